@@ -0,0 +1,140 @@
+"""
+asyncio interface, python 3 only (epublib itself doesn't import it).
+
+    from functools import partial
+    import rst2epub
+    from epublib import aio
+
+    async for chunk in aio.iter_epub(partial(rst2epub.build_book, text)):
+        await response.write(chunk)
+
+Translation and archiving run in an executor thread and the archive is
+handed over member by member while it is written, so the first bytes
+(the mimetype) go out before translation has finished and later chapters
+are compressed while earlier ones are being sent.
+"""
+import asyncio
+import os
+import threading
+import zipfile
+
+from epublib.epub import EpubBook
+from epublib.workspace import Workspace
+
+
+class StreamClosed(Exception):
+    """
+    the reader of iter_epub went away, the build is abandoned
+    """
+
+
+class ArchiveStream(object):
+    """
+    Write only file for zipfile.ZipFile that passes the archive on to
+    ``send(data)``.  zipfile seeks back to fill in the sizes and crc of a
+    member once it is written, so bytes are held until commit() (called
+    after every member) says they won't change again.  The archive is
+    the same as one written to a regular file.
+    """
+
+    def __init__(self, send):
+        self.send = send
+        self.buffer = bytearray()  # the bytes from self.base on
+        self.base = 0
+        self.pos = 0
+
+    def write(self, data):
+        start = self.pos - self.base
+        self.buffer[start : start + len(data)] = data
+        self.pos += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, pos, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            pos += self.pos
+        elif whence == os.SEEK_END:
+            pos += self.base + len(self.buffer)
+        if pos < self.base:
+            raise OSError("can't seek back into data already sent")
+        self.pos = pos
+        return pos
+
+    def flush(self):
+        pass
+
+    def commit(self):
+        if self.buffer:
+            data = bytes(self.buffer)
+            self.base += len(data)
+            self.buffer = bytearray()
+            self.send(data)
+
+
+def write_epub(make_book, stream):
+    """
+    write the epub of ``make_book()`` to the ArchiveStream `stream`, the
+    mimetype is sent before make_book is called
+    """
+    with zipfile.ZipFile(stream, "w") as fout:
+        EpubBook.add_mimetype(fout)
+        stream.commit()
+        book = make_book()
+        with Workspace() as ws:
+            root_dir = os.path.join(ws.path, "epub")
+            book.create_book(root_dir)
+            EpubBook.add_archive_members(fout, root_dir, on_member=stream.commit)
+    stream.commit()
+
+
+async def iter_epub(make_book, executor=None, chunk_size=1 << 16, queue_size=16):
+    """
+    Async iterator over the bytes of the epub of the EpubBook returned by
+    ``make_book()`` (eg ``partial(rst2epub.build_book, text)``).
+
+    make_book and the archiving run in `executor`, which must be a thread
+    pool (default: the loop's).  At most `queue_size` chunks of up to
+    `chunk_size` bytes wait for the reader before the build blocks.
+    Exceptions from the build are raised from the iterator, and closing
+    the iterator early stops the build.
+    """
+    loop = asyncio.get_running_loop()
+    chunks = asyncio.Queue(queue_size)
+    closed = threading.Event()
+
+    def put(chunk):
+        if closed.is_set():
+            raise StreamClosed()
+        asyncio.run_coroutine_threadsafe(chunks.put(chunk), loop).result()
+
+    def send(data):
+        for start in range(0, len(data), chunk_size):
+            put(data[start : start + chunk_size])
+
+    def run():
+        try:
+            write_epub(make_book, ArchiveStream(send))
+        finally:
+            if not closed.is_set():
+                put(None)
+
+    future = loop.run_in_executor(executor, run)
+    try:
+        while True:
+            chunk = await chunks.get()
+            if chunk is None:
+                break
+            yield chunk
+        await future
+    finally:
+        if not future.done():
+            # unblock a put that is waiting for room, the next one stops
+            closed.set()
+            while not chunks.empty():
+                chunks.get_nowait()
+            try:
+                await future
+            except StreamClosed:
+                pass
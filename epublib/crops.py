@@ -0,0 +1,91 @@
+"""
+Pre-rendered zoom crops for comic pages.
+
+Rather than having the reader scale the whole page image for every
+magnification, each zoom region can be cut out of the page and resized
+to the lightbox size ahead of time.  Crops are cached on disk, keyed by
+a hash of the source image plus the crop box and output size, so
+rebuilding a book only renders new regions.
+
+Needs Pillow.
+"""
+from __future__ import print_function
+
+import os
+
+from epublib import util
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+DEFAULT_CACHE_DIR = util.cache_dir("epublib-crops")
+
+
+def crop_name(src_hash, box, size, ext):
+    """
+    cache file name for the `box` (left, top, width, height percent)
+    of an image resized to `size` (width, height pixels)
+    """
+    return "{0}-{1}-{2}.{3}{4}".format(
+        src_hash,
+        "-".join(str(v) for v in box),
+        "x".join(str(v) for v in size),
+        "crop",
+        ext,
+    )
+
+
+def render_crops(src_path, regions, cache_dir=DEFAULT_CACHE_DIR):
+    """
+    cut each (box, size) of `regions` out of the image at `src_path`,
+    returning the cached crop paths in the same order.  The source is
+    only opened if some crop isn't cached yet.
+    """
+    if Image is None:
+        raise ImportError("zoom crops need Pillow")
+    ext = os.path.splitext(src_path)[1].lower()
+    src_hash = util.file_hash(src_path)
+    paths = [
+        os.path.join(cache_dir, crop_name(src_hash, box, size, ext))
+        for box, size in regions
+    ]
+    missing = [
+        (path, box, size)
+        for path, (box, size) in zip(paths, regions)
+        if not os.path.exists(path)
+    ]
+    if missing:
+        util.makedirs(cache_dir)
+        with Image.open(src_path) as img:
+            img.load()
+            img_w, img_h = img.size
+            for path, (left, top, width, height), size in missing:
+                pixel_box = (
+                    int(img_w * left / 100.0),
+                    int(img_h * top / 100.0),
+                    int(img_w * min(left + width, 100) / 100.0),
+                    int(img_h * min(top + height, 100) / 100.0),
+                )
+                crop = img.crop(pixel_box).resize(size, Image.LANCZOS)
+                if crop.mode not in ("RGB", "L") and ext in (".jpg", ".jpeg"):
+                    crop = crop.convert("RGB")
+                util.save_atomically(
+                    path, lambda tmp_path: crop.save(tmp_path, quality=90)
+                )
+    return paths
+
+
+def render_crops_many(jobs, processes=None, cache_dir=DEFAULT_CACHE_DIR):
+    """
+    run render_crops for each (src_path, regions) of `jobs` in a
+    process pool, results are in the same order as `jobs`
+    """
+    return util.process_map(
+        render_crops,
+        [(src_path, regions, cache_dir) for src_path, regions in jobs],
+        processes,
+        chunksize=1,
+    )
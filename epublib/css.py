@@ -0,0 +1,107 @@
+"""
+Drop CSS rules that can't match anything in a book.
+
+The vocabulary of a book is the set of element names, classes and ids
+used in its html.  A selector is kept if every element, class and id
+it names is in the vocabulary; a rule is kept if any of its selectors
+is.  At-rules other than @media (@page, @font-face, ...) are always
+kept, @media blocks are pruned recursively.  This is deliberately
+conservative: pseudo classes and attribute selectors are ignored when
+matching, so a kept rule may still not apply but a dropped rule never
+could.
+"""
+import re
+
+TAG_RE = re.compile(r"<([a-zA-Z][\w:-]*)([^>]*)>")
+CLASS_RE = re.compile(r"""\sclass\s*=\s*["']([^"']*)["']""")
+ID_RE = re.compile(r"""\sid\s*=\s*["']([^"']*)["']""")
+COMMENT_RE = re.compile(r"/\*.*?\*/", re.S)
+# lines left empty once comments are gone
+BLANK_LINE_RE = re.compile(r"\n[ \t]*(?=\n)")
+# pseudo classes/elements (with arguments) and attribute selectors
+PSEUDO_RE = re.compile(r"::?[\w-]+(\([^)]*\))?|\[[^\]]*\]")
+TOKEN_RE = re.compile(r"([.#]?)(-?[_a-zA-Z][\w-]*)")
+
+
+class Vocabulary(object):
+    def __init__(self):
+        self.tags = set()
+        self.classes = set()
+        self.ids = set()
+
+    def add_html(self, html):
+        for tag, attrs in TAG_RE.findall(html):
+            self.tags.add(tag.lower())
+            for classes in CLASS_RE.findall(attrs):
+                self.classes.update(classes.split())
+            self.ids.update(ID_RE.findall(attrs))
+
+    def matches(self, selector):
+        """
+        False if `selector` names an element, class or id that isn't
+        used
+        """
+        for prefix, name in TOKEN_RE.findall(PSEUDO_RE.sub("", selector)):
+            if prefix == ".":
+                if name not in self.classes:
+                    return False
+            elif prefix == "#":
+                if name not in self.ids:
+                    return False
+            elif name.lower() not in self.tags:
+                return False
+        return True
+
+
+def _blocks(text):
+    """
+    yield (prelude, body) for each top level rule of `text`, body is
+    None for statements such as @import
+    """
+    pos = 0
+    length = len(text)
+    while pos < length:
+        brace = text.find("{", pos)
+        semi = text.find(";", pos)
+        if brace == -1 and semi == -1:
+            break
+        if semi != -1 and (brace == -1 or semi < brace):
+            yield text[pos:semi].strip(), None
+            pos = semi + 1
+            continue
+        depth = 0
+        for end in range(brace, length):
+            if text[end] == "{":
+                depth += 1
+            elif text[end] == "}":
+                depth -= 1
+                if depth == 0:
+                    break
+        yield text[pos:brace].strip(), text[brace + 1:end]
+        pos = end + 1
+
+
+def prune_css(text, vocabulary):
+    """
+    return `text` without the rules that can't match `vocabulary`
+    """
+    out = []
+    text = BLANK_LINE_RE.sub("", COMMENT_RE.sub("", text))
+    for prelude, body in _blocks(text):
+        if not prelude and body is None:
+            continue
+        if body is None:
+            out.append(prelude + ";\n")
+        elif prelude.startswith("@media"):
+            inner = prune_css(body, vocabulary)
+            if inner.strip():
+                out.append("%s {\n%s}\n" % (prelude, inner))
+        elif prelude.startswith("@"):
+            out.append("%s {%s}\n" % (prelude, body))
+        else:
+            selectors = [
+                sel.strip() for sel in prelude.split(",") if vocabulary.matches(sel)
+            ]
+            if selectors:
+                out.append("%s {%s}\n" % (", ".join(selectors), body))
+    return "".join(out)
@@ -33,13 +33,14 @@ import itertools
 import mimetypes
 import os
 import shutil
-import subprocess
 import uuid
 import zipfile
 
 
 from genshi.template import TemplateLoader
 
+from epublib import css, fonts, minify, postprocess, util, xmlstream, ziputil
+
 try:
     from lxml import etree
 except ImportError as e:
@@ -51,6 +52,7 @@ COVER_ORDER = -300
 TITLE_ORDER = -200
 TOC_ORDER = -100
 OPF_NS = "http://www.idpf.org/2007/opf"
+TEMPLATES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "templates")
 
 
 class TocMapNode:
@@ -72,6 +74,18 @@ class TocMapNode:
             child._assign_play_order(next_play_order)
 
 
+class TocPage:
+    """
+    one page of a toc page split by EpubBook.toc_page_entries/bytes
+    """
+
+    def __init__(self, entries, dest_path):
+        self.entries = entries  # TocMapNodes
+        self.dest_path = dest_path
+        self.prev_href = None
+        self.next_href = None
+
+
 class EpubItem:
     def __init__(self):
         self.id = ""
@@ -83,8 +97,7 @@ class EpubItem:
 
 class EpubBook:
     def __init__(self):
-        temp_dir = os.path.dirname(os.path.abspath(__file__))
-        self.loader = TemplateLoader(os.path.join(temp_dir, "templates"))
+        self.loader = TemplateLoader(TEMPLATES_DIR)
 
         self.root_dir = ""
         self.UUID = uuid.uuid1()
@@ -99,10 +112,26 @@ class EpubBook:
         self.css_items = {}
         self.js_items = {}
         self.font_items = {}
+        # subset embedded fonts to the characters used when writing
+        self.font_subsetting = False
+        self.font_cache_dir = fonts.DEFAULT_CACHE_DIR
+        # drop css rules that match nothing in the html when writing
+        self.css_pruning = False
+        # collapse whitespace and drop comments in xhtml items when writing
+        self.minify_html = False
+        # called with the path of each item create_book writes, eg to
+        # enforce a disk quota as the book is written
+        self.on_write = None
 
         self.cover_image = None
         self.title_page = None
         self.toc_page = None
+        # split the toc page into pages of at most this many entries or
+        # bytes of entries, and leave entries deeper than toc_page_depth
+        # off it (the ncx keeps them)
+        self.toc_page_entries = None
+        self.toc_page_bytes = None
+        self.toc_page_depth = None
 
         self.spine = []
         self.guide = {}
@@ -147,6 +176,9 @@ class EpubBook:
     def get_js_items(self):
         return sorted(self.js_items.values(), key=lambda x: x.id)
 
+    def get_font_items(self):
+        return sorted(self.font_items.values(), key=lambda x: x.id)
+
     def get_all_items(self):
         return sorted(
             itertools.chain(
@@ -256,13 +288,64 @@ class EpubBook:
         self.add_spine_item(self.title_page, True, TITLE_ORDER)
         self.add_guide_item("title-page.html", "Title Page", "title-page")
 
+    def get_toc_entries(self, max_depth=None):
+        """
+        the toc map nodes in reading order, down to `max_depth`
+        """
+        entries = []
+        stack = list(reversed(self.toc_map_root.children))
+        while stack:
+            node = stack.pop()
+            if max_depth and node.depth > max_depth:
+                continue
+            entries.append(node)
+            stack.extend(reversed(node.children))
+        return entries
+
+    def _split_toc(self):
+        """
+        lists of toc entries, one per toc page
+        """
+        pages = [[]]
+        size = 0
+        for node in self.get_toc_entries(self.toc_page_depth):
+            # the markup around an entry is about 80 bytes
+            entry_size = len((node.href + node.title).encode("utf8")) + 80
+            if pages[-1] and (
+                (self.toc_page_entries and len(pages[-1]) >= self.toc_page_entries)
+                or (self.toc_page_bytes and size + entry_size > self.toc_page_bytes)
+            ):
+                pages.append([])
+                size = 0
+            pages[-1].append(node)
+            size += entry_size
+        return pages
+
     def _make_toc_page(self):
         assert self.toc_page
         tmpl = self.loader.load("toc.html")
-        stream = tmpl.generate(book=self)
-        self.toc_page.html = stream.render(
-            "xhtml", doctype="xhtml11", drop_xml_decl=False
-        )
+        if not (self.toc_page_entries or self.toc_page_bytes or self.toc_page_depth):
+            stream = tmpl.generate(book=self)
+            self.toc_page.html = stream.render(
+                "xhtml", doctype="xhtml11", drop_xml_decl=False
+            )
+            return
+        pages = [
+            TocPage(entries, "toc-{0}.html".format(i + 1) if i else "toc.html")
+            for i, entries in enumerate(self._split_toc())
+        ]
+        for page, next_page in zip(pages, pages[1:]):
+            page.next_href = next_page.dest_path
+            next_page.prev_href = page.dest_path
+        order = next(order for order, item, _ in self.spine if item is self.toc_page)
+        for i, page in enumerate(pages):
+            item = self.html_items.get(page.dest_path)
+            if item is None:
+                # right after the first page, before whatever follows it
+                item = self.add_html("", page.dest_path, "")
+                self.add_spine_item(item, False, order + float(i) / len(pages))
+            stream = tmpl.generate(book=self, page=page)
+            item.html = stream.render("xhtml", doctype="xhtml11", drop_xml_decl=False)
 
     def add_toc_page(self, order=TOC_ORDER):
         assert not self.toc_page
@@ -302,9 +385,7 @@ class EpubBook:
 
     def add_toc_map_node(self, href, title, depth=None, parent=None):
         if not title:
-            import pdb
-
-            pdb.set_trace()
+            print("WARNING: empty toc title for", href)
         print("TITLE", title)
         node = TocMapNode()
         node.href = href
@@ -319,6 +400,40 @@ class EpubBook:
         self.last_node_at_depth[node.depth] = node
         return node
 
+    def get_used_chars(self):
+        """
+        the set of characters in the text of every html item
+        """
+        chars = set()
+        for item in self.html_items.values():
+            chars.update(fonts.html_chars(item.html))
+        return chars
+
+    def _subset_fonts(self):
+        items = self.get_font_items()
+        if not items:
+            return
+        paths = fonts.subset_fonts(
+            [item.src_path for item in items],
+            self.get_used_chars(),
+            cache_dir=self.font_cache_dir,
+        )
+        for item, path in zip(items, paths):
+            item.src_path = path
+
+    def _prune_css(self):
+        vocabulary = css.Vocabulary()
+        for item in self.html_items.values():
+            vocabulary.add_html(item.html)
+        for item in self.get_css_items():
+            if item.html:
+                text = item.html
+            else:
+                with io.open(item.src_path, encoding="utf8") as fin:
+                    text = fin.read()
+            # an empty html would have _write_items copy the original
+            item.html = css.prune_css(text, vocabulary) or "\n"
+
     def make_dirs(self):
         try:
             os.makedirs(os.path.join(self.root_dir, "META-INF"))
@@ -336,10 +451,20 @@ class EpubBook:
             stream = tmpl.generate()
             fout.write(stream.render("xml"))
 
+    def _bundled_templates(self):
+        """
+        whether the loader still loads the templates that come with epublib,
+        content.opf and toc.ncx are then written without genshi
+        """
+        return self.loader.search_path == [TEMPLATES_DIR]
+
     def _write_toc_ncx(self):
         self.toc_map_root.assign_play_order()
         toc_file = os.path.join(self.root_dir, "OEBPS", "toc.ncx")
         with io.open(toc_file, mode="w", encoding="utf8") as fout:
+            if self._bundled_templates():
+                fout.writelines(xmlstream.toc_ncx(self))
+                return
             tmpl = self.loader.load("toc.ncx")
             stream = tmpl.generate(book=self)
             fout.write(stream.render("xml"))
@@ -347,6 +472,9 @@ class EpubBook:
     def _write_content_opf(self):
         content_file = os.path.join(self.root_dir, "OEBPS", "content.opf")
         with io.open(content_file, mode="w", encoding="utf8") as fout:
+            if self._bundled_templates():
+                fout.writelines(xmlstream.content_opf(self))
+                return
             tmpl = self.loader.load("content.opf")
             stream = tmpl.generate(book=self)
             data = stream.render("xml")
@@ -355,15 +483,19 @@ class EpubBook:
     def _write_items(self):
         for item in self.get_all_items():
             if item.html:
+                html = item.html
+                if self.minify_html and item.mime_type == "application/xhtml+xml":
+                    html = minify.minify_xhtml(html)
                 item_file = os.path.join(self.root_dir, "OEBPS", item.dest_path)
                 with io.open(item_file, mode="w", encoding="utf8") as fout:
                     # XXX perhaps check whether it is unicode or str and
                     # .encode() apporpriately.
-                    fout.write(item.html)
+                    fout.write(html)
             else:
-                put_file(
-                    item.src_path, os.path.join(self.root_dir, "OEBPS", item.dest_path)
-                )
+                item_file = os.path.join(self.root_dir, "OEBPS", item.dest_path)
+                put_file(item.src_path, item_file)
+            if self.on_write:
+                self.on_write(item_file)
 
     def _write_mime_type(self):
         with open(os.path.join(self.root_dir, "mimetype"), "w") as fout:
@@ -380,32 +512,158 @@ class EpubBook:
         ]
 
     @staticmethod
-    def create_archive(root_dir, output_path):
+    def _list_manifest_media_types(content_opf_path):
+        tree = etree.parse(content_opf_path)
+        return dict(
+            (foo.attrib["href"], foo.attrib.get("media-type"))
+            for foo in tree.findall("{%s}manifest/{%s}item" % (OPF_NS, OPF_NS))
+        )
+
+    @staticmethod
+    def archive_media_types(root_dir):
+        """
+        {archive name: media type} of the files under `root_dir`
+        """
+        opf_file = os.path.join(root_dir, "OEBPS", "content.opf")
+        media_types = {
+            "META-INF/container.xml": "application/xml",
+            "OEBPS/content.opf": "application/oebps-package+xml",
+        }
+        for href, media_type in EpubBook._list_manifest_media_types(opf_file).items():
+            media_types["OEBPS/" + href] = media_type
+        return media_types
+
+    @staticmethod
+    def list_archive_members(root_dir):
+        """
+        archive names of the files under `root_dir` that follow the
+        mimetype, in archive order
+        """
+        file_list = []
+        file_list.append(os.path.join("META-INF", "container.xml"))
+        file_list.append(os.path.join("OEBPS", "content.opf"))
+        opf_file = os.path.join(root_dir, "OEBPS", "content.opf")
+        for item_path in EpubBook._list_manifest_items(opf_file):
+            file_list.append(os.path.join("OEBPS", item_path))
+        return file_list
+
+    @staticmethod
+    def add_mimetype(fout):
+        # must be first and stored
+        fout.writestr(
+            "mimetype", "application/epub+zip", compress_type=zipfile.ZIP_STORED
+        )
+
+    @staticmethod
+    def add_archive_members(
+        fout, root_dir, on_member=None, previous=None, policy=None, store=None
+    ):
+        """
+        Write the book under `root_dir` to the open zipfile `fout`, calling
+        `on_member()` after each member.  Members are compressed as the
+        ziputil.CompressionPolicy `policy` says for their media type
+        (default: deflate everything).  Members whose size, crc and
+        compression match the same member of the open zipfile `previous`
+        (an earlier build of the book) have its compressed bytes copied
+        instead of being compressed again, the others come from the
+        ziputil.MemberStore `store` if one is given.  Returns the number
+        of members copied from `previous`.
+        """
+        policy = policy or ziputil.PROFILES["default"]
+        media_types = EpubBook.archive_media_types(root_dir)
+        copied = 0
+        old_file = previous and previous.fp
+        for file_path in EpubBook.list_archive_members(root_dir):
+            src_path = os.path.join(root_dir, file_path)
+            arcname = file_path.replace(os.sep, "/")
+            media_type = media_types.get(arcname)
+            compress_type, level = policy.compression(src_path, media_type)
+            old = previous and previous.NameToInfo.get(arcname)
+            if old and old.compress_type == compress_type and (
+                ziputil.file_crc(src_path) == (old.CRC, old.file_size)
+            ):
+                ziputil.write_raw(fout, old, ziputil.read_raw(old_file, old))
+                copied += 1
+            elif store is not None:
+                store.write(fout, src_path, arcname, compress_type, level)
+            elif level is None:
+                fout.write(src_path, arcname=file_path, compress_type=compress_type)
+            else:
+                fout.write(
+                    src_path,
+                    arcname=file_path,
+                    compress_type=compress_type,
+                    compresslevel=level,
+                )
+            if on_member:
+                on_member()
+        return copied
+
+    @staticmethod
+    def _write_archive(output_path, root_dir, previous, policy, store, on_progress):
         with zipfile.ZipFile(output_path, "w") as fout:
-            cwd = os.getcwd()
-            os.chdir(root_dir)
-            fout.writestr(
-                "mimetype", "application/epub+zip", compress_type=zipfile.ZIP_STORED
+            EpubBook.add_mimetype(fout)
+            on_member = on_progress and (lambda: on_progress(fout.fp.tell()))
+            if not previous:
+                EpubBook.add_archive_members(
+                    fout, root_dir, on_member, policy=policy, store=store
+                )
+                return
+            with zipfile.ZipFile(previous) as old:
+                copied = EpubBook.add_archive_members(
+                    fout, root_dir, on_member, old, policy, store
+                )
+            total = len(fout.filelist) - 1
+            print("REUSED", copied, "of", total, "members of", previous)
+
+    @staticmethod
+    def create_archive(
+        root_dir, output_path, previous=None, policy=None, store=None, on_progress=None
+    ):
+        """
+        Archive the book under `root_dir` to `output_path`, compressing
+        as the ziputil.CompressionPolicy `policy` says.  With `previous`,
+        the path of an earlier build (it may be `output_path` itself), only
+        new and changed members are compressed, and with the
+        ziputil.MemberStore `store` members already in the store aren't
+        compressed again, see add_archive_members().  `on_progress` is
+        called with the bytes of archive written after each member.
+        """
+        # no chdir here, archive names are given explicitly so several
+        # books can be archived at once from different threads
+        args = (root_dir, previous, policy, store, on_progress)
+        if previous:
+            # written next to it and renamed, `previous` may be output_path
+            util.save_atomically(
+                output_path, lambda tmp_path: EpubBook._write_archive(tmp_path, *args)
             )
-            file_list = []
-            file_list.append(os.path.join("META-INF", "container.xml"))
-            file_list.append(os.path.join("OEBPS", "content.opf"))
-            opf_file = os.path.join("OEBPS", "content.opf")
-            for item_path in EpubBook._list_manifest_items(opf_file):
-                file_list.append(os.path.join("OEBPS", item_path))
-            for file_path in file_list:
-                fout.write(file_path, compress_type=zipfile.ZIP_DEFLATED)
-        os.chdir(cwd)
+        else:
+            EpubBook._write_archive(output_path, *args)
+        if store is not None:
+            store.evict()
 
     @staticmethod
-    def check_epub(checker_path, epub_path):
-        subprocess.call(["java", "-jar", checker_path, epub_path], shell=True)
+    def check_epub(checker_path, epub_path, processor=None, timeout=None):
+        """
+        validate the epub with the epubcheck jar `checker_path`.  With a
+        PostProcessor the check is queued on it and its result comes
+        from processor.wait(), otherwise its JobResult is returned
+        """
+        command = ["java", "-jar", checker_path, "{epub}"]
+        if processor is not None:
+            processor.submit_command("epubcheck", command, epub_path, timeout)
+            return None
+        return postprocess.run_command("epubcheck", command, epub_path, timeout)
 
     def create_book(self, root_dir):
         if self.title_page:
             self._make_title_page()
         if self.toc_page:
             self._make_toc_page()
+        if self.font_subsetting:
+            self._subset_fonts()
+        if self.css_pruning:
+            self._prune_css()
         self.root_dir = root_dir
         self.make_dirs()
         self._write_mime_type()
@@ -0,0 +1,90 @@
+"""
+Subset embedded fonts down to the characters a book actually uses.
+
+A full CJK or pan-Unicode font is several megabytes; the glyphs a book
+needs are usually a small fraction of that.  Subsets are cached on disk
+keyed by a hash of the font file and of the character set, so fonts
+shared between books (or rebuilds of the same book) are only subset
+once.
+
+Needs fontTools.
+"""
+from __future__ import print_function
+
+import hashlib
+import os
+
+from genshi.util import stripentities, striptags
+
+from epublib import util
+
+try:
+    from fontTools import subset
+except ImportError:
+    subset = None
+
+
+CACHE_NAME = "epublib-fonts"
+DEFAULT_CACHE_DIR = util.cache_dir(CACHE_NAME)
+
+
+def html_chars(html):
+    """
+    the set of characters in the text of `html`, with their upper and
+    lower case forms since css (small-caps, text-transform) can show
+    text in a case it isn't written in
+    """
+    chars = set(stripentities(striptags(html)))
+    for char in list(chars):
+        chars.update(char.upper())
+        chars.update(char.lower())
+    return chars
+
+
+def subset_name(font_path, chars):
+    chars_digest = hashlib.sha1("".join(sorted(chars)).encode("utf8"))
+    ext = os.path.splitext(font_path)[1]
+    return "{0}-{1}{2}".format(
+        util.file_hash(font_path), chars_digest.hexdigest(), ext
+    )
+
+
+def subset_font(font_path, chars, cache_dir=DEFAULT_CACHE_DIR):
+    """
+    return the path of a copy of `font_path` with only the glyphs for
+    `chars`, reusing a cached subset if there is one
+    """
+    if subset is None:
+        raise ImportError("font subsetting needs fontTools")
+    dest_path = os.path.join(cache_dir, subset_name(font_path, chars))
+    if os.path.exists(dest_path):
+        return dest_path
+    util.makedirs(cache_dir)
+    options = subset.Options()
+    # keep all layout features (ligatures, kerning, ...) for the glyphs
+    # that are kept
+    options.layout_features = ["*"]
+    options.notdef_outline = True
+    font = subset.load_font(font_path, options)
+    subsetter = subset.Subsetter(options)
+    subsetter.populate(unicodes=[ord(char) for char in chars])
+    subsetter.subset(font)
+    util.save_atomically(
+        dest_path, lambda tmp_path: subset.save_font(font, tmp_path, options)
+    )
+    font.close()
+    return dest_path
+
+
+def subset_fonts(font_paths, chars, processes=None, cache_dir=DEFAULT_CACHE_DIR):
+    """
+    subset each of `font_paths` to `chars` in a process pool, returning
+    the subset paths in the same order
+    """
+    font_paths = list(font_paths)
+    if len(font_paths) < 2:
+        return [subset_font(path, chars, cache_dir) for path in font_paths]
+    chars = "".join(sorted(chars))
+    return util.process_map(
+        subset_font, [(path, chars, cache_dir) for path in font_paths], processes
+    )
@@ -0,0 +1,117 @@
+"""
+Syntax highlighting of code blocks for EPUB2 and Kindle readers.
+
+Code is marked up with ``<span class="...">`` only (pygments' short token
+classes) and coloured by a generated stylesheet scoped to
+``div.highlight``, so the markup doesn't depend on the style and old
+readers that ignore the stylesheet still show plain code.  Highlighted
+blocks are cached on disk keyed by a hash of the code, the language and
+the pygments version, and blocks that aren't cached yet can be
+highlighted in a process pool.
+
+Needs pygments.
+"""
+from __future__ import print_function
+
+import hashlib
+import io
+import os
+
+from epublib import util
+
+try:
+    import pygments
+    from pygments.formatters import HtmlFormatter
+    from pygments.lexers import get_lexer_by_name
+    from pygments.util import ClassNotFound
+except ImportError:
+    pygments = None
+
+
+CACHE_NAME = "epublib-highlight"
+DEFAULT_CACHE_DIR = util.cache_dir(CACHE_NAME)
+# below this many uncached blocks starting a pool costs more than it saves
+POOL_MIN_BLOCKS = 64
+
+
+def cache_name(code, language):
+    digest = hashlib.sha1()
+    for part in (pygments.__version__, language, code):
+        digest.update(part.encode("utf8") + b"\0")
+    return digest.hexdigest() + ".html"
+
+
+def highlight_code(code, language, cache_dir=DEFAULT_CACHE_DIR):
+    """
+    html for `code` in `language`, None if pygments doesn't know the
+    language
+    """
+    if pygments is None:
+        raise ImportError("syntax highlighting needs pygments")
+    path = os.path.join(cache_dir, cache_name(code, language))
+    if os.path.exists(path):
+        with io.open(path, encoding="utf8") as fin:
+            return fin.read()
+    try:
+        lexer = get_lexer_by_name(language)
+    except ClassNotFound:
+        return None
+    html = pygments.highlight(code, lexer, HtmlFormatter(nowrap=True))
+    html = html[:-1] if html.endswith("\n") else html
+    util.makedirs(cache_dir)
+
+    def save(tmp_path):
+        with io.open(tmp_path, "w", encoding="utf8") as fout:
+            fout.write(html)
+
+    util.save_atomically(path, save)
+    return html
+
+
+def highlight_many(blocks, processes=None, cache_dir=DEFAULT_CACHE_DIR):
+    """
+    return {(code, language): html or None} for the (code, language)
+    pairs in `blocks`, highlighting the ones that aren't cached in a
+    process pool when there are many of them
+    """
+    unique = sorted(set(blocks))
+    todo = [
+        (code, language)
+        for code, language in unique
+        if not os.path.exists(os.path.join(cache_dir, cache_name(code, language)))
+    ]
+    if len(todo) >= POOL_MIN_BLOCKS:
+        util.process_map(
+            highlight_code,
+            [(code, language, cache_dir) for code, language in todo],
+            processes,
+        )
+    return dict(
+        (block, highlight_code(block[0], block[1], cache_dir)) for block in unique
+    )
+
+
+def stylesheet(style="default", cache_dir=DEFAULT_CACHE_DIR):
+    """
+    path of the css for pygments style `style`, scoped to div.highlight
+    """
+    if pygments is None:
+        raise ImportError("syntax highlighting needs pygments")
+    path = os.path.join(cache_dir, "highlight-{0}.css".format(style))
+    defs = HtmlFormatter(style=style).get_style_defs("div.highlight")
+    # leave out the unscoped pre and line number rules
+    css = "\n".join(
+        line for line in defs.splitlines() if line.startswith("div.highlight")
+    )
+    if os.path.exists(path):
+        with io.open(path, encoding="utf8") as fin:
+            if fin.read() == css:
+                return path
+    util.makedirs(cache_dir)
+
+    def save(tmp_path):
+        with io.open(tmp_path, "w", encoding="utf8") as fout:
+            fout.write(css)
+
+    util.save_atomically(path, save)
+    return path
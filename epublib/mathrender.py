@@ -0,0 +1,136 @@
+"""
+Math for EPUB2 readers.
+
+Each expression becomes MathML (docutils' own latex2mathml, no external
+tools) with a png rendered by matplotlib's mathtext as the fallback for
+readers without MathML; the translator puts the two in an
+``<ops:switch>``.  Without matplotlib the fallback is the TeX source.
+
+Renders are cached on disk keyed by a hash of the TeX, inline or block,
+the image resolution and the docutils and matplotlib versions, and
+expressions that aren't cached yet can be rendered in a process pool.
+"""
+from __future__ import print_function
+
+import hashlib
+import io
+import json
+import os
+
+import docutils
+
+from epublib import util
+
+try:
+    from docutils.utils.math import latex2mathml, unichar2tex
+except ImportError:
+    latex2mathml = None
+
+try:
+    import matplotlib
+    from matplotlib import mathtext
+except ImportError:
+    matplotlib = None
+
+
+CACHE_NAME = "epublib-math"
+DEFAULT_CACHE_DIR = util.cache_dir(CACHE_NAME)
+# below this many uncached expressions starting a pool costs more than it saves
+POOL_MIN_EXPRESSIONS = 64
+
+
+def cache_key(tex, block, dpi):
+    digest = hashlib.sha1()
+    versions = (docutils.__version__, matplotlib and matplotlib.__version__)
+    for part in versions + (tex, block, dpi):
+        digest.update(u"{0}".format(part).encode("utf8") + b"\0")
+    return digest.hexdigest()
+
+
+def to_mathml(tex, block):
+    """
+    MathML for `tex`, raises ValueError if it can't be converted
+    """
+    if latex2mathml is None or not hasattr(latex2mathml, "tex2mathml"):
+        raise ValueError("this docutils can't convert math to MathML")
+    tex = tex.translate(unichar2tex.uni2tex_table)
+    try:
+        return latex2mathml.tex2mathml(tex, as_block=block)
+    except Exception as e:
+        raise ValueError(str(e))
+
+
+def render_image(tex, path, dpi):
+    """
+    render `tex` to the png `path` with mathtext, raises ValueError if
+    it can't
+    """
+    # mathtext does a single line of inline math
+    tex = " ".join(tex.split())
+    try:
+        mathtext.math_to_image(u"${0}$".format(tex), path, dpi=dpi, format="png")
+    except Exception as e:
+        raise ValueError(str(e))
+
+
+def render(tex, block=False, dpi=150, cache_dir=DEFAULT_CACHE_DIR):
+    """
+    Render `tex` and return a dict with "mathml" and "image" (path of the
+    png), either may be None, and "errors" saying why.  Failures are
+    cached too.
+    """
+    key = cache_key(tex, block, dpi)
+    path = os.path.join(cache_dir, key + ".json")
+    if os.path.exists(path):
+        with io.open(path, encoding="utf8") as fin:
+            result = json.load(fin)
+        if result["image"]:
+            # stored relative so the cache can be moved
+            result["image"] = os.path.join(cache_dir, result["image"])
+        return result
+    util.makedirs(cache_dir)
+    result = {"mathml": None, "image": None, "errors": []}
+    try:
+        result["mathml"] = to_mathml(tex, block)
+    except ValueError as e:
+        result["errors"].append(u"MathML: {0}".format(e))
+    if matplotlib is not None:
+        image = os.path.join(cache_dir, key + ".png")
+        try:
+            util.save_atomically(image, lambda tmp: render_image(tex, tmp, dpi))
+            result["image"] = key + ".png"
+        except ValueError as e:
+            result["errors"].append(u"image: {0}".format(e))
+
+    def save(tmp_path):
+        with io.open(tmp_path, "w", encoding="utf8") as fout:
+            fout.write(json.dumps(result, ensure_ascii=False))
+
+    util.save_atomically(path, save)
+    if result["image"]:
+        result["image"] = os.path.join(cache_dir, result["image"])
+    return result
+
+
+def render_many(expressions, processes=None, dpi=150, cache_dir=DEFAULT_CACHE_DIR):
+    """
+    return {(tex, block): render()} for the (tex, block) pairs in
+    `expressions`, rendering the ones that aren't cached in a process
+    pool when there are many of them
+    """
+    unique = sorted(set(expressions))
+    todo = [
+        (tex, block)
+        for tex, block in unique
+        if not os.path.exists(
+            os.path.join(cache_dir, cache_key(tex, block, dpi) + ".json")
+        )
+    ]
+    if len(todo) >= POOL_MIN_EXPRESSIONS:
+        util.process_map(
+            render, [(tex, block, dpi, cache_dir) for tex, block in todo], processes
+        )
+    return dict(
+        (expression, render(expression[0], expression[1], dpi, cache_dir))
+        for expression in unique
+    )
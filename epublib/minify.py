@@ -0,0 +1,61 @@
+"""
+Conservative XHTML minification.
+
+Outside of ``pre``, ``script``, ``style`` and ``textarea`` elements:
+
+* comments are dropped
+* runs of whitespace are collapsed to a single space
+* whitespace next to block level tags, where it can't render, is
+  removed
+* empty ``class`` and ``style`` attributes are dropped and the
+  whitespace inside ``class`` values is collapsed
+
+Attributes the XHTML 1.1 DTD requires (``type`` on ``script``/``style``
+and friends) are left alone so epubcheck stays happy.  Each document is
+minified on its own, so it can run per chapter.
+"""
+import re
+
+# elements whose content is kept verbatim
+PRESERVE_RE = re.compile(
+    r"(<(pre|script|style|textarea)\b[^>]*>.*?</\2\s*>)", re.S | re.I
+)
+COMMENT_RE = re.compile(r"<!--.*?-->", re.S)
+SPACE_RE = re.compile(r"[ \t\r\n]+")
+BLOCK_TAGS = (
+    "html|head|body|title|meta|link|div|p|h[1-6]|ul|ol|li|dl|dt|dd|table|"
+    "caption|colgroup|col|thead|tbody|tfoot|tr|td|th|blockquote|hr|br|"
+    "pre|script|style|address|center|noscript|form|fieldset|legend|"
+    "object|param|map|area|\\?xml|!DOCTYPE"
+)
+BLOCK_SPACE_RE = re.compile(r" ?(</?(?:%s)\b[^>]*>) ?" % BLOCK_TAGS, re.I)
+EMPTY_ATTR_RE = re.compile(r"""\s(?:class|style)=(["'])\s*\1""")
+CLASS_ATTR_RE = re.compile(r"""(\sclass=)(["'])([^"']*)\2""")
+
+
+def _clean_class(match):
+    return "%s%s%s%s" % (
+        match.group(1),
+        match.group(2),
+        " ".join(match.group(3).split()),
+        match.group(2),
+    )
+
+
+def _minify_text(html):
+    html = COMMENT_RE.sub("", html)
+    html = SPACE_RE.sub(" ", html)
+    html = BLOCK_SPACE_RE.sub(r"\1", html)
+    html = EMPTY_ATTR_RE.sub("", html)
+    return CLASS_ATTR_RE.sub(_clean_class, html)
+
+
+def minify_xhtml(html):
+    parts = PRESERVE_RE.split(html)
+    out = []
+    # split gives text, preserved element, element name, text, ...
+    for i in range(0, len(parts), 3):
+        out.append(_minify_text(parts[i]))
+        if i + 1 < len(parts):
+            out.append(parts[i + 1])
+    return "".join(out).strip()
@@ -1,13 +1,19 @@
 from __future__ import print_function
 
+import array
 import io
 import logging
 import math
+import os
 
-from epublib import epub
+from epublib import crops, epub, panels
 from genshi.core import Markup
 
-logging.basicConfig(level=logging.DEBUG)
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 # see http://blog.epubandebookhelp.com/2012/05/16/kf8-panel-magnification/
 # and amazon sample book
 # http://mathorsinfotech.blogspot.com/2012/06/kf8-fixed-layout-image-zoom-tutorial.html
@@ -70,8 +76,66 @@ class MobiComicBook(epub.EpubBook):
         self.pages.append(page)
         return page
 
+    def crop_zoom_regions(self, processes=None, cache_dir=crops.DEFAULT_CACHE_DIR):
+        """
+        Pre-render every zoom region as a crop sized to its lightbox and
+        use that in place of the css scaled page image.  Crops are made
+        in a process pool, one job per page, and cached in `cache_dir`.
+        Call after all regions are added.
+        """
+        jobs = []
+        for page in self.pages:
+            for src_path, regions, indexes in page.crop_jobs():
+                jobs.append((page, src_path, regions, indexes))
+        results = crops.render_crops_many(
+            [(src_path, regions) for _, src_path, regions, _ in jobs],
+            processes=processes,
+            cache_dir=cache_dir,
+        )
+        for (page, _, _, indexes), paths in zip(jobs, results):
+            for index, path in zip(indexes, paths):
+                dest_path = "crops/" + os.path.basename(path)
+                self.add_image(path, dest_path)
+                page.mags.set_crop(index, dest_path)
+
+    def auto_panel_pages(self, processes=None, zoom_factor=2, **kw):
+        """
+        detect the panels of every page with a background image in a
+        process pool and add zoom targets for them (see panels.find_panels
+        for `kw`)
+        """
+        pages = [page for page in self.pages if page.img]
+        results = panels.detect_panels_many(
+            [page.img.src_path for page in pages], processes=processes, **kw
+        )
+        # targets are added in page order so ids/ordinals stay stable
+        for page, rects in zip(pages, results):
+            page.add_panel_targets(rects, zoom_factor=zoom_factor)
+
 
 class Mag(object):
+    __slots__ = (
+        "txt",
+        "target_id_parent",
+        "target_id",
+        "top",
+        "left",
+        "height",
+        "width",
+        "lb_top",
+        "lb_left",
+        "lb_width",
+        "lb_height",
+        "zoomed_img_top",
+        "zoomed_img_left",
+        "ordinal",
+        "zoom_factor",
+        "img_src",
+        "post_data",
+        "pre_data",
+        "cropped",
+    )
+
     def __init__(
         self,
         txt,
@@ -92,6 +156,7 @@ class Mag(object):
         zoom_factor=1.5,
         pre_data=None,
         post_data=None,
+        cropped=False,
     ):
         self.txt = txt
         self.target_id_parent = target_id_parent
@@ -115,7 +180,10 @@ class Mag(object):
 
         self.ordinal = ordinal
         self.zoom_factor = zoom_factor
+        # img_src is either the page image scaled by css or, if cropped,
+        # a pre-rendered crop of just this region
         self.img_src = img_src
+        self.cropped = cropped
         # text/etc to display
         if post_data:
             self.post_data = Markup(post_data)
@@ -139,6 +207,110 @@ class Mag(object):
         return result
 
 
+class MagRegions(object):
+    """
+    Compact storage for the zoom regions of a page.  Coordinates live in
+    int arrays, one per field, and Mag objects are only built while
+    iterating (ie when the template renders the page).
+    """
+
+    INT_FIELDS = (
+        "left",
+        "top",
+        "width",
+        "height",
+        "lb_left",
+        "lb_top",
+        "lb_width",
+        "lb_height",
+        "zoomed_img_left",
+        "zoomed_img_top",
+        "ordinal",
+        "cropped",
+    )
+
+    def __init__(self, parent_suffix):
+        self.parent_suffix = parent_suffix
+        self.columns = dict((name, array.array("i")) for name in self.INT_FIELDS)
+        self.target_ids = []
+        self.img_srcs = []
+        # (txt, zoom_factor, pre_data, post_data), shared by all the
+        # regions added in one call
+        self.extras = []
+
+    def __len__(self):
+        return len(self.target_ids)
+
+    def __iter__(self):
+        columns = [self.columns[name] for name in self.INT_FIELDS]
+        for i, tid in enumerate(self.target_ids):
+            (left, top, width, height, lb_left, lb_top, lb_width, lb_height,
+             zoomed_img_left, zoomed_img_top, ordinal, cropped) = [
+                col[i] for col in columns]
+            txt, zoom_factor, pre_data, post_data = self.extras[i]
+            yield Mag(
+                txt,
+                tid + self.parent_suffix,
+                tid,
+                left,
+                top,
+                width,
+                height,
+                lb_left,
+                lb_top,
+                lb_width,
+                lb_height,
+                zoomed_img_left,
+                zoomed_img_top,
+                self.img_srcs[i],
+                ordinal,
+                zoom_factor=zoom_factor,
+                pre_data=pre_data,
+                post_data=post_data,
+                cropped=bool(cropped),
+            )
+
+    def append(self, mag):
+        for name in self.INT_FIELDS:
+            self.columns[name].append(int(getattr(mag, name)))
+        self.target_ids.append(mag.target_id)
+        self.img_srcs.append(mag.img_src)
+        self.extras.append((mag.txt, mag.zoom_factor, mag.pre_data, mag.post_data))
+
+    def extend(self, target_ids, img_src, extra, **columns):
+        """
+        add many regions at once, `columns` maps each of INT_FIELDS to a
+        sequence of ints (``cropped`` is optional)
+        """
+        columns.setdefault("cropped", [0] * len(target_ids))
+        for name in self.INT_FIELDS:
+            self.columns[name].extend(columns[name])
+        self.target_ids.extend(target_ids)
+        self.img_srcs.extend([img_src] * len(target_ids))
+        self.extras.extend([extra] * len(target_ids))
+
+    def set_crop(self, index, img_src):
+        """
+        point region `index` at a pre-rendered crop instead of the page
+        """
+        self.img_srcs[index] = img_src
+        self.columns["cropped"][index] = 1
+
+
+def grid_rects(rows, cols, left=0, top=0, width=100, height=100):
+    """
+    (left, top, width, height) percent rects for a rows x cols grid
+    covering the given area, row by row
+    """
+    cell_w = width / float(cols)
+    cell_h = height / float(rows)
+    return [
+        (left + col * cell_w, top + row * cell_h, cell_w, cell_h)
+        for row in range(rows)
+        for col in range(cols)
+    ]
+
+
 LEFT = 1
 RIGHT = 2
 DOWN = 3
@@ -151,7 +323,7 @@ class Page(object):
     def __init__(self, book, height=1024, width=600):
         self.img = None
         self.book = book
-        self.mags = []
+        self.mags = MagRegions(self.PARENT_SUFFIX)
         self.title = None
         self.style = None
         self.height = height
@@ -178,13 +350,11 @@ class Page(object):
     ):
         start_left = whtarget_left
         # target is all in percent
-        print("ZF", zoom_factor)
         if direction == LEFT:
             chunks = whtarget_width * zoom_factor / 100.0
             chunk_int = int(math.ceil(chunks))
             target_left = whtarget_left
             zoom_left = whtarget_left
-            print("CHUNKS", chunks, "WHOLE WIDTH", whtarget_width)
             for i in range(chunk_int):
                 if chunks > 1:
                     target_width = whtarget_width / float(chunks)
@@ -196,20 +366,12 @@ class Page(object):
                     target_left = 100 - target_width
                     zoom_left = 100 - target_width
                 elif right_side > start_left + whtarget_width:
-                    print("OFF RIGHT")
                     target_left = whtarget_left + whtarget_width - target_width
                     zoom_left = whtarget_left + whtarget_width - target_width
                     # target_width = whtarget_width # - target_left
-                print("LEFT", target_left)
-                print("RIGHT SIDE", right_side, "TW", target_width)
-
-                print(
-                    "H", self.book.height, "MINUS", -whtarget_height * zoom_factor / 2.0
-                )
                 lb_width = 100
                 lb_left = 0
                 if whtarget_width * zoom_factor < 100:
-                    print("SMALLER", whtarget_width * zoom_factor)
                     lb_width = whtarget_width * zoom_factor
                     lb_left = 50 - lb_width / 2
                 calculated_zoom_something = (
@@ -237,6 +399,113 @@ class Page(object):
                 target_left += whtarget_width / float(chunks)
                 # target_left += (whtarget_width - target_width)/float(chunks)
 
+    def add_regions(self, rects, zoom_factor=2, txt=None, pre_data=None, post_data=None):
+        """
+        Batched auto_target (direction LEFT): compute the click target,
+        lightbox and zoom offsets of every (left, top, width, height)
+        percent rect in one numpy pass and store them in self.mags.
+        Wide rects are split into several regions as in auto_target.
+        """
+        if np is None:
+            raise ImportError("add_regions needs numpy")
+        rects = np.asarray(rects, dtype=float).reshape(-1, 4)
+        left, top, width, height = rects.T
+        chunks = width * zoom_factor / 100.0
+        counts = np.ceil(chunks).astype(int)
+        # one row per region, the chunks of a rect are consecutive
+        rect_idx = np.repeat(np.arange(len(rects)), counts)
+        step = np.arange(len(rect_idx)) - np.repeat(np.cumsum(counts) - counts, counts)
+        left, top, width, height = (
+            left[rect_idx],
+            top[rect_idx],
+            width[rect_idx],
+            height[rect_idx],
+        )
+        chunks = chunks[rect_idx]
+        target_width = np.where(chunks > 1, width / np.maximum(chunks, 1), width)
+        # accumulate step by step (rather than step * width) so the
+        # floats, and the truncated ints, match auto_target exactly
+        target_left = left.copy()
+        for i in range(1, counts.max() if len(counts) else 0):
+            later = step >= i
+            target_left[later] += target_width[later]
+        right_side = target_left + target_width
+        target_left = np.where(
+            right_side > 100,
+            100 - target_width,
+            np.where(right_side > left + width, left + width - target_width, target_left),
+        )
+        zoomed_width = width * zoom_factor
+        lb_width = np.where(zoomed_width < 100, zoomed_width, 100)
+        lb_left = np.where(zoomed_width < 100, 50 - lb_width / 2, 0)
+
+        n = len(rect_idx)
+        target_ids = [self.book.get_target_id() for _ in range(n)]
+        ordinals = [self.book.get_ordinal() for _ in range(n)]
+
+        def ints(values):
+            return np.trunc(values).astype(int).tolist()
+
+        self.mags.extend(
+            target_ids,
+            self.img.dest_path,
+            (txt, zoom_factor, pre_data, post_data),
+            left=ints(target_left),
+            top=ints(top),
+            width=ints(target_width),
+            height=ints(height),
+            lb_left=ints(lb_left),
+            lb_top=ints(50.0 - height * zoom_factor / 2.0),
+            lb_width=ints(lb_width),
+            lb_height=ints(height * zoom_factor),
+            zoomed_img_left=ints(-target_left),
+            zoomed_img_top=ints(-100 * (top / height / zoom_factor)),
+            ordinal=ordinals,
+        )
+
+    def crop_jobs(self):
+        """
+        yield (src_path, regions, indexes) for each image the zoom
+        regions of this page magnify, where regions are the
+        (box, size) pairs crops.render_crops takes
+        """
+        by_src = {}
+        for i, mag in enumerate(self.mags):
+            if mag.cropped:
+                continue
+            src_path = self.book.image_items[mag.img_src].src_path
+            box = (mag.left, mag.top, mag.width, mag.height)
+            size = (
+                max(1, int(self.width * mag.lb_width / 100.0)),
+                max(1, int(self.height * mag.lb_height / 100.0)),
+            )
+            regions, indexes = by_src.setdefault(src_path, ([], []))
+            regions.append((box, size))
+            indexes.append(i)
+        for src_path, (regions, indexes) in by_src.items():
+            yield src_path, regions, indexes
+
+    def add_grid(self, rows, cols, zoom_factor=2, **kw):
+        """
+        add zoom regions for a rows x cols grid over the page, see
+        add_regions
+        """
+        self.add_regions(grid_rects(rows, cols), zoom_factor=zoom_factor, **kw)
+
+    def add_panel_targets(self, rects, zoom_factor=2, **kw):
+        """
+        add zoom targets for (left, top, width, height) percent rects
+        """
+        self.add_regions(rects, zoom_factor=zoom_factor, **kw)
+
+    def auto_panels(self, zoom_factor=2, **kw):
+        """
+        detect the panels of the background image and add zoom targets
+        for them
+        """
+        rects = panels.detect_panels(self.img.src_path, **kw)
+        self.add_panel_targets(rects, zoom_factor=zoom_factor)
+
     def add_zoom_image(
         self,
         zoom_factor,
@@ -356,4 +625,5 @@ def test():
 
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.DEBUG)
     test()
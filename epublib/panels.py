@@ -0,0 +1,99 @@
+"""
+Automatic panel detection for comic pages.
+
+Gutters are found from row and column projections of the page: a row
+(or column) is gutter if nearly all of its pixels are background.  The
+page is cut into horizontal strips at row gutters and each strip into
+panels at column gutters.  Panels are returned as
+(left, top, width, height) tuples in percent of the page, the units
+``mobi.Page.auto_target`` expects.
+
+Needs numpy and Pillow.
+"""
+from __future__ import print_function
+
+from epublib import util
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+def load_page(path):
+    """
+    return the page at `path` as a 2d array of grey levels
+    """
+    if np is None or Image is None:
+        raise ImportError("panel detection needs numpy and Pillow")
+    with Image.open(path) as img:
+        return np.asarray(img.convert("L"), dtype=np.uint8)
+
+
+def _runs(mask):
+    """
+    start and end (exclusive) indexes of the runs of True in `mask`
+    """
+    padded = np.concatenate(([False], mask, [False]))
+    edges = np.flatnonzero(padded[1:] != padded[:-1])
+    return edges[0::2], edges[1::2]
+
+
+def _content_runs(gutter, min_size):
+    starts, ends = _runs(~gutter)
+    keep = (ends - starts) >= min_size
+    return starts[keep], ends[keep]
+
+
+def find_panels(pixels, background=255, tolerance=24, fill=0.98, min_size=0.05):
+    """
+    return the panel rectangles of a page in percent
+
+    `pixels` is a 2d grey level array.  A pixel is background if it is
+    within `tolerance` of `background`; a row/column is gutter if at
+    least `fill` of it is background.  Strips and panels smaller than
+    `min_size` (fraction of the page) are dropped as noise.
+    """
+    height, width = pixels.shape
+    is_bg = np.abs(pixels.astype(np.int16) - background) <= tolerance
+    row_gutter = is_bg.mean(axis=1) >= fill
+    panels = []
+    for top, bottom in zip(*_content_runs(row_gutter, min_size * height)):
+        strip = is_bg[top:bottom]
+        col_gutter = strip.mean(axis=0) >= fill
+        for left, right in zip(*_content_runs(col_gutter, min_size * width)):
+            panels.append(
+                (
+                    100.0 * int(left) / width,
+                    100.0 * int(top) / height,
+                    100.0 * int(right - left) / width,
+                    100.0 * int(bottom - top) / height,
+                )
+            )
+    return panels
+
+
+def detect_panels(path, **kw):
+    """
+    load the page image at `path` and return its panels, see find_panels
+    """
+    return find_panels(load_page(path), **kw)
+
+
+def detect_panels_many(paths, processes=None, **kw):
+    """
+    detect the panels of many pages in a process pool, results are in
+    the same order as `paths`
+    """
+    return util.process_map(
+        _detect_panels_kw, [(path, kw) for path in paths], processes
+    )
+
+
+def _detect_panels_kw(path, kw):
+    return detect_panels(path, **kw)
@@ -0,0 +1,155 @@
+"""
+Run external converters and validators (kindlegen, epubcheck, ...) on
+finished books in a background pool so the build doesn't stall on
+them.  Register commands, submit each epub as it is written, and
+report the results at the end of the build::
+
+    processor = PostProcessor(max_workers=2)
+    processor.register("kindlegen", "kindlegen {epub}")
+    processor.register("epubcheck", ["java", "-jar", "epubcheck.jar", "{epub}"])
+    processor.submit("book.epub")
+    ...
+    processor.report(processor.wait())
+"""
+from __future__ import print_function
+
+import shlex
+import subprocess
+import sys
+import threading
+import time
+import traceback
+
+
+class JobResult(object):
+    def __init__(self, name, epub_path, returncode, output, elapsed, timed_out=False):
+        self.name = name
+        self.epub_path = epub_path
+        self.returncode = returncode
+        self.output = output
+        self.elapsed = elapsed
+        self.timed_out = timed_out
+
+    @property
+    def ok(self):
+        return self.returncode == 0 and not self.timed_out
+
+
+def run_command(name, command, epub_path, timeout=None):
+    """
+    run `command` on `epub_path`, returning a JobResult with the
+    combined stdout/stderr.  ``{epub}`` in the command is replaced by
+    the path of the book, other braces are left alone.
+    """
+    if not isinstance(command, (list, tuple)):
+        command = shlex.split(command)
+    args = [arg.replace("{epub}", epub_path) for arg in command]
+    start = time.time()
+    try:
+        proc = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    except OSError as e:
+        return JobResult(name, epub_path, None, str(e), time.time() - start)
+    # a timer rather than communicate(timeout=), which python 2 (that
+    # the sphinx extension runs on) doesn't have
+    timed_out = []
+    timer = None
+    if timeout:
+
+        def kill():
+            timed_out.append(True)
+            proc.kill()
+
+        timer = threading.Timer(timeout, kill)
+        timer.start()
+    try:
+        output, _ = proc.communicate()
+    finally:
+        if timer is not None:
+            timer.cancel()
+    return JobResult(
+        name,
+        epub_path,
+        proc.returncode,
+        output.decode("utf8", "replace"),
+        time.time() - start,
+        bool(timed_out),
+    )
+
+
+class PostProcessor(object):
+    def __init__(self, max_workers=2, timeout=None):
+        self.commands = []  # (name, command, timeout) tuples
+        self.timeout = timeout
+        self.slots = threading.Semaphore(max_workers)
+        self.jobs = []  # (thread, result list) in submission order
+
+    def register(self, name, command, timeout=None):
+        """
+        `command` is a string or a list of arguments, ``{epub}`` is
+        replaced with the path of each submitted book
+        """
+        self.commands.append((name, command, timeout or self.timeout))
+
+    def _run(self, result, name, command, epub_path, timeout):
+        with self.slots:
+            start = time.time()
+            try:
+                result.append(run_command(name, command, epub_path, timeout))
+            except Exception:
+                result.append(
+                    JobResult(
+                        name, epub_path, None, traceback.format_exc(), time.time() - start
+                    )
+                )
+
+    def submit(self, epub_path):
+        """
+        queue every registered command for `epub_path` and return
+        immediately, at most max_workers commands run at once
+        """
+        for name, command, timeout in self.commands:
+            self.submit_command(name, command, epub_path, timeout)
+
+    def submit_command(self, name, command, epub_path, timeout=None):
+        """
+        queue a single `command` (not registered) for `epub_path`
+        """
+        result = []
+        thread = threading.Thread(
+            target=self._run,
+            args=(result, name, command, epub_path, timeout or self.timeout),
+        )
+        thread.daemon = True
+        thread.start()
+        self.jobs.append((thread, result))
+
+    def wait(self):
+        """
+        block until all submitted jobs are done, return their results
+        in submission order.  A job that raised gives a failed result.
+        """
+        results = []
+        for thread, result in self.jobs:
+            thread.join()
+            results.extend(result)
+        self.jobs = []
+        return results
+
+    @staticmethod
+    def report(results, fout=None):
+        fout = fout or sys.stdout
+        for result in results:
+            if result.timed_out:
+                status = "TIMED OUT"
+            elif result.ok:
+                status = "OK"
+            else:
+                status = "FAILED ({0})".format(result.returncode)
+            print(
+                "POST PROCESS {0} {1}: {2} {3:.1f}s".format(
+                    result.name, result.epub_path, status, result.elapsed
+                ),
+                file=fout,
+            )
+            if not result.ok and result.output:
+                print(result.output, file=fout)
@@ -0,0 +1,197 @@
+"""
+Size report of an epub: the compressed and uncompressed bytes of every
+chapter, image, font and stylesheet, in spine then manifest order, with
+the members over a size budget flagged.
+
+Only the central directory, container.xml, content.opf and toc.ncx are
+read, the other members aren't decompressed.  ``rst2epub inspect`` runs
+it on existing epubs and ``--size-report`` on the book being built.
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import posixpath
+import zipfile
+
+try:
+    from lxml import etree
+except ImportError:
+    import xml.etree.ElementTree as etree
+
+CONTAINER_NS = "urn:oasis:names:tc:opendocument:xmlns:container"
+OPF_NS = "http://www.idpf.org/2007/opf"
+NCX_NS = "http://www.daisy.org/z3986/2005/ncx/"
+
+# media type (or its prefix) -> kind shown in the report
+KINDS = (
+    ("application/xhtml+xml", "chapter"),
+    ("image/", "image"),
+    ("text/css", "stylesheet"),
+    ("application/opentype", "font"),
+    ("application/truetype", "font"),
+    ("font/", "font"),
+    ("application/font", "font"),
+    ("application/x-font", "font"),
+)
+
+
+def kind_of(media_type):
+    for prefix, kind in KINDS:
+        if (media_type or "").startswith(prefix):
+            return kind
+    return "other"
+
+
+def _titles(book, ncx_name):
+    """
+    {archive name: toc title} from the toc.ncx, first title wins
+    """
+    titles = {}
+    if ncx_name not in book.NameToInfo:
+        return titles
+    tree = etree.fromstring(book.read(ncx_name))
+    base = posixpath.dirname(ncx_name)
+    for point in tree.iter("{%s}navPoint" % NCX_NS):
+        text = point.find("{%s}navLabel/{%s}text" % (NCX_NS, NCX_NS))
+        src = point.find("{%s}content" % NCX_NS).get("src").split("#")[0]
+        name = posixpath.normpath(posixpath.join(base, src))
+        titles.setdefault(name, (text.text or "").strip() if text is not None else "")
+    return titles
+
+
+def inspect_epub(path, budget=None, sources=None):
+    """
+    Return a row (dict) per member of the epub at `path`: name,
+    media_type, kind, compressed and size (bytes), spine (position or
+    None), section (the toc title of a chapter) and over_budget (size is
+    over `budget` bytes).  `sources` ({archive name: source}) adds where
+    the builder got each chapter from.
+    """
+    with zipfile.ZipFile(path) as book:
+        opf_name = "OEBPS/content.opf"
+        if "META-INF/container.xml" in book.NameToInfo:
+            container = etree.fromstring(book.read("META-INF/container.xml"))
+            rootfile = container.find(
+                "{%s}rootfiles/{%s}rootfile" % (CONTAINER_NS, CONTAINER_NS)
+            )
+            if rootfile is not None:
+                opf_name = rootfile.get("full-path")
+        opf = etree.fromstring(book.read(opf_name))
+        base = posixpath.dirname(opf_name)
+        manifest = []  # (id, archive name, media type)
+        for item in opf.findall("{%s}manifest/{%s}item" % (OPF_NS, OPF_NS)):
+            name = posixpath.normpath(posixpath.join(base, item.get("href")))
+            manifest.append((item.get("id"), name, item.get("media-type")))
+        spine = opf.find("{%s}spine" % OPF_NS)
+        ncx_name = None
+        idrefs = []
+        if spine is not None:
+            idrefs = [ref.get("idref") for ref in spine.findall("{%s}itemref" % OPF_NS)]
+            ncx_id = spine.get("toc")
+            ncx_name = next((name for id_, name, _ in manifest if id_ == ncx_id), None)
+        titles = _titles(book, ncx_name) if ncx_name else {}
+        by_id = dict((id_, (name, media_type)) for id_, name, media_type in manifest)
+        ordered = [by_id[idref] for idref in idrefs if idref in by_id]
+        in_spine = set(name for name, _ in ordered)
+        for _, name, media_type in manifest:
+            if name not in in_spine:
+                ordered.append((name, media_type))
+        listed = set(name for name, _ in ordered)
+        # mimetype, container.xml, content.opf
+        for info in book.infolist():
+            if info.filename not in listed:
+                ordered.append((info.filename, None))
+        rows = []
+        for position, (name, media_type) in enumerate(ordered):
+            info = book.NameToInfo.get(name)
+            if info is None:
+                continue
+            size = info.file_size
+            rows.append(
+                {
+                    "name": name,
+                    "media_type": media_type,
+                    "kind": kind_of(media_type),
+                    "compressed": info.compress_size,
+                    "size": size,
+                    "spine": position if name in in_spine else None,
+                    "section": titles.get(name),
+                    "source": (sources or {}).get(name),
+                    "over_budget": bool(budget) and size > budget,
+                }
+            )
+    return rows
+
+
+ROW = "{0:>10} {1:>10}  {2:<10} {3}"
+
+
+def format_report(rows):
+    """
+    the rows as a text table with totals per kind
+    """
+    lines = [ROW.format("compressed", "size", "kind", "member")]
+    totals = {}
+    for row in rows:
+        section = row["section"] or ""
+        if row["source"]:
+            section = "{0} ({1})".format(section, row["source"]).strip()
+        name = row["name"]
+        if section:
+            name += "  " + section
+        if row["over_budget"]:
+            name += "  OVER BUDGET"
+        lines.append(ROW.format(row["compressed"], row["size"], row["kind"], name))
+        total = totals.setdefault(row["kind"], [0, 0, 0])
+        total[0] += row["compressed"]
+        total[1] += row["size"]
+        total[2] += 1
+    lines.append("")
+    for kind in sorted(totals):
+        compressed, size, count = totals[kind]
+        lines.append(ROW.format(compressed, size, kind, "{0} members".format(count)))
+    compressed = sum(row["compressed"] for row in rows)
+    size = sum(row["size"] for row in rows)
+    lines.append(ROW.format(compressed, size, "total", "{0} members".format(len(rows))))
+    over = [row["name"] for row in rows if row["over_budget"]]
+    if over:
+        lines.append("{0} over budget: {1}".format(len(over), ", ".join(over)))
+    return "\n".join(lines)
+
+
+def write_report(path, rows):
+    """
+    write the rows to `path` as json if it ends in .json, else as text
+    """
+    if path.endswith(".json"):
+        data = json.dumps(rows, indent=2)
+    else:
+        data = format_report(rows)
+    with open(path, "w") as fout:
+        fout.write(data + "\n")
+
+
+def main(args):
+    parser = argparse.ArgumentParser(
+        prog="rst2epub inspect",
+        description="size of every member of an epub, in spine and manifest order",
+    )
+    parser.add_argument("epubs", nargs="+", metavar="EPUB")
+    parser.add_argument(
+        "--budget", type=int, help="flag members bigger than this many KB"
+    )
+    parser.add_argument("--json", action="store_true", help="print json")
+    opts = parser.parse_args(args)
+    budget = opts.budget * 1024 if opts.budget else None
+    over = False
+    for path in opts.epubs:
+        rows = inspect_epub(path, budget)
+        over = over or any(row["over_budget"] for row in rows)
+        if opts.json:
+            print(json.dumps({"epub": path, "members": rows}))
+        else:
+            print(path)
+            print(format_report(rows))
+    # non zero so a build script can fail on it
+    return 1 if over else 0
@@ -0,0 +1,483 @@
+"""
+Parse a large rst document in several processes, one piece per top
+level section, see parse().  Used by rst2epub's ``--parallel-parse``.
+
+Each piece is parsed the way it would be in the whole document: the
+title styles seen so far are seeded, the piece is parsed below empty
+sections standing in for its parent sections and ``.. role::``
+definitions from earlier pieces are parsed first.  The calls a piece
+makes on its document's registries (ids, names, footnotes,
+substitutions, pending transforms, ...) are recorded and replayed in
+order on the real document, so ids, duplicate names and their messages
+come out as in a serial parse, and transforms then see the same tree.
+When a piece doesn't parse the way the split assumed, parse() returns
+False and the caller parses serially.
+"""
+import itertools
+import re
+
+from docutils import frontend, nodes, statemachine, utils
+from docutils.parsers.rst import roles, states
+
+from epublib import util
+
+PUNCTUATION_RE = re.compile(r"[!-/:-@[-`{-~]")
+ADORNMENT_RE = re.compile(r"([!-/:-@[-`{-~])\1* *$")
+# text lines that start some other body element, not a title
+NOT_TITLE_RE = re.compile(
+    u"([-+*•‣⁃]( |$)|\\.\\.( |$)|:|\\||>>>|\\+[-=+]|[-+/]\\w)"
+)
+ROLE_RE = re.compile(r"( *)\.\. +(default-)?role::")
+# registry methods of nodes.document that are not replayed
+NOT_RECORDED = ("note_source", "note_parse_message", "note_transform_message")
+# node attributes the registry methods change
+TRACKED = ("ids", "names", "dupnames")
+# settings that don't go to the workers: dependencies are sent back,
+# warnings go to stderr (a --warnings file would be truncated by each)
+LOCAL_SETTINGS = ("record_dependencies", "warning_stream")
+
+
+def find_titles(lines):
+    """
+    (line index, title style) of the section titles starting in column
+    0.  Style is the underline character, or a pair for over and
+    underlined titles, as in the rst parser's memo.  A title missed here
+    only means fewer pieces, parse() checks the ones that are found.
+    """
+    titles = []
+    blank = True
+    literal_next = False
+    quoted = False
+    i = 0
+    while i < len(lines):
+        line = lines[i]
+        if not line.strip():
+            blank = True
+            quoted = False
+            i += 1
+            continue
+        if blank and literal_next and PUNCTUATION_RE.match(line):
+            # quoted literal block, up to the next blank line
+            quoted = True
+        literal_next = (
+            not line[0].isspace()
+            and not line.startswith("..")
+            and line.rstrip().endswith("::")
+        )
+        if quoted or not blank or line[0].isspace():
+            blank = False
+            i += 1
+            continue
+        blank = False
+        rest = lines[i + 1 : i + 3]
+        if ADORNMENT_RE.match(line):
+            if len(rest) == 2 and rest[0].strip() and rest[1].rstrip() == line.rstrip():
+                titles.append((i, (line[0], line[0])))
+                blank = True
+                i += 3
+                continue
+        elif rest and ADORNMENT_RE.match(rest[0]) and not NOT_TITLE_RE.match(line):
+            underline = rest[0].rstrip()
+            if len(underline) >= 4 or len(underline) >= utils.column_width(
+                line.rstrip()
+            ):
+                titles.append((i, underline[0]))
+                blank = True
+                i += 2
+                continue
+        i += 1
+    return titles
+
+
+def plan_pieces(lines):
+    """
+    Return (level, styles, starts): the piece boundaries are the titles
+    of section `level`, the first level with two or more titles and
+    nothing above it after its first one.  `styles` are the title styles
+    in order of first use, with the line each is first used on.  None
+    if the document doesn't split.
+    """
+    titles = find_titles(lines)
+    styles = []
+    for index, style in titles:
+        if style not in [s for s, _ in styles]:
+            styles.append((style, index))
+    order = [s for s, _ in styles]
+    levels = [order.index(style) + 1 for _, style in titles]
+    for level in range(1, len(styles) + 1):
+        at = [n for n, title_level in enumerate(levels) if title_level == level]
+        if len(at) >= 2 and min(levels[at[0] :]) >= level:
+            starts = [titles[n][0] for n in at]
+            return level, styles, starts
+    return None
+
+
+def role_blocks(lines):
+    """
+    (line index, lines) of the ``.. role::`` and ``.. default-role::``
+    directives, None if one is indented (inside another directive)
+    """
+    blocks = []
+    for i, line in enumerate(lines):
+        match = ROLE_RE.match(line)
+        if not match:
+            continue
+        if match.group(1):
+            return None
+        end = i + 1
+        while end < len(lines) and (not lines[end].strip() or lines[end][0].isspace()):
+            end += 1
+        blocks.append((i, lines[i:end]))
+    return blocks
+
+
+class Parent(object):
+    """
+    stands for the document (0) or the section at `level` that a piece
+    is parsed into
+    """
+
+    def __init__(self, level):
+        self.level = level
+
+
+class Call(object):
+    def __init__(self, name, args, kwargs):
+        self.name = name
+        self.args = args
+        self.kwargs = kwargs
+        # (node, children before the call, children the call added)
+        self.appended = []
+
+
+class Recorder(object):
+    """
+    Wrap the registry methods of `document` and record the calls the
+    parser makes on them (not the calls they make themselves).  Their
+    messages aren't printed here, the replay prints them.
+    """
+
+    def __init__(self, document):
+        self.document = document
+        self.calls = []
+        self.initial = []  # (node, TRACKED attributes before its first call)
+        self.seen = set()
+        self.depth = 0
+        for name in dir(document):
+            if (name.startswith("note_") and name not in NOT_RECORDED) or (
+                name == "set_id"
+            ):
+                setattr(document, name, self.wrap(name, getattr(document, name)))
+
+    def wrap(self, name, method):
+        def record(*args, **kwargs):
+            if self.depth:
+                return method(*args, **kwargs)
+            elements = []
+            for arg in itertools.chain(args, kwargs.values()):
+                if isinstance(arg, nodes.Element) and id(arg) not in [
+                    id(node) for node in elements
+                ]:
+                    elements.append(arg)
+            for node in elements:
+                if id(node) not in self.seen:
+                    self.seen.add(id(node))
+                    self.initial.append((node, snapshot(node)))
+            sizes = [(node, len(node.children)) for node in elements]
+            reporter = self.document.reporter
+            stream, reporter.stream = reporter.stream, None
+            self.depth += 1
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self.depth -= 1
+                reporter.stream = stream
+                call = Call(name, args, kwargs)
+                call.appended = [
+                    (node, size, len(node.children) - size) for node, size in sizes
+                ]
+                self.calls.append(call)
+
+        return record
+
+    def remove_messages(self):
+        """
+        take the messages the recorded calls added out of the tree,
+        return their ids
+        """
+        removed = set()
+        for call in reversed(self.calls):
+            for node, size, count in call.appended:
+                for message in node.children[size : size + count]:
+                    removed.add(id(message))
+                del node.children[size : size + count]
+        return removed
+
+
+def snapshot(node):
+    return dict((key, list(node[key])) for key in TRACKED)
+
+
+class PieceStateMachine(states.RSTStateMachine):
+    """
+    parse a piece of a document below `level` empty sections, with the
+    title styles `title_styles` already known
+    """
+
+    def __init__(self, title_styles, level, **kwargs):
+        states.RSTStateMachine.__init__(self, **kwargs)
+        self.seed_styles = title_styles
+        self.level = level
+        self.parents = []
+
+    def runtime_init(self):
+        # run() has made the memo, parsing hasn't started
+        self.title_styles = self.memo.title_styles
+        self.title_styles[:] = self.seed_styles
+        self.memo.section_level = self.level  # docutils < 0.22
+        for _ in range(self.level):
+            section = nodes.section()
+            self.node += section
+            self.node = section
+            self.parents.append(section)
+        states.RSTStateMachine.runtime_init(self)
+
+
+def run_lines(parser, document, lines, start, title_styles=(), level=0):
+    machine = PieceStateMachine(
+        list(title_styles),
+        level,
+        state_classes=parser.state_classes,
+        initial_state=parser.initial_state,
+        debug=document.reporter.debug_flag,
+    )
+    source = document["source"]
+    input_lines = statemachine.StringList(
+        lines, source, items=[(source, start + n) for n in range(len(lines))]
+    )
+    machine.run(input_lines, document, input_offset=start, inliner=parser.inliner)
+    return machine
+
+
+class Piece(object):
+    """
+    what a worker sends back: the parsed nodes and the recorded calls
+    """
+
+    ok = True
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+def parse_piece(parser_class, source_path, settings, lines, start, styles, level, roles_lines):
+    """
+    worker: parse `lines` (starting at line `start` of the document) and
+    return a Piece
+    """
+    settings = frontend.Values(settings)
+    settings.record_dependencies = utils.DependencyList()
+    settings.warning_stream = None
+    saved_roles = dict(roles._roles)
+    try:
+        parser = parser_class()
+        if roles_lines:
+            run_lines(parser, utils.new_document(source_path, settings), roles_lines, 0)
+        document = utils.new_document(source_path, settings)
+        recorder = Recorder(document)
+        parser.setup_parse("\n".join(lines), document)
+        machine = run_lines(parser, document, lines, start, styles, level)
+        parser.finish_parse()
+    finally:
+        # role definitions are global, pieces parsed later in this
+        # process mustn't see them
+        roles._roles.clear()
+        roles._roles.update(saved_roles)
+    top = machine.parents[-1] if machine.parents else document
+    chain = [document] + machine.parents
+    ok = (
+        document.decoration is None
+        and len(document.transformer.transforms)
+        == len([call for call in recorder.calls if call.name == "note_pending"])
+        and all(parent.children == [child] for parent, child in zip(chain, chain[1:]))
+        and (not level or all(isinstance(n, nodes.section) for n in top.children))
+    )
+    if not ok:
+        return Piece(ok=False)
+    removed = recorder.remove_messages()
+    placeholders = dict((id(node), Parent(n)) for n, node in enumerate(chain))
+
+    def strip(value):
+        return placeholders.get(id(value), value)
+
+    for call in recorder.calls:
+        call.args = tuple(strip(arg) for arg in call.args)
+        call.kwargs = dict((k, strip(v)) for k, v in call.kwargs.items())
+        call.appended = [(strip(node), size, count) for node, size, count in call.appended]
+    children = list(top.children)
+    for child in children:
+        child.parent = None
+    # newer docutils keep the document on each node, it stays here
+    roots = children + list(document.parse_messages)
+    for call in recorder.calls:
+        roots.extend(a for a in call.args if isinstance(a, nodes.Node))
+        roots.extend(a for a in call.kwargs.values() if isinstance(a, nodes.Node))
+    for root in roots:
+        for node in walk(root):
+            if "_document" in node.__dict__:
+                node._document = None
+    return Piece(
+        children=children,
+        calls=recorder.calls,
+        initial=[(n, a) for n, a in recorder.initial if id(n) not in placeholders],
+        messages=[m for m in document.parse_messages if id(m) not in removed],
+        dependencies=list(settings.record_dependencies.list),
+        title_styles=list(machine.title_styles),
+        attributes=dict(
+            (key, value)
+            for key, value in document.attributes.items()
+            if key not in nodes.Element.basic_attributes + ("source",)
+        ),
+    )
+
+
+def walk(node, condition=None):
+    findall = getattr(node, "findall", None) or node.traverse
+    return findall(condition)
+
+
+def merge(document, piece, parents):
+    """
+    add `piece` below parents[-1] (`parents` starts with the document)
+    and replay its registry calls on `document`
+    """
+    target = parents[-1]
+    base = len(target.children)
+    target.extend(piece.children)
+    document.parse_messages.extend(piece.messages)
+    document.settings.record_dependencies.add(*piece.dependencies)
+    document.attributes.update(piece.attributes)
+    refs = [
+        node
+        for child in piece.children
+        for node in walk(child, nodes.Element)
+        if node.get("refid") or node.get("backrefs")
+    ]
+    final = []
+    for node, attributes in piece.initial:
+        final.append(snapshot(node))
+        for key, value in attributes.items():
+            node[key] = value
+
+    def resolve(value):
+        if isinstance(value, Parent):
+            return parents[value.level]
+        return value
+
+    offsets = {}
+    for call in piece.calls:
+        appended = [(resolve(node), size, count) for node, size, count in call.appended]
+        before = [len(node.children) for node, _, _ in appended]
+        getattr(document, call.name)(
+            *[resolve(arg) for arg in call.args],
+            **dict((k, resolve(v)) for k, v in call.kwargs.items())
+        )
+        for (node, size, count), now in zip(appended, before):
+            added = node.children[now:]
+            if not added and not count:
+                continue
+            offset = offsets.get(id(node), 0)
+            offsets[id(node)] = offset + len(added) - count
+            if any(node is parent for parent in parents[:-1]):
+                continue  # ancestor of the piece, leave it at the end
+            del node.children[now:]
+            position = size + offset + (base if node is target else 0)
+            for n, message in enumerate(added):
+                node.insert(position + n, message)
+    id_map = {}
+    for (node, _), old in zip(piece.initial, final):
+        for old_id, new_id in zip(old["ids"], node["ids"]):
+            id_map[old_id] = new_id
+    for node in refs:
+        if node.get("refid"):
+            node["refid"] = id_map.get(node["refid"], node["refid"])
+        if node.get("backrefs"):
+            node["backrefs"] = [id_map.get(ref, ref) for ref in node["backrefs"]]
+
+
+def open_sections(children, depth):
+    """
+    the innermost open sections of a tree with top level `children`,
+    `depth` of them, None if there aren't that many
+    """
+    sections = []
+    for _ in range(depth):
+        found = [node for node in children if isinstance(node, nodes.section)]
+        if not found or found[-1] is not children[-1]:
+            return None
+        sections.append(found[-1])
+        children = found[-1].children
+    return sections
+
+
+def parse(parser, inputstring, document, processes=None):
+    """
+    Parse `inputstring` into `document` like ``parser.parse`` does, in
+    `processes` worker processes.  Return False, with `document`
+    untouched, if the document doesn't split into pieces or a piece
+    didn't parse as expected; the caller should then parse serially.
+    """
+    settings = document.settings
+    lines = statemachine.string2lines(
+        inputstring, tab_width=settings.tab_width, convert_whitespace=True
+    )
+    limit = getattr(settings, "line_length_limit", 10000)
+    if any(len(line) > limit for line in lines):
+        return False
+    plan = plan_pieces(lines)
+    blocks = role_blocks(lines)
+    if plan is None or blocks is None:
+        return False
+    level, styles, starts = plan
+    bounds = [0] + starts + [len(lines)]
+    worker_settings = dict(
+        (key, value)
+        for key, value in vars(settings).items()
+        if key not in LOCAL_SETTINGS
+    )
+    jobs = []
+    expected = []
+    for n, (start, end) in enumerate(zip(bounds, bounds[1:])):
+        seed = [style for style, first in styles if first < start]
+        roles_lines = []
+        for index, block in blocks:
+            if index < start:
+                roles_lines.extend(block + [""])
+        jobs.append(
+            (
+                type(parser),
+                document["source"],
+                worker_settings,
+                lines[start:end],
+                start,
+                seed,
+                level - 1 if n else 0,
+                roles_lines,
+            )
+        )
+        expected.append([style for style, first in styles if first < end])
+    pieces = util.process_map(parse_piece, jobs, processes, chunksize=1)
+    if not all(
+        piece.ok and piece.title_styles == styles_
+        for piece, styles_ in zip(pieces, expected)
+    ):
+        return False
+    sections = open_sections(pieces[0].children, level - 1)
+    if sections is None:
+        return False
+    parser.setup_parse(inputstring, document)
+    merge(document, pieces[0], [document])
+    for piece in pieces[1:]:
+        merge(document, piece, [document] + sections)
+    parser.finish_parse()
+    return True
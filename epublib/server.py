@@ -0,0 +1,366 @@
+"""
+Local conversion server, run with ``rst2epub serve``.
+
+POST rst text to ``/convert`` and get the epub back.  Conversions run
+in a pool of worker processes that have rst2epub imported and the
+templates loaded before the first request arrives.  The server keeps a
+bounded number of requests waiting for a worker (503 when full), kills
+and replaces a worker whose job runs past the timeout (504) or that
+doesn't start in time, and can cap the memory of each worker.
+``GET /metrics`` returns queue depth, job counts and latencies as json.
+
+Uploads are always treated as rst text, never as a path, and are
+converted with file insertion (include, raw :file:) disabled and
+``restrict_paths`` on, so a document can't pull files from the server
+into its epub.  Each worker gets its own empty base directory.  The
+server listens on 127.0.0.1 or a unix socket only.
+
+The conversion function is passed in (``rst2epub serve`` passes
+``rst2epub.build``), it is called as ``build(text, base_dir=...,
+options=...)`` in the workers and must be importable there.
+"""
+from __future__ import print_function
+
+import argparse
+import collections
+import json
+import multiprocessing
+import os
+import queue
+import shutil
+import signal
+import socketserver
+import sys
+import tempfile
+import threading
+import time
+import traceback
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+# settings that can be switched on with ?name=1 on /convert
+OPTION_FLAGS = ("prune_css", "minify", "subset_fonts")
+
+
+class QueueFull(Exception):
+    pass
+
+
+class JobTimeout(Exception):
+    pass
+
+
+class JobFailed(Exception):
+    pass
+
+
+class WorkerDead(Exception):
+    pass
+
+
+def warm_up():
+    """
+    load and compile the templates so the first job doesn't pay for it
+    """
+    from epublib import epub
+
+    book = epub.EpubBook()
+    templates = os.path.join(os.path.dirname(epub.__file__), "templates")
+    for name in os.listdir(templates):
+        if name.endswith((".html", ".ncx", ".opf", ".xml")):
+            book.loader.load(name)
+
+
+def worker_main(conn, build, base_dir, memory_limit=None):
+    """
+    worker process loop: receive (text, options), send back
+    ("ok", epub bytes) or ("error", message)
+    """
+    if memory_limit:
+        import resource
+
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+    # the build is chatty, keep it out of the server's output
+    sys.stdout = open(os.devnull, "w")
+    warm_up()
+    conn.send(("ready", None))
+    while True:
+        try:
+            text, options = conn.recv()
+        except EOFError:
+            break
+        try:
+            data = build(text, base_dir=base_dir, options=options)
+            conn.send(("ok", data))
+        except MemoryError:
+            conn.send(("error", "memory limit exceeded"))
+        except Exception:
+            conn.send(("error", traceback.format_exc()))
+
+
+class Worker(object):
+    context = multiprocessing.get_context("spawn")
+
+    def __init__(self, build, memory_limit=None, start_timeout=60):
+        self.start_timeout = start_timeout
+        # made and removed here, the process may be killed
+        self.base_dir = tempfile.mkdtemp(prefix="rst2epub-serve-")
+        self.conn, child_conn = self.context.Pipe()
+        self.process = self.context.Process(
+            target=worker_main, args=(child_conn, build, self.base_dir, memory_limit)
+        )
+        self.process.daemon = True
+        self.process.start()
+        child_conn.close()
+        self.ready = False
+
+    def run(self, text, options, timeout):
+        if not self.ready:
+            # start up and warm up don't count against the job's timeout,
+            # but have their own so a worker stuck starting is replaced
+            if not self.conn.poll(self.start_timeout):
+                raise WorkerDead("worker didn't start")
+            self.conn.recv()
+            self.ready = True
+        self.conn.send((text, options))
+        if not self.conn.poll(timeout):
+            raise JobTimeout()
+        status, payload = self.conn.recv()
+        if status != "ok":
+            raise JobFailed(payload)
+        return payload
+
+    def kill(self):
+        self.process.terminate()
+        self.process.join(5)
+        self.conn.close()
+        shutil.rmtree(self.base_dir, ignore_errors=True)
+
+
+class Metrics(object):
+    def __init__(self, keep=1000):
+        self.lock = threading.Lock()
+        self.queued = 0
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.latencies = collections.deque(maxlen=keep)  # seconds
+
+    def as_dict(self):
+        with self.lock:
+            latencies = sorted(self.latencies)
+            data = dict(
+                queue_depth=self.queued,
+                running=self.running,
+                completed=self.completed,
+                failed=self.failed,
+                rejected=self.rejected,
+                timeouts=self.timeouts,
+            )
+        if latencies:
+            data["latency"] = dict(
+                count=len(latencies),
+                mean=sum(latencies) / len(latencies),
+                p50=latencies[len(latencies) // 2],
+                p95=latencies[int(len(latencies) * 0.95)],
+                max=latencies[-1],
+            )
+        return data
+
+
+class WorkerPool(object):
+    """
+    `workers` warm processes with at most `queue_size` further requests
+    waiting for one of them
+    """
+
+    def __init__(
+        self,
+        build,
+        workers=2,
+        queue_size=8,
+        timeout=60,
+        memory_limit=None,
+        start_timeout=60,
+    ):
+        self.build = build
+        self.timeout = timeout
+        self.memory_limit = memory_limit
+        self.start_timeout = start_timeout
+        self.idle = queue.Queue()
+        for _ in range(workers):
+            self.idle.put(self.new_worker())
+        self.slots = threading.BoundedSemaphore(workers + queue_size)
+        self.metrics = Metrics()
+
+    def convert(self, text, options=None):
+        metrics = self.metrics
+        if not self.slots.acquire(False):
+            with metrics.lock:
+                metrics.rejected += 1
+            raise QueueFull()
+        start = time.time()
+        try:
+            with metrics.lock:
+                metrics.queued += 1
+            worker = self.idle.get()
+            with metrics.lock:
+                metrics.queued -= 1
+                metrics.running += 1
+            try:
+                data = worker.run(text, options, self.timeout)
+            except JobTimeout:
+                with metrics.lock:
+                    metrics.timeouts += 1
+                worker.kill()
+                worker = self.new_worker()
+                raise
+            except JobFailed:
+                with metrics.lock:
+                    metrics.failed += 1
+                raise
+            except (EOFError, OSError, WorkerDead) as e:
+                # worker died (eg killed for memory) or never started,
+                # replace it
+                with metrics.lock:
+                    metrics.failed += 1
+                worker.kill()
+                worker = self.new_worker()
+                raise JobFailed(str(e) or "worker died")
+            finally:
+                self.idle.put(worker)
+                with metrics.lock:
+                    metrics.running -= 1
+            with metrics.lock:
+                metrics.completed += 1
+                metrics.latencies.append(time.time() - start)
+            return data
+        finally:
+            self.slots.release()
+
+    def new_worker(self):
+        return Worker(self.build, self.memory_limit, self.start_timeout)
+
+    def close(self):
+        while not self.idle.empty():
+            self.idle.get().kill()
+
+
+class Handler(BaseHTTPRequestHandler):
+    max_upload = 50 * 1024 * 1024
+
+    def address_string(self):
+        # client_address is "" on a unix socket
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+        return "unix"
+
+    def send_data(self, code, data, content_type="text/plain; charset=utf-8"):
+        if not isinstance(data, bytes):
+            data = data.encode("utf8")
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == "/metrics":
+            self.send_data(
+                200, json.dumps(self.server.pool.metrics.as_dict()), "application/json"
+            )
+        elif self.path == "/health":
+            self.send_data(200, "ok\n")
+        else:
+            self.send_data(404, "not found\n")
+
+    def do_POST(self):
+        path, _, query = self.path.partition("?")
+        if path != "/convert":
+            return self.send_data(404, "not found\n")
+        length = self.headers.get("Content-Length")
+        if length is None:
+            return self.send_data(411, "Content-Length required\n")
+        try:
+            length = int(length)
+        except ValueError:
+            length = -1
+        if length < 0:
+            return self.send_data(400, "bad Content-Length\n")
+        if length > self.max_upload:
+            return self.send_data(413, "too large\n")
+        try:
+            text = self.rfile.read(length).decode("utf-8-sig")
+        except UnicodeDecodeError:
+            return self.send_data(400, "body is not utf-8\n")
+        options = {"file_insertion_enabled": False, "restrict_paths": True}
+        for pair in query.split("&"):
+            name, _, value = pair.partition("=")
+            if name in OPTION_FLAGS:
+                options[name] = value not in ("", "0", "false")
+        try:
+            data = self.server.pool.convert(text, options)
+        except QueueFull:
+            return self.send_data(503, "queue full\n")
+        except JobTimeout:
+            return self.send_data(504, "conversion timed out\n")
+        except JobFailed as e:
+            return self.send_data(422, "conversion failed\n{0}\n".format(e))
+        self.send_data(200, data, "application/epub+zip")
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def make_server(pool, host="127.0.0.1", port=8642, socket_path=None):
+    if socket_path:
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        server = ThreadingUnixHTTPServer(socket_path, Handler)
+    else:
+        server = ThreadingHTTPServer((host, port), Handler)
+    server.pool = pool
+    return server
+
+
+def main(args, build):
+    parser = argparse.ArgumentParser(
+        prog="rst2epub serve", description="local rst to epub conversion server"
+    )
+    parser.add_argument("--port", type=int, default=8642)
+    parser.add_argument("--socket", help="listen on this unix socket instead")
+    parser.add_argument("--workers", type=int, default=multiprocessing.cpu_count())
+    parser.add_argument(
+        "--queue", type=int, default=8, help="requests that may wait for a worker"
+    )
+    parser.add_argument("--timeout", type=float, default=60, help="seconds per job")
+    parser.add_argument("--memory-limit", type=int, help="MB of memory per worker")
+    parser.add_argument(
+        "--start-timeout",
+        type=float,
+        default=60,
+        help="seconds a worker may take to start before it is replaced",
+    )
+    opts = parser.parse_args(args)
+    memory_limit = opts.memory_limit * 1024 * 1024 if opts.memory_limit else None
+    pool = WorkerPool(
+        build, opts.workers, opts.queue, opts.timeout, memory_limit, opts.start_timeout
+    )
+    server = make_server(pool, port=opts.port, socket_path=opts.socket)
+    print("SERVING", opts.socket or "http://127.0.0.1:{0}".format(opts.port))
+    # stop cleanly (workers and their directories removed) on kill too
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        pool.close()
@@ -0,0 +1,84 @@
+"""
+Small helpers shared by the optional build steps (panel detection,
+zoom crops, font subsetting, caches).
+"""
+import hashlib
+import multiprocessing
+import os
+import tempfile
+
+# the on-disk caches (crops, fonts, ...) go under this directory when it
+# is set, rather than in the shared temp dir
+CACHE_ENV = "EPUBLIB_CACHE_DIR"
+
+
+def cache_dir(name, root=None):
+    """
+    the directory of the `name` cache, under `root`, $EPUBLIB_CACHE_DIR
+    or the temp dir
+    """
+    root = root or os.environ.get(CACHE_ENV) or tempfile.gettempdir()
+    return os.path.join(root, name)
+
+
+def makedirs(path):
+    """
+    create `path` and its parents, it is fine if it already exists
+    """
+    try:
+        os.makedirs(path)
+    except OSError:
+        if not os.path.isdir(path):
+            raise
+
+
+def file_hash(path):
+    """
+    hex sha1 of the contents of `path`, read in chunks
+    """
+    digest = hashlib.sha1()
+    with open(path, "rb") as fin:
+        for chunk in iter(lambda: fin.read(1 << 16), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def save_atomically(path, save):
+    """
+    call ``save(tmp_path)`` and move the result to `path`.  The
+    temporary file is in the same directory and has the same extension
+    (some writers pick the format from it), and the rename means
+    concurrent builds sharing a cache never see a half written file.
+    """
+    directory, name = os.path.split(path)
+    fd, tmp_path = tempfile.mkstemp(
+        prefix=name + ".", suffix=os.path.splitext(name)[1], dir=directory
+    )
+    os.close(fd)
+    try:
+        save(tmp_path)
+        os.rename(tmp_path, path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+
+
+def _call(job):
+    func, args = job
+    return func(*args)
+
+
+def process_map(func, arg_tuples, processes=None, chunksize=None):
+    """
+    ``[func(*args) for args in arg_tuples]`` in a process pool, results
+    are in the same order.  `func` must be a module level function.
+    """
+    # imported here so importing epublib doesn't need concurrent.futures
+    from concurrent.futures import ProcessPoolExecutor
+
+    jobs = [(func, args) for args in arg_tuples]
+    processes = processes or multiprocessing.cpu_count()
+    if chunksize is None:
+        chunksize = max(1, len(jobs) // (4 * processes))
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        return list(pool.map(_call, jobs, chunksize=chunksize))
@@ -0,0 +1,126 @@
+"""
+Build workspaces: a private directory per build for the unzipped book
+and the archive, so concurrent builds never share files.
+
+    with Workspace(root="/dev/shm", quota=500 * 1024 * 1024) as workspace:
+        book.on_write = workspace.add_file
+        book.create_book(os.path.join(workspace.path, "epub"))
+        workspace.check()
+
+The directory is removed when the build succeeds.  When it fails it is
+kept for debugging (marked with a ``.failed`` file and printed), but
+only the newest `keep_failed` failed workspaces are kept so they can't
+fill the disk.
+
+The quota is enforced while the build writes: add_file() counts each
+file as it is written and check_writing() the part of a file (the
+archive) written so far, either raises QuotaExceeded as soon as the
+total is over `quota` bytes.  check() walks the whole directory, for
+files written without telling the workspace.  A workspace over its
+quota is always removed.
+"""
+from __future__ import print_function
+
+import os
+import shutil
+import tempfile
+import traceback
+
+from epublib import util
+
+# where workspaces are made when no root is given (else the temp dir)
+ROOT_ENV = "EPUBLIB_WORKSPACE_ROOT"
+FAILED = ".failed"
+
+
+class QuotaExceeded(Exception):
+    pass
+
+
+def tree_size(path):
+    """
+    bytes in the files under `path`
+    """
+    size = 0
+    for dir_path, dir_names, file_names in os.walk(path):
+        for name in file_names:
+            try:
+                size += os.lstat(os.path.join(dir_path, name)).st_size
+            except OSError:
+                pass
+    return size
+
+
+class Workspace(object):
+    def __init__(self, root=None, prefix="rst2epub-", quota=None, keep_failed=3):
+        self.root = root or os.environ.get(ROOT_ENV) or None
+        self.prefix = prefix
+        self.quota = quota
+        self.keep_failed = keep_failed
+        self.path = None
+        self.used = 0  # bytes of the files counted by add_file()
+
+    def __enter__(self):
+        if self.root:
+            util.makedirs(self.root)
+        self.path = tempfile.mkdtemp(prefix=self.prefix, dir=self.root)
+        return self
+
+    def _check_size(self, size):
+        if self.quota and size > self.quota:
+            raise QuotaExceeded(
+                "workspace {0} holds {1} bytes, the quota is {2}".format(
+                    self.path, size, self.quota
+                )
+            )
+
+    def add_file(self, path):
+        """
+        count the file `path` just written to the workspace, raise
+        QuotaExceeded if the files counted are over the quota
+        """
+        self.used += os.path.getsize(path)
+        self._check_size(self.used)
+
+    def check_writing(self, size):
+        """
+        raise QuotaExceeded if the files counted plus the `size` bytes
+        written so far of a file in progress are over the quota
+        """
+        self._check_size(self.used + size)
+
+    def check(self):
+        """
+        raise QuotaExceeded if the workspace holds more than the quota
+        """
+        if self.quota:
+            self.used = tree_size(self.path)
+            self._check_size(self.used)
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if (
+            exc_type is None
+            or not self.keep_failed
+            or issubclass(exc_type, QuotaExceeded)
+        ):
+            shutil.rmtree(self.path, ignore_errors=True)
+            return False
+        with open(os.path.join(self.path, FAILED), "w") as fout:
+            fout.write("".join(traceback.format_exception(exc_type, exc_value, tb)))
+        print("KEPT failed build workspace", self.path)
+        self.prune()
+        return False
+
+    def prune(self):
+        """
+        remove all but the newest `keep_failed` failed workspaces
+        """
+        root = os.path.dirname(self.path)
+        failed = []
+        for name in os.listdir(root):
+            marker = os.path.join(root, name, FAILED)
+            if name.startswith(self.prefix) and os.path.exists(marker):
+                failed.append((os.path.getmtime(marker), os.path.join(root, name)))
+        failed.sort()
+        for _, path in failed[: max(0, len(failed) - self.keep_failed)]:
+            shutil.rmtree(path, ignore_errors=True)
@@ -0,0 +1,155 @@
+"""
+content.opf and toc.ncx written straight from the EpubBook, a line at a
+time, instead of through the genshi templates.  The output is the same
+as the bundled templates' (values are escaped with genshi's escape), but
+a book with tens of thousands of items or nav points isn't turned into
+a genshi event stream and held in memory first.  EpubBook falls back to
+the templates when its loader has been pointed at custom ones.
+"""
+from genshi.core import escape
+from genshi.util import striptags
+
+
+try:
+    string_types = basestring
+except NameError:
+    string_types = str
+
+
+def string(value):
+    if not isinstance(value, string_types):
+        value = str(value)
+    return value
+
+
+def text(value):
+    """
+    `value` escaped as element text, None is nothing
+    """
+    if value is None:
+        return ""
+    return escape(string(value), quotes=False)
+
+
+def attrs(*pairs):
+    """
+    ``name="value"`` for each (name, value), each preceded by a space,
+    attributes whose value is None are left out
+    """
+    return "".join(
+        ' {0}="{1}"'.format(name, escape(string(value)))
+        for name, value in pairs
+        if value is not None
+    )
+
+
+def content_opf(book):
+    """
+    the lines of content.opf for `book`
+    """
+    yield '<?xml version="1.0" encoding="utf-8" standalone="no"?>\n'
+    yield (
+        '<opf:package xmlns:opf="http://www.idpf.org/2007/opf" '
+        'xmlns:dc="http://purl.org/dc/elements/1.1/" '
+        'unique-identifier="bookid" version="2.0">\n'
+    )
+    yield "  <opf:metadata>\n"
+    yield '    <dc:identifier id="bookid">urn:uuid:{0}</dc:identifier>\n'.format(
+        text(book.UUID)
+    )
+    yield "    <dc:language>{0}</dc:language>\n".format(text(book.lang))
+    yield "    <dc:title>{0}</dc:title>\n".format(text(book.title))
+    for name, role in book.creators:
+        yield "    <dc:creator{0}>{1}</dc:creator>\n".format(
+            attrs(("opf:role", role)), text(name)
+        )
+    for begin_tag, content, end_tag in book.get_meta_tags():
+        # the tags are markup already
+        yield "    {0}{1}{2}\n".format(begin_tag, text(content), end_tag)
+    if book.cover_image:
+        yield "    <opf:meta{0}/>\n".format(
+            attrs(("name", "cover"), ("content", book.cover_image.id))
+        )
+    yield "  </opf:metadata>\n"
+    yield "  <opf:manifest>\n"
+    yield (
+        '    <opf:item id="ncxtoc" media-type="application/x-dtbncx+xml" '
+        'href="toc.ncx"/>\n'
+    )
+    for item in book.get_all_items():
+        yield "    <opf:item{0}/>\n".format(
+            attrs(
+                ("id", item.id),
+                ("media-type", item.mime_type),
+                ("href", item.dest_path),
+            )
+        )
+    yield "  </opf:manifest>\n"
+    yield '  <opf:spine toc="ncxtoc">\n'
+    for _, item, linear in book.get_spine():
+        yield "    <opf:itemref{0}/>\n".format(
+            attrs(("idref", item.id), ("linear", "yes" if linear else "no"))
+        )
+    yield "  </opf:spine>\n"
+    if book.guide:
+        yield "  <opf:guide>\n"
+        for href, title, type in book.get_guide():
+            yield "    <opf:reference{0}/>\n".format(
+                attrs(("href", href), ("type", type), ("title", title))
+            )
+        yield "  </opf:guide>\n"
+    yield "</opf:package>"
+
+
+def nav_points(node):
+    """
+    the navPoint lines for the children of `node`, depth first without
+    recursion (toc trees can be deep)
+    """
+    # children are written at the same indent as their parent, as the
+    # template does
+    stack = [iter(node.children)]
+    while stack:
+        child = next(stack[-1], None)
+        if child is None:
+            stack.pop()
+            if stack:
+                yield "    </navPoint>\n"
+            continue
+        yield "    <navPoint{0}>\n".format(
+            attrs(
+                ("id", "navPoint-{0}".format(child.play_order)),
+                ("playOrder", child.play_order),
+            )
+        )
+        yield "      <navLabel><text>{0}</text></navLabel>\n".format(
+            text(striptags(child.title))
+        )
+        yield "      <content{0}/>\n".format(attrs(("src", child.href)))
+        stack.append(iter(child.children))
+
+
+def toc_ncx(book):
+    """
+    the lines of toc.ncx for `book`, play orders must be assigned
+    """
+    yield '<?xml version="1.0" encoding="UTF-8" standalone="no"?>\n'
+    yield '<ncx xmlns="http://www.daisy.org/z3986/2005/ncx/" version="2005-1">\n'
+    yield "  <head>\n"
+    yield "    <meta{0}/>\n".format(
+        attrs(("name", "dtb:uid"), ("content", "urn:uuid:{0}".format(book.UUID)))
+    )
+    yield "    <meta{0}/>\n".format(
+        attrs(("name", "dtb:depth"), ("content", book.get_toc_map_height()))
+    )
+    yield '    <meta name="dtb:totalPageCount" content="0"/>\n'
+    yield '    <meta name="dtb:maxPageNumber" content="0"/>\n'
+    yield "  </head>\n"
+    yield "  <docTitle>\n"
+    yield "    <text>{0}</text>\n".format(text(striptags(book.title)))
+    yield "  </docTitle>\n"
+    yield "  <navMap>\n"
+    for line in nav_points(book.get_toc_map_root()):
+        yield line
+    yield "  </navMap>\n"
+    yield "</ncx>"
@@ -0,0 +1,247 @@
+"""
+Copying zip members between archives without decompressing and
+recompressing them.  zipfile has no api for that, write_raw() writes the
+local header and the compressed bytes itself and registers the member so
+that close() puts it in the central directory.
+
+Also the compression policies of create_archive and the store of
+compressed members it can share across builds.
+"""
+import os
+import struct
+import tempfile
+import time
+import zipfile
+import zlib
+
+from epublib import util
+
+# local file header: signature ... file name length, extra field length
+LOCAL_HEADER = struct.Struct("<4s2B4HL2L2H")
+# general purpose flag: sizes and crc follow the data instead
+DATA_DESCRIPTOR = 0x08
+
+
+def file_crc(path):
+    """
+    (crc32, size) of the file `path`, read in chunks
+    """
+    crc = 0
+    size = 0
+    with open(path, "rb") as fin:
+        for chunk in iter(lambda: fin.read(1 << 16), b""):
+            crc = zlib.crc32(chunk, crc)
+            size += len(chunk)
+    return crc & 0xFFFFFFFF, size
+
+
+def read_raw(fin, info):
+    """
+    the compressed bytes of member `info` from the archive file `fin`
+    """
+    fin.seek(info.header_offset)
+    header = LOCAL_HEADER.unpack(fin.read(LOCAL_HEADER.size))
+    fin.seek(header[-2] + header[-1], 1)
+    return fin.read(info.compress_size)
+
+
+def write_raw(fout, info, data):
+    """
+    add member `info` (a ZipInfo from another archive) with its
+    compressed bytes `data` to the ZipFile `fout`
+    """
+    zinfo = zipfile.ZipInfo(info.filename, info.date_time)
+    for attr in (
+        "compress_type",
+        "CRC",
+        "compress_size",
+        "file_size",
+        "external_attr",
+        "create_system",
+    ):
+        setattr(zinfo, attr, getattr(info, attr))
+    # the sizes are known, they go in the local header
+    zinfo.flag_bits = info.flag_bits & ~DATA_DESCRIPTOR
+    zinfo.header_offset = fout.fp.tell()
+    fout.fp.write(zinfo.FileHeader())
+    fout.fp.write(data)
+    fout.filelist.append(zinfo)
+    fout.NameToInfo[zinfo.filename] = zinfo
+    fout.start_dir = fout.fp.tell()
+    fout._didModify = True
+    return zinfo
+
+
+class CompressionPolicy(object):
+    """
+    How to compress archive members by media type.  `rules` is a list of
+    (media type, compress_type, level), where the media type may be a
+    prefix ending in "/" (eg "image/"), first match wins; other members
+    get `default`, a (compress_type, level) pair.  A level of None is
+    zlib's default.  A member that would be deflated is stored instead
+    when deflating its first `SAMPLE_SIZE` bytes saves less than
+    `min_gain` (a fraction of their size).
+    """
+
+    SAMPLE_SIZE = 1 << 16
+
+    def __init__(self, rules=(), default=(zipfile.ZIP_DEFLATED, None), min_gain=0):
+        self.rules = list(rules)
+        self.default = default
+        self.min_gain = min_gain
+
+    def lookup(self, media_type):
+        for rule_type, compress_type, level in self.rules:
+            if media_type == rule_type or (
+                rule_type.endswith("/") and (media_type or "").startswith(rule_type)
+            ):
+                return compress_type, level
+        return self.default
+
+    def compression(self, path, media_type=None):
+        """
+        (compress_type, level) for the file `path`
+        """
+        compress_type, level = self.lookup(media_type)
+        if compress_type == zipfile.ZIP_DEFLATED and self.min_gain > 0:
+            with open(path, "rb") as fin:
+                sample = fin.read(self.SAMPLE_SIZE)
+            if sample:
+                zlib_level = -1 if level is None else level
+                deflate = zlib.compressobj(zlib_level, zlib.DEFLATED, -15)
+                size = len(deflate.compress(sample) + deflate.flush())
+                if size > len(sample) * (1 - self.min_gain):
+                    return zipfile.ZIP_STORED, None
+        return compress_type, level
+
+
+# stored by the preview profile, deflate gains little or nothing on them
+ALREADY_COMPRESSED = (
+    "image/jpeg",
+    "image/png",
+    "image/gif",
+    "application/opentype",
+    "application/truetype",
+)
+
+PROFILES = {
+    # what create_archive has always done
+    "default": CompressionPolicy(),
+    # smallest archive: deflate everything at the highest level, store
+    # what that can't shrink by 1%
+    "release": CompressionPolicy(default=(zipfile.ZIP_DEFLATED, 9), min_gain=0.01),
+    # fastest archive: store images and fonts, deflate the rest at the
+    # lowest level unless that saves less than 10%
+    "preview": CompressionPolicy(
+        rules=[(name, zipfile.ZIP_STORED, None) for name in ALREADY_COMPRESSED],
+        default=(zipfile.ZIP_DEFLATED, 1),
+        min_gain=0.1,
+    ),
+}
+
+
+DEFAULT_STORE_DIR = os.path.join(tempfile.gettempdir(), "epublib-members")
+
+
+class MemberStore(object):
+    """
+    Compressed zip members kept on disk, keyed by the sha1 of the
+    content and the compression, so a file shared by many builds or
+    books (stylesheets, fonts, logos) is compressed once.  Each entry
+    holds the crc, the uncompressed size and the compressed bytes.
+    Entries are touched when used and evict() removes the least recently
+    used ones once the store is over `max_size` bytes.
+    """
+
+    HEADER = struct.Struct("<LQ")  # crc32, uncompressed size
+
+    def __init__(self, store_dir=DEFAULT_STORE_DIR, max_size=512 * 1024 * 1024):
+        self.store_dir = store_dir
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+
+    def entry_path(self, digest, compress_type, level):
+        name = "{0}-{1}-{2}.z".format(digest, compress_type, level)
+        return os.path.join(self.store_dir, name)
+
+    def get(self, path):
+        """
+        (crc, file_size, data) stored at `path`, None if it isn't there
+        """
+        try:
+            with open(path, "rb") as fin:
+                crc, file_size = self.HEADER.unpack(fin.read(self.HEADER.size))
+                data = fin.read()
+            os.utime(path, None)
+        except (IOError, OSError, struct.error):
+            # not there, or evicted by a concurrent build
+            return None
+        return crc, file_size, data
+
+    def put(self, path, crc, file_size, data):
+        util.makedirs(self.store_dir)
+
+        def save(tmp_path):
+            with open(tmp_path, "wb") as fout:
+                fout.write(self.HEADER.pack(crc, file_size))
+                fout.write(data)
+
+        util.save_atomically(path, save)
+
+    def write(self, fout, src_path, arcname, compress_type, level=None):
+        """
+        add the file `src_path` to the ZipFile `fout` as `arcname`, with
+        the compressed bytes from the store if they are there
+        """
+        path = self.entry_path(util.file_hash(src_path), compress_type, level)
+        entry = self.get(path)
+        if entry is None:
+            self.misses += 1
+            with open(src_path, "rb") as fin:
+                content = fin.read()
+            data = content
+            if compress_type == zipfile.ZIP_DEFLATED:
+                zlib_level = -1 if level is None else level
+                deflate = zlib.compressobj(zlib_level, zlib.DEFLATED, -15)
+                data = deflate.compress(content) + deflate.flush()
+            entry = (zlib.crc32(content) & 0xFFFFFFFF, len(content), data)
+            self.put(path, *entry)
+        else:
+            self.hits += 1
+        st = os.stat(src_path)
+        info = zipfile.ZipInfo(arcname, time.localtime(st.st_mtime)[:6])
+        info.external_attr = (st.st_mode & 0xFFFF) << 16
+        info.compress_type = compress_type
+        info.CRC, info.file_size, data = entry
+        info.compress_size = len(data)
+        write_raw(fout, info, data)
+
+    def evict(self):
+        """
+        remove the least recently used entries until the store is no
+        bigger than max_size, returns the number removed
+        """
+        if not os.path.isdir(self.store_dir):
+            return 0
+        entries = []
+        total = 0
+        for name in os.listdir(self.store_dir):
+            try:
+                st = os.stat(os.path.join(self.store_dir, name))
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, name))
+            total += st.st_size
+        entries.sort()
+        removed = 0
+        for mtime, size, name in entries:
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(os.path.join(self.store_dir, name))
+            except OSError:
+                pass
+            total -= size
+            removed += 1
+        return removed
@@ -41,21 +41,38 @@ TODO:
 
 """
 from __future__ import print_function
-from contextlib import contextmanager
+import json
 import os
+import re
 import sys
-import tempfile
+import zipfile
 
 import docutils
 
 
-from docutils import io, nodes
-from docutils.core import Publisher, default_description, default_usage
+from docutils import frontend, io, nodes, utils
+from docutils.core import (
+    Publisher,
+    default_description,
+    default_usage,
+    publish_doctree,
+    publish_string,
+)
 from docutils.parsers.rst import Directive, directives
 from docutils.readers import standalone
 from docutils.writers import html4css1
 
-from epublib import epub
+from epublib import (
+    epub,
+    fonts,
+    highlight,
+    mathrender,
+    postprocess,
+    report,
+    util,
+    workspace,
+    ziputil,
+)
 from genshi.util import striptags
 
 try:
@@ -64,62 +81,309 @@ except:
     smartypants = None
 
 
-@contextmanager
-def cwd_cm():
-    cur_dir = os.getcwd()
-    found = False
-    for arg in sys.argv:
-        if arg.endswith(".rst"):
-            found = arg
-            break
-    if found:
-        directory = os.path.dirname(arg)
-        if directory:
-            os.chdir(directory)
-    yield
-    os.chdir(cur_dir)
+ID_RE = re.compile(r"""\sid=["']([^"']+)["']""")
+LOCAL_HREF_RE = re.compile(r"""href=(["'])#([^"']+)\1""")
 
 
-def cwd_decorator(func):
+def validate_targets(
+    setting, value=None, option_parser=None, config_parser=None, config_section=None
+):
     """
-    decorator to change cwd to directory containing rst for this function
+    docutils validator for --target, every value must be NAME:PATH with
+    NAME one of TARGETS
     """
-
-    def wrapper(*args, **kw):
-        cur_dir = os.getcwd()
-        found = False
-        for arg in sys.argv:
-            if arg.endswith(".rst"):
-                found = arg
-                break
-        if found:
-            directory = os.path.dirname(arg)
-            if directory:
-                os.chdir(directory)
-        data = func(*args, **kw)
-        os.chdir(cur_dir)
-        return data
-
-    return wrapper
+    if value is None:
+        value = setting
+    if not isinstance(value, list):
+        # from a config file
+        value = [item.strip() for item in value.split(",") if item.strip()]
+    for target in value:
+        name, _, path = target.partition(":")
+        if name not in TARGETS or not path:
+            raise ValueError(
+                'invalid target "{0}", expected NAME:PATH with NAME one of {1}'.format(
+                    target, ", ".join(sorted(TARGETS))
+                )
+            )
+    return value
 
 
 class EpubWriter(html4css1.Writer):
-    def __init__(self):
+    settings_spec = html4css1.Writer.settings_spec + (
+        "EPUB Writer Options",
+        None,
+        (
+            (
+                "Also write the document as NAME:PATH, where NAME is one of "
+                "the TARGETS (epub, html).  May be given more than once; the "
+                "source is only parsed once for all outputs.",
+                ["--target"],
+                {
+                    "action": "append",
+                    "metavar": "<NAME:PATH>",
+                    "default": [],
+                    "validator": validate_targets,
+                },
+            ),
+            (
+                "Run CMD on each epub once it is written, in the background. "
+                "{epub} in CMD is replaced with the epub path.  May be given "
+                "more than once (eg kindlegen and epubcheck).",
+                ["--post-process"],
+                {"action": "append", "metavar": "<CMD>", "default": []},
+            ),
+            (
+                "Seconds a --post-process command may run before it is "
+                "killed.  Default: 600.",
+                ["--post-process-timeout"],
+                {
+                    "type": "int",
+                    "metavar": "<SECONDS>",
+                    "default": 600,
+                    "validator": frontend.validate_nonnegative_int,
+                },
+            ),
+            (
+                "Subset fonts embedded with the font: comment to the "
+                "characters used in the book.  Needs fontTools.",
+                ["--subset-fonts"],
+                {"action": "store_true", "validator": frontend.validate_boolean},
+            ),
+            (
+                "Keep the build caches (font subsets, highlighting, math) "
+                "under DIR.  Default: $EPUBLIB_CACHE_DIR or the temp dir.",
+                ["--cache-dir"],
+                {"metavar": "<DIR>"},
+            ),
+            (
+                "Drop rules from the bundled and css: stylesheets that match "
+                "no element, class or id in the book.",
+                ["--prune-css"],
+                {"action": "store_true", "validator": frontend.validate_boolean},
+            ),
+            (
+                "Collapse insignificant whitespace and drop comments in the "
+                "generated xhtml (pre blocks are left alone).",
+                ["--minify"],
+                {"action": "store_true", "validator": frontend.validate_boolean},
+            ),
+            (
+                "Refuse images, cover, css:, js:, font: and addimg: paths "
+                "that are absolute or outside the document's directory "
+                "(for untrusted sources, with --no-file-insertion).",
+                ["--restrict-paths"],
+                {"action": "store_true", "validator": frontend.validate_boolean},
+            ),
+            (
+                "Syntax highlight code blocks (and :: blocks with "
+                "--highlight-language) with pygments.  Results are cached "
+                "on disk.",
+                ["--highlight"],
+                {"action": "store_true", "validator": frontend.validate_boolean},
+            ),
+            (
+                "Pygments style for --highlight.  Default: default.",
+                ["--highlight-style"],
+                {"metavar": "<STYLE>", "default": "default"},
+            ),
+            (
+                "Language of :: literal blocks for --highlight.  "
+                "Default: none (not highlighted).",
+                ["--highlight-language"],
+                {"metavar": "<LANGUAGE>"},
+            ),
+            (
+                "Render math as MathML with a png fallback (needs "
+                "matplotlib for the png), cached under --cache-dir.  Without "
+                "it the html writer's own math output is used.",
+                ["--render-math"],
+                {"action": "store_true", "validator": frontend.validate_boolean},
+            ),
+            (
+                "Resolution of the png fallback of --render-math (shown by "
+                "readers without MathML).  Default: 150.",
+                ["--math-dpi"],
+                {
+                    "metavar": "<DPI>",
+                    "type": "int",
+                    "default": 150,
+                    "validator": frontend.validate_nonnegative_int,
+                },
+            ),
+            (
+                "How to compress the epub: default (deflate everything), "
+                "release (smallest: deflate at the highest level, store what "
+                "doesn't shrink) or preview (fastest: store images and fonts, "
+                "deflate the rest at the lowest level).  Default: default.",
+                ["--compression"],
+                {
+                    "choices": sorted(ziputil.PROFILES),
+                    "default": "default",
+                    "metavar": "<PROFILE>",
+                },
+            ),
+            (
+                "If the destination epub exists, copy the compressed bytes "
+                "of its members that haven't changed instead of compressing "
+                "them again.",
+                ["--update-archive"],
+                {"action": "store_true", "validator": frontend.validate_boolean},
+            ),
+            (
+                "Keep the compressed members of the epub in DIR and reuse "
+                "them in later builds and other books, so shared stylesheets, "
+                "fonts and images are compressed once.",
+                ["--member-store"],
+                {"metavar": "<DIR>"},
+            ),
+            (
+                "Size the --member-store is kept under, least recently used "
+                "members are removed first.  Default: 512.",
+                ["--member-store-size"],
+                {
+                    "metavar": "<MB>",
+                    "type": "int",
+                    "default": 512,
+                    "validator": frontend.validate_nonnegative_int,
+                },
+            ),
+            (
+                "Split the table of contents page into pages of at most N "
+                "entries, linked to each other.",
+                ["--toc-page-entries"],
+                {
+                    "metavar": "<N>",
+                    "type": "int",
+                    "validator": frontend.validate_nonnegative_int,
+                },
+            ),
+            (
+                "Split the table of contents page into pages of about at "
+                "most KB kilobytes of entries.",
+                ["--toc-page-kb"],
+                {
+                    "metavar": "<KB>",
+                    "type": "int",
+                    "validator": frontend.validate_nonnegative_int,
+                },
+            ),
+            (
+                "Only show entries down to this depth on the table of "
+                "contents page (the toc.ncx keeps them all).",
+                ["--toc-page-depth"],
+                {
+                    "metavar": "<N>",
+                    "type": "int",
+                    "validator": frontend.validate_nonnegative_int,
+                },
+            ),
+            (
+                "Write the compressed and uncompressed size of every member "
+                "of the epub, and the source section of each chapter, to "
+                "FILE (json if it ends in .json).  See also rst2epub inspect.",
+                ["--size-report"],
+                {"metavar": "<FILE>"},
+            ),
+            (
+                "Flag members bigger than this in --size-report.",
+                ["--size-budget"],
+                {
+                    "metavar": "<KB>",
+                    "type": "int",
+                    "validator": frontend.validate_nonnegative_int,
+                },
+            ),
+            (
+                "Build in a workspace under DIR (eg a tmpfs), default the "
+                "$EPUBLIB_WORKSPACE_ROOT environment variable or the temp dir.",
+                ["--workspace-dir"],
+                {"metavar": "<DIR>"},
+            ),
+            (
+                "Fail the build as soon as its workspace holds more than "
+                "this (checked as the book and the archive are written).",
+                ["--workspace-quota"],
+                {
+                    "metavar": "<MB>",
+                    "type": "int",
+                    "validator": frontend.validate_nonnegative_int,
+                },
+            ),
+            (
+                "Keep the workspaces of the last N failed builds for "
+                "debugging, 0 removes them.  Default 3.",
+                ["--keep-failed-workspaces"],
+                {
+                    "metavar": "<N>",
+                    "type": "int",
+                    "default": 3,
+                    "validator": frontend.validate_nonnegative_int,
+                },
+            ),
+            (
+                "Write the files the build read (source, includes, images, "
+                "cover, css:, js:, font:, addimg:) to FILE, as a Makefile "
+                "rule, or as json if FILE ends in .json.",
+                ["--dep-file"],
+                {"metavar": "<FILE>"},
+            ),
+        ),
+    )
+    def __init__(self, book_only=False):
         html4css1.Writer.__init__(self)
         self.translator_class = HTMLTranslator
+        # stop at an EpubBook ready for create_book, see build_book()
+        self.book_only = book_only
+        self.book = None
 
     def translate(self):
         self.visitor = visitor = self.translator_class(self.document)
         self.document.walkabout(visitor)
         for attr in self.visitor_attributes:
             setattr(self, attr, getattr(visitor, attr))
-        self.output = self.visitor.get_output()
+        if self.book_only:
+            self.book = visitor.prepare_book()
+            self.output = b""
+        else:
+            self.output = visitor.get_output()
+        settings = self.document.settings
+        # once, by the publisher's own writer which is the last to run
+        if getattr(settings, "dep_file", None) and (
+            self.destination.destination_path == settings._destination
+        ):
+            outputs = [settings._destination] + [
+                target.split(":", 1)[1] for target in settings.target
+            ]
+            write_dep_file(
+                settings.dep_file,
+                [path for path in outputs if path],
+                [settings._source] + settings.record_dependencies.list,
+            )
 
 
 class HTMLTranslator(html4css1.HTMLTranslator):
     def __init__(self, document):
         html4css1.HTMLTranslator.__init__(self, document)
         self.book = epub.EpubBook()
+        self.book.font_subsetting = getattr(document.settings, "subset_fonts", False)
+        self.cache_dir = getattr(document.settings, "cache_dir", None)
+        self.book.font_cache_dir = util.cache_dir(fonts.CACHE_NAME, self.cache_dir)
+        self.book.css_pruning = getattr(document.settings, "prune_css", False)
+        self.book.minify_html = getattr(document.settings, "minify", False)
+        settings = document.settings
+        self.book.toc_page_entries = getattr(settings, "toc_page_entries", None)
+        toc_page_kb = getattr(settings, "toc_page_kb", None)
+        self.book.toc_page_bytes = toc_page_kb and toc_page_kb * 1024
+        self.book.toc_page_depth = getattr(settings, "toc_page_depth", None)
+        # relative paths in the document are relative to this
+        self.base_dir = getattr(document.settings, "base_dir", None)
+        if not self.base_dir:
+            source = document.settings._source
+            if source and source != "-":
+                self.base_dir = os.path.dirname(os.path.abspath(source))
+            else:
+                self.base_dir = os.getcwd()
+        self.restrict_paths = getattr(document.settings, "restrict_paths", False)
         self.sections = []
         self.body_len_before_node = {}
         self.section_title = ""
@@ -143,6 +407,19 @@ class HTMLTranslator(html4css1.HTMLTranslator):
         self.parent_level = 0
         self.guide_type = None
         self.first_admonition_para = False
+        self.added_paths = set()  # css/js/font paths already in the book
+        self.id_index = {}  # every emitted id -> href in the book
+        self.section_ids = []  # ids of sections in the current chapter
+        self.chapter_source = None  # source:line of the current chapter
+        self.chapter_sources = {}  # chapter path in the book -> source:line
+        self.highlighted = {}  # (code, language) -> html
+        self.highlight_css = None
+        if getattr(document.settings, "highlight", False):
+            self.highlight_blocks(document)
+        self.math = {}  # (tex, block) -> mathrender.render() result
+        self.math_rendering = getattr(document.settings, "render_math", False)
+        if self.math_rendering:
+            self.render_math(document)
 
     def dispatch_visit(self, node):
         # mark body length before visiting node
@@ -165,6 +442,36 @@ class HTMLTranslator(html4css1.HTMLTranslator):
         """
         return self.in_node.get(nodename, False)
 
+    def abspath(self, path):
+        """
+        `path` made absolute against the directory of the document
+        (instead of chdir-ing there, which isn't thread safe)
+        """
+        return os.path.normpath(os.path.join(self.base_dir, path))
+
+    def record_dependency(self, abs_path):
+        """
+        add a file the build read to --dep-file
+        """
+        record_dependencies = getattr(self.settings, "record_dependencies", None)
+        if record_dependencies is not None:
+            record_dependencies.add(utils.relative_path(None, abs_path))
+
+    def resource_path(self, path):
+        """
+        absolute path of a file the document refers to, checked against
+        --restrict-paths
+        """
+        abs_path = self.abspath(path)
+        self.record_dependency(abs_path)
+        if self.restrict_paths:
+            base_dir = os.path.join(os.path.realpath(self.base_dir), "")
+            if os.path.isabs(path) or not os.path.realpath(abs_path).startswith(
+                base_dir
+            ):
+                raise ValueError("path outside of the document directory: " + path)
+        return abs_path
+
     def _dumb(self, node):
         pass
 
@@ -250,7 +557,103 @@ class HTMLTranslator(html4css1.HTMLTranslator):
         # mobi doesn't like multiple classes per tag
         self.append_class_on_child(node, "-first", 0)
 
+    def block_language(self, node):
+        """
+        language of a literal block: the code directive's, or
+        --highlight-language for :: blocks
+        """
+        classes = node["classes"]
+        if "code" in classes:
+            languages = classes[classes.index("code") + 1 :]
+            return languages[0] if languages else None
+        return getattr(self.settings, "highlight_language", None)
+
+    def highlight_blocks(self, document):
+        """
+        highlight all code blocks up front, so the uncached ones can be
+        done in parallel
+        """
+        findall = getattr(document, "findall", None) or document.traverse
+        blocks = []
+        for node in findall(nodes.literal_block):
+            language = self.block_language(node)
+            if language:
+                blocks.append((node.astext(), language))
+        if blocks:
+            cache_dir = util.cache_dir(highlight.CACHE_NAME, self.cache_dir)
+            self.highlighted = highlight.highlight_many(blocks, cache_dir=cache_dir)
+            self.highlight_css = highlight.stylesheet(
+                self.settings.highlight_style, cache_dir
+            )
+
+    def render_math(self, document):
+        """
+        render all math up front, so the uncached expressions can be done
+        in parallel
+        """
+        findall = getattr(document, "findall", None) or document.traverse
+        expressions = [
+            (node.astext(), isinstance(node, nodes.math_block))
+            for node in findall(lambda n: isinstance(n, (nodes.math, nodes.math_block)))
+        ]
+        if expressions:
+            dpi = getattr(self.settings, "math_dpi", 150)
+            cache_dir = util.cache_dir(mathrender.CACHE_NAME, self.cache_dir)
+            self.math = mathrender.render_many(
+                expressions, dpi=dpi, cache_dir=cache_dir
+            )
+
+    def visit_math(self, node):
+        block = isinstance(node, nodes.math_block)
+        if not self.math_rendering:
+            # handles math blocks too
+            return html4css1.HTMLTranslator.visit_math(self, node)
+        tex = node.astext()
+        result = self.math[(tex, block)]
+        if result["mathml"] is None:
+            self.document.reporter.warning(
+                "math not converted, " + "; ".join(result["errors"]),
+                base_node=node,
+            )
+        if result["image"]:
+            uri = "math/" + os.path.basename(result["image"])
+            self.images[result["image"]] = uri
+            fallback = self.emptytag({}, "img", src=uri, alt=tex)
+        else:
+            fallback = self.encode(tex)
+        if block:
+            self.body.append(self.starttag(node, "div", CLASS="math"))
+        else:
+            self.body.append(self.starttag(node, "span", "", CLASS="math"))
+        if result["mathml"] is None:
+            self.body.append(fallback)
+        else:
+            # epub2's way of giving readers without MathML something else
+            self.body.append(
+                '<ops:switch xmlns:ops="http://www.idpf.org/2007/ops">'
+                '<ops:case required-namespace="http://www.w3.org/1998/Math/MathML">'
+            )
+            self.body.append(result["mathml"].strip())
+            self.body.append("</ops:case><ops:default>")
+            self.body.append(fallback)
+            self.body.append("</ops:default></ops:switch>")
+        self.body.append("</div>\n" if block else "</span>")
+        raise nodes.SkipNode
+
+    visit_math_block = visit_math
+
     def visit_literal_block(self, node):
+        html = self.highlighted.get((node.astext(), self.block_language(node)))
+        if html is not None:
+            if self.css is not None and self.highlight_css not in self.css:
+                self.css = self.css + [self.highlight_css]
+            # one class per tag for mobi, the stylesheet is scoped to it
+            ids = "".join(' id="{0}"'.format(id_) for id_ in node["ids"][:1])
+            self.body.append('<div class="highlight"{0}>\n'.format(ids))
+            self.body.append('<pre class="literal-block">')
+            self.body.append(html)
+            self.body.append("\n</pre>\n</div>\n")
+            raise nodes.SkipNode
         # mobi needs an extra div here, otherwise headings following
         # <pre> are indented poorly
         if self.at("admonition"):
@@ -324,14 +727,12 @@ book will follow suit.</paragraph></footnote>
         if name.startswith("DC"):
             self.fields[name[3:]] = node.get("content")
         elif name.startswith("coverpage"):
-            with cwd_cm():
-                cover_page = node.get("content")
-                self.cover_image = os.path.abspath(cover_page)
+            cover_page = node.get("content")
+            self.cover_image = self.resource_path(cover_page)
 
-    @cwd_decorator
     def visit_Text(self, node):  # noqa
         def valid_paths(paths):
-            return [os.path.abspath(path) for path in paths if path]
+            return [self.resource_path(path) for path in paths if path]
 
         if "Copyright" in str(node):
             pass
@@ -374,7 +775,7 @@ book will follow suit.</paragraph></footnote>
                 self.css = None
             elif txt.startswith("addimg:"):
                 uri = txt.split(":")[-1]
-                self.images[os.path.abspath(uri)] = uri
+                self.images[self.resource_path(uri)] = uri
             elif txt.startswith("toc:show"):
                 # old school hack now overriding .. contents::
                 # see visit_epubcontent
@@ -403,16 +804,15 @@ book will follow suit.</paragraph></footnote>
     def depart_epubcontent(self, node):
         self.section_level = 0
 
-    @cwd_decorator
     def visit_image(self, node):
         self._ignore_image = False
         if "cover" in node.get("classes"):
             source = node.get("uri")
-            self.cover_image = os.path.abspath(source)
+            self.cover_image = self.resource_path(source)
             self._ignore_image = True
         else:
             source = node.get("uri")
-            abs_path = os.path.abspath(source)
+            abs_path = self.resource_path(source)
             if abs_path == source:
                 # put absolute-pathed images into OEBPS directory
                 if source.startswith("/"):
@@ -508,6 +908,12 @@ book will follow suit.</paragraph></footnote>
                 self.create_chapter()
             else:
                 self.reset_chapter()
+            title = node.next_node(nodes.title) or node
+            source = title.source or node.source or self.settings._source
+            # docutils gives the line of the underline
+            line = (title.line or node.line or 1) - 1
+            self.chapter_source = "{0}:{1}".format(source, line)
+        self.section_ids.extend(node.get("ids", []))
         self.section_level += 1
         self.first_paragraph = True
 
@@ -553,8 +959,13 @@ book will follow suit.</paragraph></footnote>
                 ]
             )
             for item in self.css:
-                if os.path.exists(item):
-                    self.book.add_css(item, os.path.basename(item))
+                if item in self.added_paths:
+                    continue
+                self.added_paths.add(item)
+                if os.path.exists(self.abspath(item)):
+                    # eg a main.css next to the document overriding ours
+                    self.record_dependency(self.abspath(item))
+                    self.book.add_css(self.abspath(item), os.path.basename(item))
                 else:
                     self.book.add_css(
                         os.path.join(
@@ -564,6 +975,9 @@ book will follow suit.</paragraph></footnote>
                     )
         if self.font:
             for item in self.font:
+                if item in self.added_paths:
+                    continue
+                self.added_paths.add(item)
                 if os.path.exists(item):
                     self.book.add_font(item, os.path.basename(item))
                 else:
@@ -580,6 +994,9 @@ book will follow suit.</paragraph></footnote>
                 ]
             )
             for item in self.js:
+                if item in self.added_paths:
+                    continue
+                self.added_paths.add(item)
                 if os.path.exists(item):
                     self.book.add_js(item, os.path.basename(item))
                 else:
@@ -593,6 +1010,7 @@ book will follow suit.</paragraph></footnote>
         header = css + js
         html = XHTML_WRAPPER.format(body=body, title=title, header=header)
         if self.is_title_page:
+            self.index_ids(body, "title-page.html")
             self.book.add_title_page(html)
             # clear out toc_map_node
             self.book.last_node_at_depth = {0: self.book.toc_map_root}
@@ -603,7 +1021,9 @@ book will follow suit.</paragraph></footnote>
             self.toc_page = False
         else:
             dst = "{0}.html".format(len(self.sections))
+            self.index_ids(body, dst)
             item = self.book.add_html("", dst, html)
+            self.chapter_sources[dst] = self.chapter_source
             if self.guide_type:
                 self.book.add_guide_item(dst, self.section_title, self.guide_type)
             self.book.add_spine_item(item)
@@ -618,6 +1038,35 @@ book will follow suit.</paragraph></footnote>
                 self.toc_parents = self.toc_parents[:1] + [node]
         self.reset_chapter()
 
+    def index_ids(self, body, dest_path):
+        for id_ in ID_RE.findall(body):
+            self.id_index.setdefault(id_, "{0}#{1}".format(dest_path, id_))
+        # sections don't get a div (mobi), so their ids aren't in the
+        # html, link to the top of the chapter instead
+        for id_ in self.section_ids:
+            self.id_index.setdefault(id_, dest_path)
+        self.section_ids = []
+
+    def resolve_links(self):
+        """
+        Point ``#id`` links at the chapter file the id ended up in.
+        One pass over the html items, ids are looked up in id_index.
+        """
+
+        def resolve(item):
+            def replace(match):
+                quote, id_ = match.groups()
+                href = self.id_index.get(id_)
+                if href is None or href.split("#")[0] == item.dest_path:
+                    return match.group(0)
+                return "href={0}{1}{0}".format(quote, href)
+
+            return replace
+
+        for item in self.book.html_items.values():
+            if item.html:
+                item.html = LOCAL_HREF_RE.sub(resolve(item), item.html)
+
     def reset_chapter(self):
         self.section_title = ""
         self.first_paragraph = True
@@ -645,13 +1094,22 @@ book will follow suit.</paragraph></footnote>
     depart_thead = depart_tbody
 
     def get_output(self):
-        if sys.platform == "darwin":
-            kw = {"dir": "/tmp"}
-        else:
-            kw = {}
-        # root_dir = os.path.join(tempfile.gettempdir(), 'epub')
-        root_dir = os.path.join(tempfile.mkdtemp(**kw), "epub")
-        print("\n\nROOT", root_dir)
+        root = getattr(self.settings, "workspace_dir", None)
+        if root is None and sys.platform == "darwin":
+            root = "/tmp"
+        quota = getattr(self.settings, "workspace_quota", None)
+        with workspace.Workspace(
+            root=root,
+            quota=quota and quota * 1024 * 1024,
+            keep_failed=getattr(self.settings, "keep_failed_workspaces", 3),
+        ) as ws:
+            return self._build(os.path.join(ws.path, "epub"), ws)
+
+    def prepare_book(self):
+        """
+        add the metadata, cover and images to the book and resolve the
+        links between chapters, the book is then ready for create_book
+        """
         for k, v in self.fields.items():
             if k == "creator":
                 self.book.add_creator(v)
@@ -665,9 +1123,50 @@ book will follow suit.</paragraph></footnote>
         for i, img_paths in enumerate(self.images.items()):
             abs_path, dst_path = img_paths
             self.book.add_image(abs_path, dst_path, id="image_{0}".format(i))
+        self.resolve_links()
+        return self.book
+
+    def _build(self, root_dir, ws=None):
+        print("\n\nROOT", root_dir)
+        self.prepare_book()
+        on_progress = None
+        if ws is not None:
+            # checked as files are written, not once the disk is full
+            self.book.on_write = ws.add_file
+            on_progress = ws.check_writing
         self.book.create_book(root_dir)
-        self.book.create_archive(root_dir, root_dir + ".epub")
-        return open(root_dir + ".epub", "rb").read()
+        if ws is not None:
+            ws.check()
+        previous = None
+        if getattr(self.settings, "update_archive", False):
+            destination = self.settings._destination
+            if destination and zipfile.is_zipfile(destination):
+                previous = destination
+        policy = ziputil.PROFILES[getattr(self.settings, "compression", "default")]
+        store = None
+        if getattr(self.settings, "member_store", None):
+            max_size = self.settings.member_store_size * 1024 * 1024
+            store = ziputil.MemberStore(self.settings.member_store, max_size)
+        self.book.create_archive(
+            root_dir,
+            root_dir + ".epub",
+            previous=previous,
+            policy=policy,
+            store=store,
+            on_progress=on_progress,
+        )
+        if ws is not None:
+            ws.check()
+        if getattr(self.settings, "size_report", None):
+            budget = (self.settings.size_budget or 0) * 1024
+            sources = dict(
+                ("OEBPS/" + path, source)
+                for path, source in self.chapter_sources.items()
+            )
+            rows = report.inspect_epub(root_dir + ".epub", budget, sources)
+            report.write_report(self.settings.size_report, rows)
+        with open(root_dir + ".epub", "rb") as fin:
+            return fin.read()
 
 
 XHTML_WRAPPER = u"""<?xml version="1.0" encoding="UTF-8"?>
@@ -685,6 +1184,43 @@ XHTML_WRAPPER = u"""<?xml version="1.0" encoding="UTF-8"?>
 </html>"""
 
 
+def make_escape(path):
+    return path.replace("$", "$$").replace("#", "\\#").replace(" ", "\\ ")
+
+
+def write_dep_file(path, outputs, dependencies):
+    """
+    Write `dependencies` of `outputs` to `path`: json if it ends in
+    .json, else a Makefile rule with an empty rule per dependency (like
+    ``gcc -MP``) so make doesn't fail when one is removed.  Files
+    installed with docutils (the html writer's stylesheet) are left out.
+    """
+    library = os.path.join(os.path.dirname(os.path.abspath(docutils.__file__)), "")
+    dependencies = [
+        dep
+        for dep in dependencies
+        if dep
+        and dep != "<stdin>"
+        and not os.path.abspath(dep).startswith(library)
+    ]
+    if path.endswith(".json"):
+        data = json.dumps(
+            {"outputs": outputs, "dependencies": dependencies}, indent=2
+        )
+    else:
+        lines = [
+            "{0}: {1}".format(
+                " ".join(make_escape(output) for output in outputs or ["-"]),
+                " ".join(make_escape(dep) for dep in dependencies),
+            )
+        ]
+        for dep in dependencies:
+            lines.extend(["", make_escape(dep) + ":"])
+        data = "\n".join(lines)
+    with open(path, "w") as fout:
+        fout.write(data + "\n")
+
+
 class EpubFileOutput(io.FileOutput):
     """
     A version of docutils.io.FileOutput which writes to a binary file.
@@ -707,6 +1243,84 @@ class EpubFileOutput(io.FileOutput):
         self.opened = 1
 
 
+# writers available to --target, with the output class their data needs
+TARGETS = {
+    "epub": (EpubWriter, EpubFileOutput),
+    "html": (html4css1.Writer, io.FileOutput),
+}
+
+
+def get_target(target, settings):
+    """
+    return a (writer, destination) pair for a ``NAME:PATH`` target
+    (already checked by validate_targets)
+    """
+    name, _, path = target.partition(":")
+    writer_class, output_class = TARGETS[name]
+    destination = output_class(
+        destination_path=path,
+        encoding=settings.output_encoding,
+        error_handler=settings.output_encoding_error_handler,
+    )
+    return writer_class(), destination
+
+
+def get_post_processor(settings):
+    processor = postprocess.PostProcessor(timeout=settings.post_process_timeout)
+    for command in settings.post_process:
+        processor.register(command.split()[0], command)
+    return processor
+
+
+def publish_targets(publisher, targets, processor=None, enable_exit_status=False):
+    """
+    Parse and transform the source once, then write it with each of
+    `targets` and finally the publisher's own writer.  Every writer but
+    the last gets a copy of the doctree: both writers modify nodes while
+    translating (HTMLTranslator rewrites image uris and tables,
+    html4css1 adds "first"/"last" classes), which would leak into the
+    next output.  Epubs are handed to
+    `processor` as soon as they are written.  Errors and the exit status
+    are handled as in ``Publisher.publish``.
+    """
+    exit_ = None
+    try:
+        publisher.set_io()
+        publisher.document = publisher.reader.read(
+            publisher.source, publisher.parser, publisher.settings
+        )
+        publisher.apply_transforms()
+        outputs = [get_target(target, publisher.settings) for target in targets]
+        outputs.append((publisher.writer, publisher.destination))
+        for i, (writer, destination) in enumerate(outputs):
+            document = publisher.document
+            if i < len(outputs) - 1:
+                document = document.deepcopy()
+            writer.write(document, destination)
+            if processor and isinstance(writer, EpubWriter):
+                processor.submit(destination.destination_path)
+    except SystemExit as error:
+        exit_ = True
+        exit_status = error.code
+    except Exception as error:
+        if publisher.settings.traceback:
+            publisher.debugging_dumps()
+            raise
+        publisher.report_Exception(error)
+        exit_ = True
+        exit_status = 1
+    publisher.debugging_dumps()
+    reporter = publisher.document and publisher.document.reporter
+    if (
+        enable_exit_status
+        and reporter
+        and reporter.max_level >= publisher.settings.exit_status_level
+    ):
+        sys.exit(reporter.max_level + 10)
+    elif exit_:
+        sys.exit(exit_status)
+
+
 class epubcontent(nodes.Element):
     # change normal TOC to epubcontent
     tagname = "epubcontent"
@@ -722,7 +1336,6 @@ class Index(Directive):
     optional_arguments = 1
     final_argument_whitespace = True
     option_spec = {}
-    count = 0
 
     def run(self):
         text = "".join(self.content)
@@ -730,8 +1343,7 @@ class Index(Directive):
         index_node = index(rawsource=text)
         # Parse the directive contents.
         self.state.nested_parse(self.content, self.content_offset, index_node)
-        targetid = "index-%s" % Index.count
-        Index.count += 1
+        targetid = next_index_id(self.state.document)
         target_node = nodes.target("", "", ids=[targetid])
         index_node["entries"] = ne = []
         index_node["inline"] = False
@@ -742,6 +1354,16 @@ class Index(Directive):
         return [index_node, target_node]
 
 
+def next_index_id(document):
+    """
+    index target ids are numbered per document, so concurrent builds
+    don't share a counter
+    """
+    count = getattr(document, "index_count", 0)
+    document.index_count = count + 1
+    return "index-%s" % count
+
+
 indextypes = ["single", "pair", "double", "triple", "see", "seealso"]
 
 
@@ -813,14 +1435,12 @@ class IndexOld(Directive):
     optional_arguments = 0
     final_argument_whitespace = True
     option_spec = {}
-    count = 0
 
     def run(self):
         return []  # None #ignore for now
         # see sphinx.directives.other.Index for hints
         arguments = self.arguments[0].split("\n")
-        targetid = "index-%s" % Index.count
-        Index.count += 1
+        targetid = next_index_id(self.state.document)
         targetnode = nodes.target("", "", ids=[targetid])
         self.state.document.note_explicit_target(targetnode)
         indexnode = addnodes.index()
@@ -847,11 +1467,64 @@ class Contents(Directive):
 
 
 class Parser(docutils.parsers.rst.Parser):
+    settings_spec = docutils.parsers.rst.Parser.settings_spec + (
+        "rst2epub Parser Options",
+        None,
+        (
+            (
+                "Parse the top level sections of a large document in <N> "
+                "processes.  The result is the same as a serial parse, "
+                "documents that don't split are parsed serially.  "
+                "Default: 0 (off).",
+                ["--parallel-parse"],
+                {
+                    "metavar": "<N>",
+                    "type": "int",
+                    "default": 0,
+                    "validator": frontend.validate_nonnegative_int,
+                },
+            ),
+        ),
+    )
+
     def __init__(self):
-        directives.register_directive("contents", Contents)
-        directives.register_directive("index", Index)
+        register_extensions()
         docutils.parsers.rst.Parser.__init__(self)
 
+    def parse(self, inputstring, document):
+        if getattr(document.settings, "highlight", False):
+            # the writer highlights (cached, in parallel), don't also
+            # tokenize code blocks while parsing
+            document.settings.syntax_highlight = "none"
+        processes = getattr(document.settings, "parallel_parse", 0)
+        if processes:
+            from epublib import rstparallel
+
+            if rstparallel.parse(self, inputstring, document, processes):
+                renumber_index_targets(document)
+                return
+        docutils.parsers.rst.Parser.parse(self, inputstring, document)
+
+
+def renumber_index_targets(document):
+    """
+    number the index targets in document order, as next_index_id does
+    in a serial parse (pieces of a parallel parse each start at 0)
+    """
+    findall = getattr(document, "findall", None) or document.traverse
+    count = 0
+    for node in list(findall(index)):
+        target = node.next_node(descend=False, siblings=True)
+        old_id = target["ids"][0]
+        new_id = "index-%s" % count
+        target["ids"] = [new_id]
+        node["entries"] = [
+            (type_, value, new_id if targetid == old_id else targetid, main)
+            for type_, value, targetid, main in node["entries"]
+        ]
+        count += 1
+    document.index_count = count
+
 
 # FIXME envvar !!!
 class envvar(nodes.Inline, nodes.TextElement):
@@ -867,11 +1540,221 @@ def ignore_role(role, rawtext, text, lineno, inliner, options={}, content=[]):
 
 from docutils.parsers.rst import roles  # noqa
 
-roles.register_local_role("envvar", ignore_role)
-# roles.register_local_role('envvar', envvar)
+
+def register_extensions():
+    """
+    Register the contents and index directives and the envvar role.
+    Docutils keeps these in process global registries, so this replaces
+    the standard ``contents`` directive for every later parse in the
+    process.  It is done when a Parser is created rather than on import
+    so that importing rst2epub (eg from sphinxext) doesn't change Sphinx's
+    own directives.  Registering is idempotent, so concurrent builds are
+    fine.
+    """
+    directives.register_directive("contents", Contents)
+    directives.register_directive("index", Index)
+    roles.register_local_role("envvar", ignore_role)
+    # roles.register_local_role('envvar', envvar)
+
+
+def build(text, base_dir=None, options=None, stream=None, source_path=None):
+    """
+    Convert reStructuredText `text` to an epub and return its bytes, or
+    write them to `stream` if given.
+
+    Relative paths in the document (images, css:, font:, ...) are
+    resolved against `base_dir`, by default the current directory.
+    `options` are docutils settings overrides, eg ``{"prune_css": True}``.
+    Nothing process global is touched, so several threads can build at
+    once.  For untrusted text pass ``file_insertion_enabled=False`` and
+    ``restrict_paths=True`` in `options`.
+    """
+    overrides = {"traceback": True, "base_dir": base_dir}
+    overrides.update(options or {})
+    output = publish_string(
+        text,
+        source_path=source_path,
+        reader=standalone.Reader(),
+        parser=Parser(),
+        writer=EpubWriter(),
+        settings_overrides=overrides,
+    )
+    if stream is None:
+        return output
+    stream.write(output)
+
+
+def build_book(text, base_dir=None, options=None, source_path=None):
+    """
+    Like build() but stop before anything is written and return the
+    translated EpubBook, for callers that write the archive themselves
+    (see epublib.aio).
+    """
+    overrides = {"traceback": True, "base_dir": base_dir}
+    overrides.update(options or {})
+    writer = EpubWriter(book_only=True)
+    publish_string(
+        text,
+        source_path=source_path,
+        reader=standalone.Reader(),
+        parser=Parser(),
+        writer=writer,
+        settings_overrides=overrides,
+    )
+    return writer.book
+
+
+def build_file(path, options=None, stream=None):
+    """
+    build() for the rst file at `path`, relative paths in it are
+    resolved against its directory
+    """
+    with open(path, "rb") as fin:
+        text = fin.read().decode("utf-8-sig")
+    return build(
+        text,
+        base_dir=os.path.dirname(os.path.abspath(path)),
+        options=options,
+        stream=stream,
+        source_path=path,
+    )
+
+
+class MetadataVisitor(nodes.SparseNodeVisitor):
+    """
+    Collects what HTMLTranslator puts in the book's metadata (the field
+    list of the first page, authors, Gutenberg DC.* and coverpage meta,
+    the cover image) and the chapter titles, without rendering anything.
+    """
+
+    def __init__(self, document, base_dir):
+        nodes.SparseNodeVisitor.__init__(self, document)
+        self.base_dir = base_dir
+        self.fields = {}
+        self.authors = []
+        self.cover = None
+        self.chapters = []
+        self.section_level = 0
+        self.first_page = True
+
+    def visit_field(self, node):
+        if self.first_page:
+            name = node.children[0].astext()
+            self.fields[name] = node.children[1].astext()
+        raise nodes.SkipNode
+
+    def visit_author(self, node):
+        self.authors.append(node.astext())
+
+    def visit_meta(self, node):
+        name = node.get("name", "")
+        if name.startswith("DC"):
+            self.fields[name[3:]] = node.get("content")
+        elif name.startswith("coverpage"):
+            self.cover = os.path.join(self.base_dir, node.get("content"))
+
+    def visit_image(self, node):
+        if "cover" in node.get("classes"):
+            self.cover = os.path.join(self.base_dir, node.get("uri"))
+
+    def visit_section(self, node):
+        if self.section_level == 0:
+            self.chapters.append(node.next_node(nodes.title).astext())
+        self.section_level += 1
+
+    def depart_section(self, node):
+        self.first_page = False
+        self.section_level -= 1
+
+    def metadata(self):
+        creators = [self.fields["creator"]] if "creator" in self.fields else []
+        if self.authors:
+            creators.append(", ".join(self.authors))
+        titles = [v for k, v in self.fields.items() if k.lower() == "title"]
+        return {
+            "title": titles[-1] if titles else None,
+            "creators": creators,
+            "fields": self.fields,
+            "cover": self.cover and os.path.normpath(self.cover),
+            "chapters": self.chapters,
+        }
+
+
+def extract_metadata(path, options=None):
+    """
+    The metadata and chapter titles the epub of the rst file at `path`
+    would have, as a dict.  Only parses, nothing is rendered or written.
+    """
+    with open(path, "rb") as fin:
+        text = fin.read().decode("utf-8-sig")
+    overrides = {"traceback": True}
+    overrides.update(options or {})
+    document = publish_doctree(
+        text,
+        source_path=path,
+        reader=standalone.Reader(),
+        parser=Parser(),
+        settings_overrides=overrides,
+    )
+    visitor = MetadataVisitor(document, os.path.dirname(os.path.abspath(path)))
+    document.walkabout(visitor)
+    result = {"source": path}
+    result.update(visitor.metadata())
+    return result
+
+
+def _extract_metadata(path):
+    try:
+        return extract_metadata(path, {"report_level": 5})
+    except Exception as e:
+        return {"source": path, "error": "{0}: {1}".format(e.__class__.__name__, e)}
+
+
+def metadata_main(args):
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog="rst2epub",
+        description="print the metadata and chapter titles of rst books as "
+        "json, one line per file, without building them",
+    )
+    parser.add_argument(
+        "--metadata-json",
+        action="store_true",
+        required=True,
+        help="print metadata instead of building",
+    )
+    parser.add_argument("files", nargs="+", metavar="FILE")
+    parser.add_argument(
+        "--jobs", type=int, default=1, help="parse this many files at once"
+    )
+    opts = parser.parse_args(args)
+    if opts.jobs > 1:
+        from epublib import util
+
+        results = util.process_map(
+            _extract_metadata, [(path,) for path in opts.files], opts.jobs
+        )
+    else:
+        results = (_extract_metadata(path) for path in opts.files)
+    status = 0
+    for result in results:
+        print(json.dumps(result, sort_keys=True))
+        if "error" in result:
+            status = 1
+    return status
 
 
 def main(args=sys.argv):
+    if len(args) > 1 and args[1] == "serve":
+        from epublib import server
+
+        return server.main(args[2:], build)
+    if len(args) > 1 and args[1] == "inspect":
+        return report.main(args[2:])
+    if "--metadata-json" in args[1:]:
+        # anywhere on the command line, eg after the file names
+        return metadata_main(args[1:])
     argv = None
     reader = standalone.Reader()
     reader_name = "standalone"
@@ -893,15 +1776,34 @@ def main(args=sys.argv):
         "Generates epub books from reStructuredText sources.  " + default_description
     )
 
-    publisher.publish(
-        argv,
-        usage,
-        description,
-        settings_spec,
-        settings_overrides,
-        config_section=config_section,
-        enable_exit_status=enable_exit_status,
+    publisher.process_command_line(
+        argv, usage, description, settings_spec, config_section=config_section
     )
+    processor = get_post_processor(publisher.settings)
+    if publisher.settings.target:
+        publish_targets(
+            publisher,
+            publisher.settings.target,
+            processor,
+            enable_exit_status=enable_exit_status,
+        )
+    else:
+        publisher.publish(
+            argv,
+            usage,
+            description,
+            settings_spec,
+            settings_overrides,
+            config_section=config_section,
+            enable_exit_status=enable_exit_status,
+        )
+        if publisher.destination.destination_path:
+            processor.submit(publisher.destination.destination_path)
+    results = processor.wait()
+    processor.report(results)
+    if not all(result.ok for result in results):
+        # let a failing validator (epubcheck) fail the build
+        return 1
 
 
 if __name__ == "__main__":
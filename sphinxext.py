@@ -1,23 +1,28 @@
+from __future__ import print_function
+
 import os.path
 
 import rst2epub
 
+from docutils import nodes
 from docutils.frontend import OptionParser
 from docutils.writers import html4css1
-from epublib import epub
+from epublib import epub, postprocess, workspace
 from genshi.util import striptags
+from sphinx import addnodes
 from sphinx.builders import Builder
 from sphinx.highlighting import PygmentsBridge
 from sphinx.util.console import bold, darkgreen
 from sphinx.util.nodes import inline_all_toctrees
 from sphinx.util.osutil import copyfile, relative_uri
+from sphinx.util.parallel import ParallelTasks, make_chunks
 from sphinx.writers.html import HTMLTranslator
 
 
 # dublin core meta data
-DC_ITEMS = set('title', 'creator', 'subject', 'description', 'publisher',
-               'contributor', 'date', 'type', 'format', 'identifier', 'source',
-               'language', 'relation', 'coverage', 'rights')
+DC_ITEMS = set(['title', 'creator', 'subject', 'description', 'publisher',
+                'contributor', 'date', 'type', 'format', 'identifier',
+                'source', 'language', 'relation', 'coverage', 'rights'])
 
 class MobiWriter(html4css1.Writer):
     def __init__(self, builder):
@@ -27,40 +32,49 @@ class MobiWriter(html4css1.Writer):
     def translate(self):
         visitor = MobiTranslator(self.builder, self.document)
         self.document.walkabout(visitor)
+        self.builder.merge_document(visitor.chapters, visitor.images,
+                                    visitor.toc_page_at)
         self.output = visitor.get_output()
 
 
+def chapter_html(body, title, css_paths):
+    # check for css overrides
+    css_pattern = \
+        '<link rel="stylesheet" href="{0}" type="text/css" media="all" />'
+    css = ''
+    for item in css_paths:
+        css += css_pattern.format(os.path.basename(item)) + '\n'
+    css = css.rstrip()
+    return rst2epub.XHTML_WRAPPER.format(body=body, title=title, header=css)
+
+
 class MobiTranslator(HTMLTranslator):
     def __init__(self, builder, document, *args, **kwargs):
         HTMLTranslator.__init__(self, builder, document, *args, **kwargs)
         self._title = None  # section title
         self.parent = None
         self.add_to_toc = False
-        self.order = 0
         self.add_permalinks = False
         self.css = ['main.css']
-        self._images = set()
+        # results are collected here rather than added to the builder's
+        # ebook so documents can be translated in worker processes
+        self.chapters = []  # (title, html, add_to_toc) tuples
+        self.images = []  # (absolute path, book path) tuples
+        self.toc_page_at = None  # number of chapters before the toc page
         self.doc_path = document.attributes['source']
 
     def visit_compound(self, node):
         # print "COMPOUND", node
         # only adding items to table of contents if in toctree
         if 'toctree-wrapper' in node['classes']:
-            try:
-                self.builder.ebook.add_toc_page(order=self.next_order())
-            except AssertionError:
-                pass
+            if self.toc_page_at is None:
+                self.toc_page_at = len(self.chapters)
             self.add_to_toc = True
 
     def depart_compound(self, node):
         if 'toctree-wrapper' in node['classes']:
             self.add_to_toc = False
 
-    def next_order(self):
-        val = self.order
-        self.order += 1
-        return val
-
     def dispatch_visit(self, node):
         """
         Call self."``visit_`` + node class name" with `node` as
@@ -77,32 +91,11 @@ class MobiTranslator(HTMLTranslator):
     def create_chapter(self):
         body = ''.join(self.body)
         self.body = []
-        book = self.builder.ebook
-        # check for css overrides
-        css_pattern = \
-            '<link rel="stylesheet" href="{0}" type="text/css" media="all" />'
-        css = ''
-        for item in self.css:
-            css += css_pattern.format(os.path.basename(item)) + '\n'
-        css = css.rstrip()
-
-        src_css = os.path.join(os.path.dirname(rst2epub.epub.__file__),
-                               'templates', 'main.css')
-        dst_css = 'main.css'
-        book.add_css(src_css, dst_css)
-        src_path = ''
         if self._title is None:
-            print "NONE TITLE"
+            print("NONE TITLE")
             self._title = ''
-        dst_path = '{0}.html'.format(self.next_order())
-        html = rst2epub.XHTML_WRAPPER.format(body=body,
-                                             title=self._title,
-                                             css=css)
-        item = book.add_html(src_path, dst_path, html)
-        book.add_spine_item(item)
-        if self.add_to_toc:
-            book.add_toc_map_node(item.dest_path,
-                                  self._title)
+        html = chapter_html(body, self._title, self.css)
+        self.chapters.append((self._title, html, self.add_to_toc))
         self._title = None
         self.parent = None
 
@@ -110,18 +103,16 @@ class MobiTranslator(HTMLTranslator):
         return self.builder.get_output_data()
 
     def implement_me(self, *args):
-        print "FILL IN"
+        print("FILL IN")
 
     def visit_image(self, node):
         olduri = node['uri']
-        import pdb
-        pdb.set_trace()
         # rewrite the URI if the environment knows about it
         # if olduri in self.builder.images:
         #     node['uri'] = posixpath.join(self.builder.imgpath,
         #                                  self.builder.images[olduri])
         #                                  #import pdb; pdb.set_trace()
-        print "IMAGE!!!", node, node['uri'], os.path.abspath(node['uri'])
+        print("IMAGE!!!", node, node['uri'], os.path.abspath(node['uri']))
         if os.path.abspath(olduri) != olduri:
             pass
             # # relative
@@ -129,36 +120,33 @@ class MobiTranslator(HTMLTranslator):
             # print "COPYING TO", dest
             # olduri = os.path.join(os.path.dirname(self.doc_path),
             #                    dest)
-        self._images.add(os.path.abspath(olduri))
-        self.builder.ebook.add_image(os.path.abspath(olduri),
-                                     olduri,
-                                     id='image_{0}'.format(len(self._images)))
+        self.images.append((os.path.abspath(olduri), olduri))
         HTMLTranslator.visit_image(self, node)
 
     def visit_section(self, node):
-        print "\n\nSEC", self.section_level, str(node)[:120]
+        print("\n\nSEC", self.section_level, str(node)[:120])
         self.section_level += 1
 
     def depart_section(self, node):
         self.section_level -= 1
         if self.section_level <= int(self.builder.config.mobi_chapter_level):
-            print "CREATE CHAPTER"
+            print("CREATE CHAPTER")
             self.create_chapter()
 
     def depart_title(self, node):
         # print "--TITLE", node.text
         if not self._title:
             self._title = striptags(''.join(self.body[1:]))
-        print "\n\n**title", self.section_level, ''.join(self.body[1:])[:150]
+        print("\n\n**title", self.section_level, ''.join(self.body[1:])[:150])
         low_level = self.section_level \
             <= int(self.builder.config.mobi_chapter_level)
-        if node.parent.getattr('ids', False) and low_level:
-            print "TITLE", self.section_level, node.parent['ids'][0]
+        if node.parent.get('ids') and low_level:
+            print("TITLE", self.section_level, node.parent['ids'][0])
             self._title = striptags(''.join(self.body[1:]))
-            print "\t", str(node)[:50]
-            print "\tBODY", self.body[:4]
+            print("\t", str(node)[:50])
+            print("\tBODY", self.body[:4])
         else:
-            print "FALSE"
+            print("FALSE")
         HTMLTranslator.depart_title(self, node)
 
     depart_pending_xref = visit_pending_xref = implement_me
@@ -169,11 +157,77 @@ class MobiTranslator(HTMLTranslator):
     visit_start_of_file = no_op
 
 
+class DocumentTranslator(MobiTranslator):
+    """
+    Translates a single document for a parallel (``-j N``) build.
+
+    The serial build inlines every toctree into the master document, so
+    a chapter can start in one document and end in the next, and titles
+    are taken from the body collected since the last chapter.  Instead
+    of cutting chapters this only records, as (body position, event,
+    argument) tuples, where the serial translator would have cut a
+    chapter, taken a title, entered or left a toctree, pulled in the
+    included documents or seen an image.  MobiBuilder.replay_document
+    then plays the documents back in toctree order.  Runs in a worker
+    process, so everything it keeps must be picklable.
+    """
+
+    def __init__(self, builder, document, section_level=0):
+        MobiTranslator.__init__(self, builder, document)
+        # depth of the sections the serial build inlines this document in
+        self.section_level = section_level
+        self.events = []
+
+    def record(self, event, arg=None):
+        self.events.append((len(self.body), event, arg))
+
+    def create_chapter(self):
+        self.record('chapter')
+
+    def depart_title(self, node):
+        low_level = self.section_level \
+            <= int(self.builder.config.mobi_chapter_level)
+        self.record('title', bool(node.parent.get('ids')) and low_level)
+        HTMLTranslator.depart_title(self, node)
+
+    def visit_compound(self, node):
+        if 'toctree-wrapper' in node['classes']:
+            self.record('toctree-start')
+
+    def depart_compound(self, node):
+        if 'toctree-wrapper' in node['classes']:
+            self.record('toctree-end')
+
+    def visit_toctree(self, node):
+        self.record('include', list(node['includefiles']))
+        raise nodes.SkipNode
+
+    def visit_image(self, node):
+        self.record('image', (os.path.abspath(node['uri']), node['uri']))
+        HTMLTranslator.visit_image(self, node)
+
+
+class ReplayState(object):
+    """
+    what MobiTranslator carries from one document to the next
+    """
+
+    def __init__(self):
+        self.body = []
+        self.title = None
+        self.add_to_toc = False
+        self.chapters = []
+        self.images = []
+        self.toc_page_at = None
+
+
 class MobiBuilder(Builder):
     # basing off of latex since it seems more straightforward
     name = 'mobi'
     out_suffix = '.epub'
     add_permalinks = True
+    # documents are translated in worker processes with ``-j N``
+    allow_parallel = True
 
     def init(self):
         # note not dunder!
@@ -187,7 +241,16 @@ class MobiBuilder(Builder):
         self.document_data = []
         self.docnames = []
         self.secnumbers = {}
+        self.chapter_order = 0
+        self.image_paths = set()
         self.init_highlighter()
+        self.init_post_processor()
+
+    def init_post_processor(self):
+        self.post_processor = postprocess.PostProcessor(
+            timeout=self.config.mobi_post_process_timeout)
+        for command in self.config.mobi_post_process:
+            self.post_processor.register(command.split()[0], command)
 
     def do_dublin_core(self):
         for key in self.config.values:
@@ -199,7 +262,7 @@ class MobiBuilder(Builder):
                 if key in DC_ITEMS:
                     if key == 'title':
                         continue
-                    print "\t***ADDING", key, value
+                    print("\t***ADDING", key, value)
                     self.ebook.add_meta(key, value)
 
     def init_highlighter(self):
@@ -224,11 +287,20 @@ class MobiBuilder(Builder):
         # ignore source path
         return self.get_target_uri(to, typ)
 
-    def write(self, *ignored):
-        writer = MobiWriter(self)
-        docsettings = OptionParser(
+    def get_docsettings(self, writer):
+        return OptionParser(
             defaults=self.env.settings,
             components=(writer,)).get_default_values()
+
+    def get_target_path(self):
+        targetname = self.config.project + '.epub'
+        return os.path.join(self.outdir, targetname)
+
+    def write(self, *ignored):
+        if self.parallel_ok and self.app.parallel > 1:
+            return self.write_parallel(self.app.parallel)
+        writer = MobiWriter(self)
+        docsettings = self.get_docsettings(writer)
         doc_name = self.config.master_doc
         self.imgpath = relative_uri(self.get_target_uri(doc_name), '_images')
         tree = self.env.get_doctree(doc_name)
@@ -236,38 +308,192 @@ class MobiBuilder(Builder):
         tree = inline_all_toctrees(self, set(), master, tree, darkgreen)
         # copy images into self.images
         self.post_process_images(tree)
-        targetname = self.config.project + '.epub'
         tree.settings = docsettings
         writer.write(
             tree,
-            rst2epub.EpubFileOutput(
-                destination_path=os.path.join(self.outdir, targetname)))
+            rst2epub.EpubFileOutput(destination_path=self.get_target_path()))
+        # kindlegen etc. run in the background, see finish
+        self.post_processor.submit(self.get_target_path())
 
-    def get_output_data(self):
-        root_dir = '/tmp/mobiext'
-        self.ebook.create_book(root_dir)
-        book_name = root_dir + '.epub'
-        self.ebook.create_archive(root_dir, book_name)
+    def get_documents(self):
+        """
+        (docname, section depth, doctree) for every document reachable
+        from the master doc, in toctree order.  The depth is the number
+        of sections around the toctree that includes the document, ie the
+        section level the serial build translates it at.
+        """
+        documents = []
+        seen = set()
+
+        def collect(docname, depth):
+            if docname in seen:
+                return
+            seen.add(docname)
+            doctree = self.env.get_doctree(docname)
+            documents.append((docname, depth, doctree))
+            for toctree in doctree.traverse(addnodes.toctree):
+                level = depth
+                parent = toctree.parent
+                while parent is not None:
+                    if isinstance(parent, nodes.section):
+                        level += 1
+                    parent = parent.parent
+                for child in toctree['includefiles']:
+                    collect(child, level)
+        collect(self.config.master_doc, 0)
+        return documents
+
+    def translate_document(self, docname, depth, doctree):
+        """
+        translate a single document, returning its body and events (see
+        DocumentTranslator).  Runs in a worker process with ``-j N`` so
+        ``self.ebook`` must not be touched.
+        """
+        doctree.settings = self.docsettings
+        visitor = DocumentTranslator(self, doctree, depth)
+        doctree.walkabout(visitor)
+        return visitor.body, visitor.events
 
-        if book_name.endswith('.epub'):
-            import subprocess
-            cmd = "kindlegen2.4 {0}".format(book_name)
-            print "RUNNING", cmd
-            subprocess.call(cmd, shell=True)
+    def write_parallel(self, nproc):
+        """
+        translate each document in worker processes and put the book
+        together in toctree order, giving the same book as the serial
+        build
+        """
+        writer = MobiWriter(self)
+        self.docsettings = self.get_docsettings(writer)
+        self.imgpath = relative_uri(
+            self.get_target_uri(self.config.master_doc), '_images')
+        documents = self.get_documents()
+        results = {}
+
+        def translate_chunk(docs):
+            return [(docname, self.translate_document(docname, depth, tree))
+                    for docname, depth, tree in docs]
+
+        def on_chunk_done(docs, chunk_results):
+            for docname, result in chunk_results:
+                results[docname] = result
+
+        tasks = ParallelTasks(nproc)
+        for chunk in make_chunks(documents, nproc):
+            for docname, depth, doctree in chunk:
+                self.post_process_images(doctree)
+            tasks.add_task(translate_chunk, chunk, on_chunk_done)
+        tasks.join()
+
+        state = ReplayState()
+        self.replay_document(self.config.master_doc, results, state)
+        self.merge_document(state.chapters, state.images, state.toc_page_at)
+        output = rst2epub.EpubFileOutput(
+            destination_path=self.get_target_path())
+        output.write(self.get_output_data())
+        self.post_processor.submit(self.get_target_path())
+
+    def replay_document(self, docname, results, state):
+        """
+        play back the body and events of `docname` into `state`, the way
+        MobiTranslator builds chapters while walking the inlined tree
+        """
+        if docname not in results:
+            # the serial build warns and skips documents it can't read
+            return
+        body, events = results[docname]
+        pos = 0
+        for at, event, arg in events:
+            state.body.extend(body[pos:at])
+            pos = at
+            if event == 'chapter':
+                title = state.title or ''
+                html = chapter_html(''.join(state.body), title, ['main.css'])
+                state.chapters.append((title, html, state.add_to_toc))
+                state.body = []
+                state.title = None
+            elif event == 'title':
+                if not state.title or arg:
+                    state.title = striptags(''.join(state.body[1:]))
+            elif event == 'toctree-start':
+                if state.toc_page_at is None:
+                    state.toc_page_at = len(state.chapters)
+                state.add_to_toc = True
+            elif event == 'toctree-end':
+                state.add_to_toc = False
+            elif event == 'include':
+                for child in arg:
+                    self.replay_document(child, results, state)
+            elif event == 'image':
+                state.images.append(arg)
+        state.body.extend(body[pos:])
+
+    def merge_document(self, chapters, images, toc_page_at):
+        """
+        add the results of translating a document to ``self.ebook``
+        """
+        book = self.ebook
+        src_css = os.path.join(os.path.dirname(rst2epub.epub.__file__),
+                               'templates', 'main.css')
+        book.add_css(src_css, 'main.css')
+        for i, (title, html, add_to_toc) in enumerate(chapters):
+            if i == toc_page_at:
+                self.add_toc_page()
+            dst_path = '{0}.html'.format(self.next_chapter_order())
+            item = book.add_html('', dst_path, html)
+            book.add_spine_item(item)
+            if add_to_toc:
+                book.add_toc_map_node(item.dest_path, title)
+        if toc_page_at is not None and toc_page_at >= len(chapters):
+            self.add_toc_page()
+        for abs_path, uri in images:
+            if abs_path in self.image_paths:
+                continue
+            self.image_paths.add(abs_path)
+            book.add_image(abs_path, uri,
+                           id='image_{0}'.format(len(self.image_paths)))
 
-        return open(root_dir + '.epub').read()
+    def next_chapter_order(self):
+        val = self.chapter_order
+        self.chapter_order += 1
+        return val
+
+    def add_toc_page(self):
+        # only the first toctree gets a page
+        if self.ebook.toc_page is None:
+            self.ebook.add_toc_page(order=self.ebook.next_order())
+
+    def get_output_data(self):
+        # a workspace of its own, concurrent builds used to share
+        # /tmp/mobiext
+        quota = self.config.mobi_workspace_quota
+        with workspace.Workspace(
+                root=self.config.mobi_workspace_dir, prefix='mobiext-',
+                quota=quota and quota * 1024 * 1024) as ws:
+            root_dir = os.path.join(ws.path, 'epub')
+            self.ebook.on_write = ws.add_file
+            self.ebook.create_book(root_dir)
+            ws.check()
+            self.ebook.create_archive(root_dir, root_dir + '.epub',
+                                      on_progress=ws.check_writing)
+            ws.check()
+            with open(root_dir + '.epub', 'rb') as fin:
+                return fin.read()
 
     def finish(self):
         # copy image files
         if self.images:
             self.info(bold('copying images...'), nonl=1)
-            for src, dest in self.images.iteritems():
+            for src, dest in self.images.items():
                 self.info(' '+src, nonl=1)
                 dest_file = os.path.join(self.outdir, dest)
                 copyfile(os.path.join(self.srcdir, src),
                          dest_file)
             self.info()
-        print "FIN"
+        results = self.post_processor.wait()
+        for result in results:
+            status = 'ok' if result.ok else 'failed'
+            self.info(bold('post process %s: ' % result.name) + status)
+            if not result.ok:
+                self.warn(result.output)
+        print("FIN")
 
 
 def setup(app):
@@ -277,5 +503,14 @@ def setup(app):
     app.add_config_value('mobi_cover', None, None)
     # chapter level is depth at which new chapters are created
     app.add_config_value('mobi_chapter_level', 2, None)
+    # commands run on the finished epub, {epub} is replaced by its path
+    app.add_config_value('mobi_post_process', ['kindlegen2.4 {epub}'], None)
+    app.add_config_value('mobi_post_process_timeout', 600, None)
+    # where build workspaces are made (eg a tmpfs), default the temp dir
+    app.add_config_value('mobi_workspace_dir', None, None)
+    # MB a build workspace may hold
+    app.add_config_value('mobi_workspace_quota', None, None)
     for name in DC_ITEMS:
         app.add_config_value('mobi_'+name, None, None)
+    return {'parallel_read_safe': True,
+            'parallel_write_safe': True}
@@ -0,0 +1,104 @@
+import asyncio
+import functools
+import io
+import os
+import threading
+import zipfile
+
+import pytest
+
+import rst2epub
+from epublib import aio
+from epublib.epub import EpubBook
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SAMPLE = os.path.join(ROOT, "sample", "sample.rst")
+
+
+def sample_book():
+    with open(SAMPLE, "rb") as fin:
+        text = fin.read().decode("utf-8-sig")
+    return functools.partial(
+        rst2epub.build_book, text, base_dir=os.path.dirname(SAMPLE)
+    )
+
+
+def collect(make_book, **kw):
+    async def read():
+        return [chunk async for chunk in aio.iter_epub(make_book, **kw)]
+
+    return asyncio.run(read())
+
+
+def test_archive_stream_matches_file(tmp_path):
+    root_dir = str(tmp_path / "epub")
+    for name in ("META-INF/container.xml", "OEBPS/a.html"):
+        os.makedirs(os.path.dirname(os.path.join(root_dir, name)), exist_ok=True)
+        with open(os.path.join(root_dir, name), "w") as fout:
+            fout.write(name * 1000)
+    with open(os.path.join(root_dir, "OEBPS", "content.opf"), "w") as fout:
+        fout.write(
+            '<package xmlns="http://www.idpf.org/2007/opf"><manifest>'
+            '<item href="a.html"/></manifest></package>'
+        )
+    expected = io.BytesIO()
+    EpubBook.create_archive(root_dir, expected)
+    sent = []
+    stream = aio.ArchiveStream(sent.append)
+    with zipfile.ZipFile(stream, "w") as fout:
+        EpubBook.add_mimetype(fout)
+        stream.commit()
+        EpubBook.add_archive_members(fout, root_dir, on_member=stream.commit)
+    stream.commit()
+    # one send per member plus the central directory
+    assert len(sent) == 5
+    assert b"".join(sent) == expected.getvalue()
+
+
+def test_iter_epub():
+    chunks = collect(sample_book(), chunk_size=1024)
+    assert max(len(chunk) for chunk in chunks) <= 1024
+    with zipfile.ZipFile(io.BytesIO(b"".join(chunks))) as book:
+        assert book.testzip() is None
+        assert book.namelist()[0] == "mimetype"
+        assert book.read("mimetype") == b"application/epub+zip"
+        assert "OEBPS/2.html" in book.namelist()
+
+
+def test_iter_epub_streams_before_translation():
+    make_book = sample_book()
+    started = threading.Event()
+
+    def slow_book():
+        # only translate once the first bytes have reached the reader
+        assert started.wait(10)
+        return make_book()
+
+    async def read():
+        chunks = []
+        async for chunk in aio.iter_epub(slow_book):
+            chunks.append(chunk)
+            started.set()
+        return chunks
+
+    chunks = asyncio.run(read())
+    assert b"mimetypeapplication/epub+zip" in chunks[0]
+    zipfile.ZipFile(io.BytesIO(b"".join(chunks))).testzip()
+
+
+def test_iter_epub_errors():
+    def broken():
+        raise RuntimeError("bad book")
+
+    with pytest.raises(RuntimeError):
+        collect(broken)
+
+
+def test_iter_epub_close_early():
+    async def read():
+        chunks = aio.iter_epub(sample_book(), chunk_size=64, queue_size=1)
+        first = await chunks.__anext__()
+        await chunks.aclose()
+        return first
+
+    assert asyncio.run(read()).startswith(b"PK")
@@ -0,0 +1,74 @@
+import os
+import shutil
+import tempfile
+
+from PIL import Image
+
+from epublib import crops, util
+
+
+def setup_dirs():
+    tmp_dir = tempfile.mkdtemp()
+    src_path = os.path.join(tmp_dir, "page.png")
+    img = Image.new("RGB", (200, 100), "white")
+    img.paste((255, 0, 0), (0, 0, 100, 50))
+    img.save(src_path)
+    return tmp_dir, src_path
+
+
+def test_render_crops():
+    tmp_dir, src_path = setup_dirs()
+    cache_dir = os.path.join(tmp_dir, "cache")
+    try:
+        regions = [((0, 0, 50, 50), (40, 20)), ((50, 50, 50, 50), (10, 10))]
+        paths = crops.render_crops(src_path, regions, cache_dir)
+        with Image.open(paths[0]) as img:
+            assert img.size == (40, 20)
+            assert img.getpixel((20, 10)) == (255, 0, 0)
+        with Image.open(paths[1]) as img:
+            assert img.size == (10, 10)
+            assert img.getpixel((5, 5)) == (255, 255, 255)
+        assert sorted(os.listdir(cache_dir)) == sorted(
+            os.path.basename(path) for path in paths
+        )
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_render_crops_uses_cache():
+    tmp_dir, src_path = setup_dirs()
+    cache_dir = os.path.join(tmp_dir, "cache")
+    try:
+        regions = [((0, 0, 50, 50), (40, 20))]
+        path = crops.render_crops(src_path, regions, cache_dir)[0]
+        with open(path, "wb") as fout:
+            fout.write(b"cached")
+        assert crops.render_crops(src_path, regions, cache_dir) == [path]
+        with open(path, "rb") as fin:
+            assert fin.read() == b"cached"
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_render_crops_many():
+    tmp_dir, src_path = setup_dirs()
+    cache_dir = os.path.join(tmp_dir, "cache")
+    try:
+        jobs = [
+            (src_path, [((0, 0, 50, 50), (40, 20))]),
+            (src_path, [((50, 0, 50, 50), (40, 20))]),
+        ]
+        assert crops.render_crops_many(jobs, processes=2, cache_dir=cache_dir) == [
+            crops.render_crops(src_path, regions, cache_dir)
+            for src_path, regions in jobs
+        ]
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_cache_dir(monkeypatch):
+    monkeypatch.delenv(util.CACHE_ENV, raising=False)
+    assert util.cache_dir("c") == os.path.join(tempfile.gettempdir(), "c")
+    monkeypatch.setenv(util.CACHE_ENV, "/var/cache/epublib")
+    assert util.cache_dir("c") == "/var/cache/epublib/c"
+    assert util.cache_dir("c", "/build") == "/build/c"
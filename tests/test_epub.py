@@ -0,0 +1,69 @@
+import io
+import os
+
+from epublib import epub
+
+
+def make_book(chapters=10):
+    book = epub.EpubBook()
+    book.set_title("Book")
+    book.add_toc_page()
+    for i in range(chapters):
+        dest = "{0}.html".format(i)
+        book.add_spine_item(book.add_html("", dest, "<p/>"))
+        node = book.add_toc_map_node(dest, "Chapter {0}".format(i))
+        book.add_toc_map_node(dest + "#a", "Section {0}".format(i), parent=node)
+    return book
+
+
+def read(book, name):
+    with io.open(os.path.join(book.root_dir, "OEBPS", name), encoding="utf8") as fin:
+        return fin.read()
+
+
+def test_toc_entries():
+    book = make_book(2)
+    titles = [node.title for node in book.get_toc_entries()]
+    assert titles == ["Chapter 0", "Section 0", "Chapter 1", "Section 1"]
+    assert [node.title for node in book.get_toc_entries(1)] == [
+        "Chapter 0",
+        "Chapter 1",
+    ]
+
+
+def test_toc_page_unsplit(tmp_path):
+    book = make_book()
+    book.create_book(str(tmp_path))
+    html = read(book, "toc.html")
+    assert html.count("tocEntry-") == 20
+    assert "tocNav" not in html
+    assert not os.path.exists(os.path.join(book.root_dir, "OEBPS", "toc-2.html"))
+
+
+def test_toc_page_entries(tmp_path):
+    book = make_book()
+    book.toc_page_entries = 8
+    book.create_book(str(tmp_path))
+    pages = ["toc.html", "toc-2.html", "toc-3.html"]
+    assert [read(book, page).count("tocEntry-") for page in pages] == [8, 8, 4]
+    assert 'href="toc-2.html">Next page' in read(book, "toc.html")
+    assert 'href="toc.html">Previous page' in read(book, "toc-2.html")
+    assert 'href="toc-3.html">Next page' in read(book, "toc-2.html")
+    assert "Next page" not in read(book, "toc-3.html")
+    # the pages follow each other in the spine, before the chapters
+    spine = [item.dest_path for _, item, _ in book.get_spine()]
+    assert spine[:4] == pages + ["0.html"]
+    opf = read(book, "content.opf")
+    assert opf.count('href="toc-') == 2
+
+
+def test_toc_page_bytes_and_depth(tmp_path):
+    book = make_book()
+    book.toc_page_depth = 1
+    book.toc_page_bytes = 300
+    book.create_book(str(tmp_path))
+    html = read(book, "toc.html")
+    assert "Section" not in html
+    assert 1 < html.count("tocEntry-1") < 10
+    # the ncx still has every entry
+    assert read(book, "toc.ncx").count("<navPoint") == 20
@@ -0,0 +1,86 @@
+import os
+import shutil
+import string
+import tempfile
+
+from fontTools.fontBuilder import FontBuilder
+from fontTools.pens.ttGlyphPen import TTGlyphPen
+from fontTools.ttLib import TTFont
+
+import rst2epub
+from epublib import fonts
+
+
+def make_font(path, chars=string.ascii_letters):
+    """
+    a minimal truetype font with a square glyph for each of `chars`
+    """
+    names = [".notdef"] + ["g{0}".format(ord(char)) for char in chars]
+    pen = TTGlyphPen(None)
+    pen.moveTo((0, 0))
+    pen.lineTo((0, 500))
+    pen.lineTo((500, 500))
+    pen.closePath()
+    glyph = pen.glyph()
+    builder = FontBuilder(1000, isTTF=True)
+    builder.setupGlyphOrder(names)
+    builder.setupCharacterMap(dict((ord(char), "g{0}".format(ord(char))) for char in chars))
+    builder.setupGlyf(dict((name, glyph) for name in names))
+    builder.setupHorizontalMetrics(dict((name, (600, 0)) for name in names))
+    builder.setupHorizontalHeader(ascent=800, descent=-200)
+    builder.setupNameTable({"familyName": "Test", "styleName": "Regular"})
+    builder.setupOS2()
+    builder.setupPost()
+    builder.save(path)
+
+
+def cmap_chars(path):
+    font = TTFont(path)
+    try:
+        return set(chr(code) for code in font.getBestCmap())
+    finally:
+        font.close()
+
+
+def test_html_chars_adds_case_forms():
+    chars = fonts.html_chars('<p class="first">Code &amp; more</p>')
+    assert set("Codemr&").issubset(chars)
+    # small-caps renders the lower case letters as capitals
+    assert set("CODEMR").issubset(chars)
+    assert "p" not in chars
+
+
+def test_subset_font():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        font_path = os.path.join(tmp_dir, "test.ttf")
+        make_font(font_path)
+        cache_dir = os.path.join(tmp_dir, "cache")
+        chars = fonts.html_chars("<p>Cab</p>")
+        path = fonts.subset_font(font_path, chars, cache_dir)
+        assert cmap_chars(path) == set("CABcab")
+        assert os.listdir(cache_dir) == [os.path.basename(path)]
+        # cached
+        assert fonts.subset_font(font_path, chars, cache_dir) == path
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_subset_fonts():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        paths = [os.path.join(tmp_dir, name) for name in ("a.ttf", "b.ttf")]
+        make_font(paths[0])
+        make_font(paths[1], string.ascii_lowercase)
+        cache_dir = os.path.join(tmp_dir, "cache")
+        subsets = fonts.subset_fonts(paths, set("aZ"), processes=2, cache_dir=cache_dir)
+        assert [cmap_chars(path) for path in subsets] == [set("aZ"), set("a")]
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_cache_dir_setting():
+    book = rst2epub.build_book("Title\n=====\n", options={"cache_dir": "/build"})
+    assert book.font_cache_dir == os.path.join("/build", fonts.CACHE_NAME)
+    book = rst2epub.build_book("Title\n=====\n")
+    assert book.font_cache_dir == fonts.DEFAULT_CACHE_DIR
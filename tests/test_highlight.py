@@ -0,0 +1,79 @@
+import io
+import os
+import zipfile
+
+import pytest
+
+import rst2epub
+from epublib import highlight
+
+pytest.importorskip("pygments")
+
+DOC = """\
+Intro
+=====
+
+text
+
+Code
+====
+
+.. code:: python
+
+   def f(x):
+       return x < 1
+
+.. code:: nosuchlang
+
+   plain
+"""
+
+
+def test_highlight_code_cached(tmp_path, monkeypatch):
+    cache_dir = str(tmp_path)
+    html = highlight.highlight_code("x = 1\n", "python", cache_dir)
+    assert '<span class="n">x</span>' in html
+    assert not html.endswith("\n")
+    # the second call reads the cache and doesn't need pygments
+    monkeypatch.setattr(highlight.pygments, "highlight", None)
+    assert highlight.highlight_code("x = 1\n", "python", cache_dir) == html
+
+
+def test_highlight_unknown_language(tmp_path):
+    assert highlight.highlight_code("x", "nosuchlang", str(tmp_path)) is None
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_highlight_many(tmp_path, monkeypatch):
+    monkeypatch.setattr(highlight, "POOL_MIN_BLOCKS", 2)
+    blocks = [("a = {0}\n".format(i), "python") for i in range(3)]
+    blocks.append(("plain", "nosuchlang"))
+    result = highlight.highlight_many(blocks * 2, 2, str(tmp_path))
+    assert len(result) == 4
+    assert result[("plain", "nosuchlang")] is None
+    assert '<span class="mi">2</span>' in result[("a = 2\n", "python")]
+
+
+def test_stylesheet_scoped(tmp_path):
+    path = highlight.stylesheet("default", str(tmp_path))
+    with io.open(path, encoding="utf8") as fin:
+        lines = fin.read().splitlines()
+    assert lines
+    assert all(line.startswith("div.highlight") for line in lines)
+    assert highlight.stylesheet("default", str(tmp_path)) == path
+
+
+def test_build_highlight(tmp_path):
+    cache_dir = tmp_path / "cache"
+    options = {"highlight": True, "cache_dir": str(cache_dir)}
+    data = rst2epub.build(DOC, base_dir=str(tmp_path), options=options)
+    with zipfile.ZipFile(io.BytesIO(data)) as book:
+        chapter = book.read("OEBPS/2.html").decode("utf8")
+        assert "OEBPS/highlight-default.css" in book.namelist()
+    assert "highlight-default.css" in chapter
+    assert '<div class="highlight">' in chapter
+    assert '<span class="k">def</span>' in chapter
+    # unknown languages are left as they were
+    assert "plain" in chapter and "nosuchlang" in chapter
+    # the cache is where the setting says
+    assert os.listdir(str(cache_dir)) == [highlight.CACHE_NAME]
@@ -0,0 +1,107 @@
+import io
+import os
+import zipfile
+
+import rst2epub
+from epublib import mathrender
+
+DOC = r"""Intro
+=====
+
+text
+
+Math
+====
+
+Inline :math:`\frac{a}{b}` here.
+
+.. math::
+
+   \sum_{i=1}^n i
+
+Bad :math:`\frac{a}` one.
+"""
+
+
+def test_render_cached(tmp_path, monkeypatch):
+    cache_dir = str(tmp_path)
+    result = mathrender.render(r"\frac{a}{b}", False, 150, cache_dir)
+    assert "<mfrac>" in result["mathml"]
+    assert 'display="block"' in mathrender.render("x", True, 150, cache_dir)["mathml"]
+
+    def fail(tex, block):
+        raise AssertionError("not cached")
+
+    monkeypatch.setattr(mathrender, "to_mathml", fail)
+    assert mathrender.render(r"\frac{a}{b}", False, 150, cache_dir) == result
+
+
+def test_render_error(tmp_path):
+    result = mathrender.render(r"\frac{a}", False, 150, str(tmp_path))
+    assert result["mathml"] is None
+    assert result["errors"]
+    assert mathrender.render(r"\frac{a}", False, 150, str(tmp_path)) == result
+
+
+def fake_image(tex, path, dpi):
+    with open(path, "wb") as fout:
+        fout.write(b"\x89PNG fake")
+
+
+def test_render_image(tmp_path, monkeypatch):
+    class FakeMatplotlib(object):
+        __version__ = "test"
+
+    monkeypatch.setattr(mathrender, "matplotlib", FakeMatplotlib())
+    monkeypatch.setattr(mathrender, "render_image", fake_image)
+    cache_dir = str(tmp_path / "cache")
+    result = mathrender.render("x^2", False, 150, cache_dir)
+    assert os.path.dirname(result["image"]) == cache_dir
+    # the cache can be moved
+    os.rename(cache_dir, str(tmp_path / "moved"))
+    moved = mathrender.render("x^2", False, 150, str(tmp_path / "moved"))
+    assert os.path.exists(moved["image"])
+
+
+def test_render_many(tmp_path, monkeypatch):
+    monkeypatch.setattr(mathrender, "POOL_MIN_EXPRESSIONS", 2)
+    expressions = [("x_{0}".format(i), False) for i in range(3)] * 2
+    result = mathrender.render_many(expressions, 2, 150, str(tmp_path))
+    assert sorted(result) == sorted(set(expressions))
+    assert "<msub>" in result[("x_2", False)]["mathml"]
+
+
+def test_build_math(tmp_path, monkeypatch):
+    class FakeMatplotlib(object):
+        __version__ = "test"
+
+    monkeypatch.setattr(mathrender, "matplotlib", FakeMatplotlib())
+    monkeypatch.setattr(mathrender, "render_image", fake_image)
+    cache_dir = tmp_path / "cache"
+    options = {"render_math": True, "cache_dir": str(cache_dir)}
+    data = rst2epub.build(DOC, base_dir=str(tmp_path), options=options)
+    with zipfile.ZipFile(io.BytesIO(data)) as book:
+        chapter = book.read("OEBPS/2.html").decode("utf8")
+        images = [name for name in book.namelist() if name.startswith("OEBPS/math/")]
+    assert len(images) == 3
+    assert chapter.count("<ops:switch") == 2
+    assert '<div class="math">' in chapter
+    assert "<mfrac>" in chapter
+    assert '<ops:default><img alt="\\frac{a}{b}" src="math/' in chapter
+    # no MathML, only the image
+    assert '<span class="math"><img alt="\\frac{a}"' in chapter
+    assert os.listdir(str(cache_dir)) == [mathrender.CACHE_NAME]
+
+
+def test_build_math_off(monkeypatch):
+    def fail(*args, **kw):
+        raise AssertionError("math rendered")
+
+    monkeypatch.setattr(mathrender, "render_many", fail)
+    data = rst2epub.build(DOC)
+    with zipfile.ZipFile(io.BytesIO(data)) as book:
+        chapter = book.read("OEBPS/2.html").decode("utf8")
+        assert not any(name.startswith("OEBPS/math/") for name in book.namelist())
+    # the html writer's own output
+    assert "ops:switch" not in chapter
+    assert '<div class="formula">' in chapter
@@ -0,0 +1,54 @@
+import random
+
+from epublib import mobi
+
+FIELDS = mobi.MagRegions.INT_FIELDS + ("target_id", "img_src", "zoom_factor")
+
+
+def regions(page):
+    return [tuple(getattr(mag, name) for name in FIELDS) for mag in page]
+
+
+def new_page():
+    book = mobi.MobiComicBook()
+    page = book.add_page()
+    page.add_bg_image("page.jpg", "page.jpg")
+    return page
+
+
+def test_add_regions_matches_auto_target():
+    rand = random.Random(42)
+    for _ in range(300):
+        rects = []
+        for _ in range(rand.randint(1, 4)):
+            left = rand.uniform(0, 90)
+            top = rand.uniform(0, 90)
+            rects.append(
+                (left, top, rand.uniform(1, 100 - left), rand.uniform(1, 100 - top))
+            )
+        zoom_factor = rand.choice([1.5, 2, 3])
+        batched = new_page()
+        batched.add_regions(rects, zoom_factor=zoom_factor)
+        single = new_page()
+        for rect in rects:
+            single.auto_target(*rect, zoom_factor=zoom_factor)
+        assert regions(batched) == regions(single)
+
+
+def test_grid_rects():
+    assert mobi.grid_rects(2, 2) == [
+        (0, 0, 50.0, 50.0),
+        (50.0, 0, 50.0, 50.0),
+        (0, 50.0, 50.0, 50.0),
+        (50.0, 50.0, 50.0, 50.0),
+    ]
+
+
+def test_set_crop():
+    page = new_page()
+    page.add_grid(1, 2)
+    page.mags.set_crop(1, "crops/a.jpg")
+    assert [(mag.img_src, mag.cropped) for mag in page] == [
+        ("page.jpg", False),
+        ("crops/a.jpg", True),
+    ]
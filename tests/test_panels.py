@@ -0,0 +1,51 @@
+import os
+import shutil
+import tempfile
+
+import numpy as np
+from PIL import Image
+
+from epublib import panels
+
+
+def make_page(boxes, shape=(200, 100)):
+    """
+    white page with black (left, top, right, bottom) pixel boxes
+    """
+    pixels = np.full(shape, 255, dtype=np.uint8)
+    for left, top, right, bottom in boxes:
+        pixels[top:bottom, left:right] = 0
+    return pixels
+
+
+def test_find_panels():
+    pixels = make_page([(10, 10, 45, 90), (55, 10, 90, 90), (10, 110, 90, 190)])
+    assert panels.find_panels(pixels) == [
+        (10.0, 5.0, 35.0, 40.0),
+        (55.0, 5.0, 35.0, 40.0),
+        (10.0, 55.0, 80.0, 40.0),
+    ]
+
+
+def test_find_panels_drops_specks():
+    pixels = make_page([(10, 10, 90, 190), (95, 195, 97, 197)])
+    assert panels.find_panels(pixels) == [(10.0, 5.0, 80.0, 90.0)]
+
+
+def test_detect_panels_many():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        pages = [
+            make_page([(10, 10, 90, 190)]),
+            make_page([(10, 10, 45, 190), (55, 10, 90, 190)]),
+        ]
+        paths = []
+        for i, pixels in enumerate(pages):
+            path = os.path.join(tmp_dir, "{0}.png".format(i))
+            Image.fromarray(pixels).save(path)
+            paths.append(path)
+        assert panels.detect_panels_many(paths, processes=2) == [
+            panels.find_panels(pixels) for pixels in pages
+        ]
+    finally:
+        shutil.rmtree(tmp_dir)
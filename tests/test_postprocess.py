@@ -0,0 +1,113 @@
+import os
+import subprocess
+import sys
+import tempfile
+
+from epublib import postprocess
+from epublib.epub import EpubBook
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SAMPLE = os.path.join(ROOT, "sample", "sample.rst")
+
+
+def test_run_command():
+    result = postprocess.run_command("echo", "echo {epub} {}", "book.epub")
+    assert result.ok
+    assert result.output == "book.epub {}\n"
+
+
+def test_run_command_failure():
+    result = postprocess.run_command("false", ["false", "{epub}"], "book.epub")
+    assert not result.ok
+    assert result.returncode == 1
+
+
+def test_run_command_missing():
+    result = postprocess.run_command("missing", "no-such-command {epub}", "book.epub")
+    assert not result.ok
+    assert result.returncode is None
+
+
+def test_run_command_timeout():
+    result = postprocess.run_command("sleep", "sleep 10", "book.epub", timeout=0.2)
+    assert result.timed_out
+    assert not result.ok
+    assert result.elapsed < 5
+
+
+def test_post_processor():
+    processor = postprocess.PostProcessor(max_workers=2, timeout=0.5)
+    processor.register("true", "true {epub}")
+    processor.register("false", "false {epub}")
+    processor.register("sleep", "sleep 10")
+    processor.submit("a.epub")
+    processor.submit("b.epub")
+    results = processor.wait()
+    assert [(result.name, result.epub_path, result.ok) for result in results] == [
+        ("true", "a.epub", True),
+        ("false", "a.epub", False),
+        ("sleep", "a.epub", False),
+        ("true", "b.epub", True),
+        ("false", "b.epub", False),
+        ("sleep", "b.epub", False),
+    ]
+    assert [result.timed_out for result in results if result.name == "sleep"] == [
+        True,
+        True,
+    ]
+    assert processor.wait() == []
+
+
+def test_submit_command():
+    processor = postprocess.PostProcessor(timeout=0.5)
+    processor.register("true", "true {epub}")
+    processor.submit_command("sleep", "sleep 10", "a.epub")
+    processor.submit("a.epub")
+    results = processor.wait()
+    assert [(result.name, result.ok) for result in results] == [
+        ("sleep", False),
+        ("true", True),
+    ]
+    assert results[0].timed_out
+
+
+def test_check_epub(monkeypatch):
+    commands = []
+
+    def run_command(name, command, epub_path, timeout=None):
+        commands.append((name, command, epub_path, timeout))
+        return postprocess.JobResult(name, epub_path, 0, "", 0)
+
+    monkeypatch.setattr(postprocess, "run_command", run_command)
+    assert EpubBook.check_epub("epubcheck.jar", "a.epub", timeout=5).ok
+    processor = postprocess.PostProcessor(timeout=60)
+    assert EpubBook.check_epub("epubcheck.jar", "b.epub", processor) is None
+    assert [result.epub_path for result in processor.wait()] == ["b.epub"]
+    assert commands == [
+        ("epubcheck", ["java", "-jar", "epubcheck.jar", "{epub}"], "a.epub", 5),
+        ("epubcheck", ["java", "-jar", "epubcheck.jar", "{epub}"], "b.epub", 60),
+    ]
+
+
+def run_rst2epub(*args):
+    fd, dest = tempfile.mkstemp(suffix=".epub")
+    os.close(fd)
+    try:
+        with open(os.devnull, "w") as devnull:
+            return subprocess.call(
+                [sys.executable, os.path.join(ROOT, "rst2epub.py")]
+                + list(args)
+                + [SAMPLE, dest],
+                stdout=devnull,
+                stderr=subprocess.STDOUT,
+            )
+    finally:
+        os.remove(dest)
+
+
+def test_exit_status():
+    assert run_rst2epub("--post-process", "true {epub}") == 0
+    assert run_rst2epub("--post-process", "true {epub}", "--post-process", "false") == 1
+    assert (
+        run_rst2epub("--post-process", "sleep 10", "--post-process-timeout", "1") == 1
+    )
@@ -0,0 +1,68 @@
+import io
+import json
+import os
+import subprocess
+import sys
+import zipfile
+
+import rst2epub
+from epublib import report
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SAMPLE = os.path.join(ROOT, "sample", "sample.rst")
+
+
+def test_inspect_epub(tmp_path):
+    path = str(tmp_path / "book.epub")
+    with open(path, "wb") as fout:
+        rst2epub.build_file(SAMPLE, stream=fout)
+    rows = report.inspect_epub(path, budget=50 * 1024)
+    names = [row["name"] for row in rows]
+    # spine first, then the rest of the manifest, then everything else
+    assert names[:4] == [
+        "OEBPS/cover.html",
+        "OEBPS/title-page.html",
+        "OEBPS/toc.html",
+        "OEBPS/2.html",
+    ]
+    assert names[-3:] == ["mimetype", "META-INF/container.xml", "OEBPS/content.opf"]
+    by_name = dict((row["name"], row) for row in rows)
+    chapter = by_name["OEBPS/2.html"]
+    assert chapter["kind"] == "chapter"
+    assert chapter["section"] == "Using rst for Books"
+    assert chapter["spine"] == 3
+    with zipfile.ZipFile(path) as book:
+        info = book.getinfo("OEBPS/cover.png")
+    cover = by_name["OEBPS/cover.png"]
+    assert (cover["compressed"], cover["size"]) == (info.compress_size, info.file_size)
+    assert cover["kind"] == "image" and cover["spine"] is None
+    assert [row["name"] for row in rows if row["over_budget"]] == ["OEBPS/cover.png"]
+    text = report.format_report(rows)
+    assert "OEBPS/cover.png  OVER BUDGET" in text
+    assert "1 over budget: OEBPS/cover.png" in text
+
+
+def test_size_report(tmp_path):
+    dest = str(tmp_path / "book.epub")
+    size_report = str(tmp_path / "report.json")
+    args = ["--size-report", size_report, "--size-budget", "50", SAMPLE, dest]
+    with open(os.devnull, "w") as devnull:
+        assert subprocess.call(
+            [sys.executable, os.path.join(ROOT, "rst2epub.py")] + args, stdout=devnull
+        ) == 0
+    with io.open(size_report, encoding="utf8") as fin:
+        rows = json.load(fin)
+    chapter = [row for row in rows if row["name"] == "OEBPS/2.html"][0]
+    # the title line of the first chapter in the source
+    assert chapter["source"] == SAMPLE + ":46"
+    out = subprocess.check_output(
+        [sys.executable, os.path.join(ROOT, "rst2epub.py"), "inspect", "--json"]
+        + [dest]
+    )
+    assert json.loads(out.decode("utf8"))["members"][0]["name"] == "OEBPS/cover.html"
+    status = subprocess.call(
+        [sys.executable, os.path.join(ROOT, "rst2epub.py"), "inspect"]
+        + ["--budget", "50", dest],
+        stdout=subprocess.PIPE,
+    )
+    assert status == 1
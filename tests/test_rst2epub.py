@@ -0,0 +1,240 @@
+import io
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import zipfile
+
+import pytest
+
+import rst2epub
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SAMPLE = os.path.join(ROOT, "sample", "sample.rst")
+
+
+def run(args):
+    with open(os.devnull, "w") as devnull:
+        return subprocess.call(
+            [sys.executable, os.path.join(ROOT, "rst2epub.py")] + args,
+            stdout=devnull,
+            stderr=subprocess.STDOUT,
+        )
+
+
+def test_validate_targets():
+    assert rst2epub.validate_targets("target", ["html:a.html", "epub:b.epub"]) == [
+        "html:a.html",
+        "epub:b.epub",
+    ]
+    assert rst2epub.validate_targets("html:a.html, epub:b.epub") == [
+        "html:a.html",
+        "epub:b.epub",
+    ]
+    for bad in ("pdf:a.pdf", "html", "html:"):
+        with pytest.raises(ValueError):
+            rst2epub.validate_targets("target", [bad])
+
+
+def test_targets():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        html = os.path.join(tmp_dir, "book.html")
+        copy = os.path.join(tmp_dir, "copy.epub")
+        dest = os.path.join(tmp_dir, "book.epub")
+        args = ["--target", "html:" + html, "--target", "epub:" + copy]
+        assert run(args + [SAMPLE, dest]) == 0
+        assert "<title>Example rst2epub2.py Book</title>" in open(html).read()
+        with zipfile.ZipFile(copy) as first, zipfile.ZipFile(dest) as second:
+            assert first.namelist() == second.namelist()
+            assert first.read("OEBPS/2.html") == second.read("OEBPS/2.html")
+        # usage error rather than a traceback
+        assert run(["--target", "pdf:" + html, SAMPLE, dest]) == 2
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_targets_exit_status():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        source = os.path.join(tmp_dir, "bad.rst")
+        with open(source, "w") as fout:
+            fout.write("Title\n=====\n\n`unclosed\n")
+        html = os.path.join(tmp_dir, "book.html")
+        dest = os.path.join(tmp_dir, "book.epub")
+        # a warning is level 2, the exit status is 10 + level
+        assert run(["--exit-status=2", source, dest]) == 12
+        assert run(["--exit-status=2", "--target", "html:" + html, source, dest]) == 12
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def book_files(data):
+    """
+    the members of an epub, without the files holding the random uuid
+    """
+    with zipfile.ZipFile(io.BytesIO(data)) as book:
+        return dict(
+            (name, book.read(name))
+            for name in book.namelist()
+            if name not in ("OEBPS/content.opf", "OEBPS/toc.ncx")
+        )
+
+
+def test_build_cleans_up():
+    tmp_dir = tempfile.mkdtemp()
+    old_tempdir = tempfile.tempdir
+    tempfile.tempdir = tmp_dir
+    try:
+        data = rst2epub.build_file(SAMPLE)
+        assert data.startswith(b"PK")
+        assert os.listdir(tmp_dir) == []
+    finally:
+        tempfile.tempdir = old_tempdir
+        shutil.rmtree(tmp_dir)
+
+
+def test_build_threads():
+    from concurrent.futures import ThreadPoolExecutor
+
+    expected = book_files(rst2epub.build_file(SAMPLE))
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        results = list(pool.map(rst2epub.build_file, [SAMPLE] * 4))
+    for data in results:
+        assert book_files(data) == expected
+
+
+def test_import_leaves_directives_alone():
+    code = (
+        "import rst2epub\n"
+        "from docutils.parsers.rst import directives, roles\n"
+        "assert 'index' not in directives._directives\n"
+        "assert 'contents' not in directives._directives\n"
+        "assert 'envvar' not in roles._roles\n"
+    )
+    assert subprocess.call([sys.executable, "-c", code], cwd=ROOT) == 0
+
+
+def test_dep_file(tmp_path):
+    shutil.copy(os.path.join(ROOT, "sample", "blue.png"), str(tmp_path))
+    (tmp_path / "style.css").write_text("p { margin: 0 }")
+    # overrides the bundled main.css
+    (tmp_path / "main.css").write_text("body { margin: 0 }")
+    (tmp_path / "part.rst").write_text("Included text.\n")
+    (tmp_path / "book.rst").write_text(
+        "Chapter\n=======\n\n.. css:style.css\n\n.. include:: part.rst\n\n"
+        ".. image:: blue.png\n\nChapter 2\n=========\n\n.. addimg:blue.png\n\ntext\n"
+    )
+    cwd = os.getcwd()
+    os.chdir(str(tmp_path))
+    try:
+        assert run(["--dep-file=book.json", "book.rst", "book.epub"]) == 0
+        assert run(["--dep-file=book.d", "book.rst", "book.epub"]) == 0
+        args = ["--dep-file=html.json", "--target=html:book.html"]
+        assert run(args + ["book.rst", "book.epub"]) == 0
+    finally:
+        os.chdir(cwd)
+    data = json.loads((tmp_path / "book.json").read_text())
+    assert data["outputs"] == ["book.epub"]
+    deps = data["dependencies"]
+    assert deps[0] == "book.rst"
+    for name in ("part.rst", "style.css", "main.css", "blue.png"):
+        assert deps.count(name) == 1
+    html = json.loads((tmp_path / "html.json").read_text())
+    assert html["outputs"] == ["book.epub", "book.html"]
+    # not the html writer's own stylesheet
+    assert html["dependencies"] == deps
+    rule = (tmp_path / "book.d").read_text().split("\n")
+    assert rule[0] == "book.epub: " + " ".join(deps)
+    assert "part.rst:" in rule
+
+
+def test_update_archive(tmp_path):
+    dest = str(tmp_path / "book.epub")
+    assert run([SAMPLE, dest]) == 0
+    with open(dest, "rb") as fin:
+        first = book_files(fin.read())
+    assert run(["--update-archive", SAMPLE, dest]) == 0
+    with open(dest, "rb") as fin:
+        assert book_files(fin.read()) == first
+
+
+def test_member_store(tmp_path):
+    store = str(tmp_path / "store")
+    first = str(tmp_path / "first.epub")
+    second = str(tmp_path / "second.epub")
+    assert run(["--member-store", store, SAMPLE, first]) == 0
+    entries = sorted(os.listdir(store))
+    assert entries
+    assert run(["--member-store", store, SAMPLE, second]) == 0
+    with open(first, "rb") as fin:
+        expected = book_files(fin.read())
+    with open(second, "rb") as fin:
+        assert book_files(fin.read()) == expected
+    # only the files with the random uuid were new
+    assert len(os.listdir(store)) == len(entries) + 2
+
+
+def test_metadata_json(tmp_path):
+    source = tmp_path / "book.rst"
+    source.write_text(
+        u".. meta::\n   :DC.Title: Meta Title\n   :coverpage: cover.png\n\n"
+        u"First\n=====\n\ntext\n\nSub\n---\n\ntext\n\nSecond\n======\n\ntext\n"
+    )
+    result = rst2epub.extract_metadata(str(source))
+    assert result["title"] == "Meta Title"
+    assert result["cover"] == str(tmp_path / "cover.png")
+    assert result["chapters"] == ["First", "Second"]
+    out = subprocess.check_output(
+        [sys.executable, os.path.join(ROOT, "rst2epub.py"), "--metadata-json"]
+        + ["--jobs", "2", SAMPLE, str(source)]
+    )
+    sample, book = [json.loads(line) for line in out.decode("utf8").splitlines()]
+    assert sample["title"] == "Example rst2epub2.py Book"
+    assert sample["creators"] == ["Matt Harrison"]
+    assert sample["cover"] == os.path.join(ROOT, "sample", "blue.png")
+    assert sample["chapters"][0] == "Using rst for Books"
+    assert book["source"] == str(source)
+    assert run(["--metadata-json", str(tmp_path / "missing.rst")]) == 1
+    # the flag can come after the file
+    out = subprocess.check_output(
+        [sys.executable, os.path.join(ROOT, "rst2epub.py"), str(source)]
+        + ["--metadata-json"]
+    )
+    assert json.loads(out.decode("utf8"))["title"] == "Meta Title"
+    assert rst2epub.main(["rst2epub", str(source), "--metadata-json"]) == 0
+
+
+def test_publish_targets_copies(tmp_path, monkeypatch):
+    from docutils import io as docutils_io
+    from docutils.core import Publisher
+    from docutils.writers import html4css1
+
+    documents = []
+
+    class Recorder(html4css1.Writer):
+        def write(self, document, destination):
+            documents.append(document)
+            return html4css1.Writer.write(self, document, destination)
+
+    monkeypatch.setitem(
+        rst2epub.TARGETS, "html", (Recorder, docutils_io.FileOutput)
+    )
+    publisher = Publisher(
+        reader="standalone",
+        parser="restructuredtext",
+        writer=Recorder(),
+        source_class=docutils_io.StringInput,
+        destination_class=docutils_io.StringOutput,
+    )
+    publisher.process_programmatic_settings(None, None, None)
+    publisher.set_source("Title\n=====\n\n.. image:: a.png\n")
+    publisher.set_destination()
+    targets = ["html:" + str(tmp_path / "a.html"), "html:" + str(tmp_path / "b.html")]
+    rst2epub.publish_targets(publisher, targets)
+    # every writer but the last gets its own copy
+    assert len(set(map(id, documents))) == 3
+    assert documents[-1] is publisher.document
+    assert (tmp_path / "a.html").read_text() == (tmp_path / "b.html").read_text()
@@ -0,0 +1,186 @@
+import io
+import os
+import zipfile
+
+from docutils import statemachine
+from docutils.core import publish_string
+
+import rst2epub
+from epublib import rstparallel
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SAMPLE = os.path.join(ROOT, "sample", "sample.rst")
+
+# features that cross section boundaries: footnote numbering, targets,
+# duplicate names, substitutions, roles, index ids, pending transforms
+BOOK = """\
+==========
+Big Book
+==========
+
+:author: Someone
+:version: 1
+
+.. |name| replace:: the book
+
+.. role:: custom(emphasis)
+
+Preface text about |name| and |later|. See `Chapter Two`_ and [#]_.
+
+.. [#] A preface footnote.
+
+.. contents::
+
+Chapter One
+===========
+
+.. _shared:
+
+Intro with :custom:`role text` and a ref to shared_ and [#first]_ and [*]_.
+
+.. index:: apple, banana
+
+Exercises
+---------
+
+Some `unknown target`_ here, and |undefined| too.
+
+.. [#first] first footnote
+.. [*] symbol note
+
+.. index:: single: cherry
+
+Details
+~~~~~~~
+
+Deep text::
+
+  code here
+
+Chapter Two
+===========
+
+.. role:: other(strong)
+
+.. _shared:
+
+Duplicate target above. Text :other:`x` [#]_ and `Chapter One`_.
+
+.. [#] auto in two
+
+.. |later| replace:: defined late
+
+Exercises
+---------
+
+Same title as in chapter one [2]_.
+
+.. [2] manual footnote
+
+.. index:: pair: module; os
+
+Chapter Three
+=============
+
+Using :custom:`still works` and `anonymous`__ link.
+
+__ http://example.com
+
+.. note:: A note with *emphasis*.
+
+.. class:: special
+
+Classed paragraph, |name|.
+
+Exercises
+---------
+
+.. _exercises:
+
+Third exercises with `Exercises`_ reference.
+
+Problem `link <http://x.org>`_ and ``literal``.
+
+.. image:: blue.png
+
+=====
+Bad
+"""
+
+
+def pseudo_xml(text, processes, parsed=None):
+    if parsed is not None:
+        parse = rstparallel.parse
+
+        def record(*args):
+            parsed.append(parse(*args))
+            return parsed[-1]
+
+        rstparallel.parse = record
+    try:
+        return publish_string(
+            text,
+            source_path="book.rst",
+            parser=rst2epub.Parser(),
+            writer="pseudoxml",
+            settings_overrides={
+                "parallel_parse": processes,
+                "report_level": 1,
+                "halt_level": 5,
+                "warning_stream": io.StringIO(),
+            },
+        ).decode("utf8")
+    finally:
+        if parsed is not None:
+            rstparallel.parse = parse
+
+
+def test_find_titles():
+    lines = statemachine.string2lines(
+        "=====\nTitle\n=====\n\n"
+        "One\n===\n\ntext::\n\n> Quoted\n> =======\n\n"
+        "- Item\n------\n\n"
+        "Sub\n---\nTwo\n===\n"
+    )
+    assert rstparallel.find_titles(lines) == [
+        (0, ("=", "=")),
+        (4, "="),
+        (15, "-"),
+        (17, "="),
+    ]
+
+
+def test_plan_pieces():
+    lines = statemachine.string2lines(BOOK)
+    level, styles, starts = rstparallel.plan_pieces(lines)
+    # the document title is level 1, chapters are split
+    assert level == 2
+    assert [lines[start] for start in starts] == [
+        "Chapter One",
+        "Chapter Two",
+        "Chapter Three",
+    ]
+
+
+def test_same_as_serial():
+    parsed = []
+    assert pseudo_xml(BOOK, 2, parsed) == pseudo_xml(BOOK, 0)
+    assert parsed == [True]
+
+
+def test_no_split_is_serial():
+    parsed = []
+    text = "Title\n=====\n\nOnly one section.\n"
+    assert pseudo_xml(text, 2, parsed) == pseudo_xml(text, 0)
+    assert parsed == [False]
+
+
+def test_epub_same_as_serial():
+    serial = zipfile.ZipFile(io.BytesIO(rst2epub.build_file(SAMPLE)))
+    parallel = zipfile.ZipFile(
+        io.BytesIO(rst2epub.build_file(SAMPLE, options={"parallel_parse": 2}))
+    )
+    assert serial.namelist() == parallel.namelist()
+    for name in serial.namelist():
+        if name not in ("OEBPS/content.opf", "OEBPS/toc.ncx"):  # uuid
+            assert serial.read(name) == parallel.read(name), name
@@ -0,0 +1,185 @@
+import io
+import json
+import os
+import socket
+import tempfile
+import threading
+import time
+import zipfile
+
+from http.client import HTTPConnection, HTTPResponse
+
+import rst2epub
+from epublib import server
+
+
+def sleepy_build(text, base_dir=None, options=None):
+    """
+    stand in for rst2epub.build that sleeps for `text` seconds
+    """
+    time.sleep(float(text))
+    return b"slept"
+
+
+def book_text(data):
+    with zipfile.ZipFile(io.BytesIO(data)) as book:
+        return b"".join(book.read(name) for name in book.namelist())
+
+
+class Server(object):
+    def __init__(self, build, **kw):
+        self.pool = server.WorkerPool(build, **kw)
+        self.httpd = server.make_server(self.pool, port=0)
+        self.port = self.httpd.server_address[1]
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def request(self, method, path, body=None):
+        conn = HTTPConnection("127.0.0.1", self.port, timeout=60)
+        try:
+            conn.request(method, path, body)
+            response = conn.getresponse()
+            return response.status, response.read()
+        finally:
+            conn.close()
+
+    def metrics(self):
+        return json.loads(self.request("GET", "/metrics")[1].decode("utf8"))
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.pool.close()
+
+
+def test_convert():
+    srv = Server(rst2epub.build, workers=1, queue_size=1)
+    try:
+        status, data = srv.request("POST", "/convert", b"Title\n=====\n\nText.\n")
+        assert status == 200
+        assert data.startswith(b"PK")
+        metrics = srv.metrics()
+        assert metrics["completed"] == 1
+        assert metrics["latency"]["count"] == 1
+        assert srv.request("GET", "/health") == (200, b"ok\n")
+    finally:
+        srv.close()
+
+
+def test_convert_never_reads_server_files():
+    srv = Server(rst2epub.build, workers=1, queue_size=1)
+    fd, path = tempfile.mkstemp(suffix=".rst")
+    os.write(fd, b"Secret\n======\n\nsecret-token\n")
+    os.close(fd)
+    try:
+        # a one line upload naming a file is text, not a path
+        status, data = srv.request("POST", "/convert", path)
+        assert status == 200
+        assert b"secret-token" not in book_text(data)
+        # include is disabled (a warning, the directive is dropped)
+        text = "Title\n=====\n\n.. include:: " + path
+        status, data = srv.request("POST", "/convert", text)
+        assert status == 200
+        assert b"secret-token" not in book_text(data)
+        # absolute paths and paths out of the base dir are refused
+        for text in (
+            ".. image:: /etc/hostname\n",
+            ".. image:: ../../etc/hostname\n",
+            ".. css:/etc/hostname\n\nText\n",
+            ".. font:../x.ttf\n\nText\n",
+        ):
+            status, data = srv.request("POST", "/convert", text)
+            assert status == 422, text
+        assert srv.metrics()["failed"] == 4
+    finally:
+        srv.close()
+        os.remove(path)
+
+
+def test_queue_full():
+    srv = Server(sleepy_build, workers=1, queue_size=0)
+    try:
+        results = []
+        busy = threading.Thread(
+            target=lambda: results.append(srv.request("POST", "/convert", b"1"))
+        )
+        busy.start()
+        while srv.metrics()["running"] == 0:
+            time.sleep(0.01)
+        assert srv.request("POST", "/convert", b"0")[0] == 503
+        busy.join()
+        assert results == [(200, b"slept")]
+        assert srv.metrics()["rejected"] == 1
+    finally:
+        srv.close()
+
+
+def test_timeout():
+    srv = Server(sleepy_build, workers=1, queue_size=0, timeout=0.5)
+    try:
+        start = time.time()
+        assert srv.request("POST", "/convert", b"30")[0] == 504
+        assert time.time() - start < 10
+        # the stuck worker was replaced
+        assert srv.request("POST", "/convert", b"0") == (200, b"slept")
+        metrics = srv.metrics()
+        assert metrics["timeouts"] == 1
+        assert metrics["completed"] == 1
+        assert metrics["queue_depth"] == 0
+        assert metrics["running"] == 0
+    finally:
+        srv.close()
+
+
+def test_worker_base_dirs_removed():
+    pool = server.WorkerPool(sleepy_build, workers=2, queue_size=0)
+    base_dirs = [worker.base_dir for worker in list(pool.idle.queue)]
+    assert all(os.path.isdir(path) for path in base_dirs)
+    pool.close()
+    assert not any(os.path.exists(path) for path in base_dirs)
+
+
+def raw_status(port, head, body=b""):
+    """
+    send `head` (request line and headers) and `body` as they are and
+    return the status of the response
+    """
+    sock = socket.create_connection(("127.0.0.1", port), timeout=10)
+    try:
+        sock.sendall(head.encode("latin1") + b"\r\n\r\n" + body)
+        response = HTTPResponse(sock)
+        response.begin()
+        return response.status
+    finally:
+        sock.close()
+
+
+def test_bad_requests():
+    srv = Server(sleepy_build, workers=1, queue_size=0)
+    try:
+        post = "POST /convert HTTP/1.0"
+        length = post + "\r\nContent-Length: "
+        assert raw_status(srv.port, post) == 411
+        assert raw_status(srv.port, length + "x") == 400
+        assert raw_status(srv.port, length + "-1") == 400
+        # not utf-8
+        assert raw_status(srv.port, length + "2", b"\xff\xfe") == 400
+        # nothing reached the workers
+        assert srv.metrics()["completed"] + srv.metrics()["failed"] == 0
+    finally:
+        srv.close()
+
+
+def test_worker_start_timeout():
+    # no spawned worker is ready this quickly
+    srv = Server(sleepy_build, workers=1, queue_size=0, start_timeout=0.001)
+    try:
+        worker = srv.pool.idle.queue[0]
+        status, data = srv.request("POST", "/convert", b"0")
+        assert status == 422
+        assert b"didn't start" in data
+        assert srv.pool.idle.queue[0] is not worker
+        assert not worker.process.is_alive()
+    finally:
+        srv.close()
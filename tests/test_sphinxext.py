@@ -0,0 +1,83 @@
+import pytest
+
+pytest.importorskip("sphinx")
+
+import sphinxext  # noqa: E402
+from epublib import epub  # noqa: E402
+
+
+def make_builder():
+    # only what replay_document and merge_document use
+    builder = object.__new__(sphinxext.MobiBuilder)
+    builder.ebook = epub.EpubBook()
+    builder.ebook.set_title("Book")
+    builder.chapter_order = 0
+    builder.image_paths = set()
+    return builder
+
+
+# body, events of each document as DocumentTranslator records them
+RESULTS = {
+    "index": (
+        ["<h1>", "Index", "</h1>", "<p>intro</p>", "<p>after</p>"],
+        [
+            (3, "title", True),
+            (4, "chapter", None),
+            (4, "toctree-start", None),
+            (4, "include", ["one", "two"]),
+            (4, "toctree-end", None),
+            (5, "chapter", None),
+        ],
+    ),
+    "one": (
+        ["<h1>", "One", "</h1>", "<p>1</p>"],
+        [
+            (3, "title", True),
+            (4, "image", ("/abs/a.png", "a.png")),
+            (4, "chapter", None),
+        ],
+    ),
+    "two": (
+        ["<h1>", "Two", "</h1>", "<p>2</p>"],
+        [(3, "title", True), (4, "chapter", None)],
+    ),
+}
+
+
+def test_replay_document():
+    builder = make_builder()
+    state = sphinxext.ReplayState()
+    builder.replay_document("index", RESULTS, state)
+    titles = [title for title, _, _ in state.chapters]
+    assert titles == ["Index", "One", "Two", ""]
+    assert [add for _, _, add in state.chapters] == [False, True, True, False]
+    assert "<p>intro</p>" in state.chapters[0][1]
+    assert "<p>1</p>" in state.chapters[1][1]
+    assert "<p>after</p>" in state.chapters[3][1]
+    assert state.toc_page_at == 1
+    assert state.images == [("/abs/a.png", "a.png")]
+
+
+def test_replay_skips_missing_documents():
+    builder = make_builder()
+    state = sphinxext.ReplayState()
+    results = dict(RESULTS)
+    del results["two"]
+    builder.replay_document("index", results, state)
+    assert [title for title, _, _ in state.chapters] == ["Index", "One", ""]
+
+
+def test_merge_document():
+    # the serial build merges the translator's results the same way
+    builder = make_builder()
+    state = sphinxext.ReplayState()
+    builder.replay_document("index", RESULTS, state)
+    builder.merge_document(state.chapters, state.images, state.toc_page_at)
+    book = builder.ebook
+    assert book.toc_page is not None
+    spine = [item.dest_path for _, item, _ in book.get_spine()]
+    assert spine == ["0.html", "toc.html", "1.html", "2.html", "3.html"]
+    assert [node.title for node in book.get_toc_entries()] == ["One", "Two"]
+    # images are added once however many documents use them
+    builder.merge_document([], state.images, None)
+    assert builder.image_paths == set(["/abs/a.png"])
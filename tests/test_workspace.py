@@ -0,0 +1,121 @@
+import os
+
+import pytest
+
+import rst2epub
+from epublib import workspace
+from epublib.epub import EpubBook
+from epublib.workspace import QuotaExceeded, Workspace
+
+
+def write(path, size):
+    with open(path, "wb") as fout:
+        fout.write(b"x" * size)
+
+
+def test_removed_on_success(tmpdir):
+    with Workspace(root=str(tmpdir)) as ws:
+        assert os.path.dirname(ws.path) == str(tmpdir)
+        write(os.path.join(ws.path, "a"), 10)
+    assert os.listdir(str(tmpdir)) == []
+
+
+def test_root_from_environment(tmpdir, monkeypatch):
+    root = os.path.join(str(tmpdir), "shm")
+    monkeypatch.setenv(workspace.ROOT_ENV, root)
+    with Workspace() as ws:
+        assert os.path.dirname(ws.path) == root
+
+
+def test_kept_on_failure(tmpdir):
+    with pytest.raises(ValueError):
+        with Workspace(root=str(tmpdir)) as ws:
+            raise ValueError("broken")
+    assert os.listdir(str(tmpdir)) == [os.path.basename(ws.path)]
+    with open(os.path.join(ws.path, workspace.FAILED)) as fin:
+        assert "broken" in fin.read()
+
+
+def test_failed_pruned(tmpdir):
+    paths = []
+    for i in range(4):
+        with pytest.raises(ValueError):
+            with Workspace(root=str(tmpdir), keep_failed=2) as ws:
+                paths.append(ws.path)
+                raise ValueError(i)
+        os.utime(os.path.join(ws.path, workspace.FAILED), (i, i))
+    assert sorted(os.listdir(str(tmpdir))) == sorted(
+        os.path.basename(path) for path in paths[2:]
+    )
+
+
+def test_not_kept(tmpdir):
+    with pytest.raises(ValueError):
+        with Workspace(root=str(tmpdir), keep_failed=0):
+            raise ValueError()
+    assert os.listdir(str(tmpdir)) == []
+
+
+def test_quota(tmpdir):
+    with pytest.raises(QuotaExceeded):
+        with Workspace(root=str(tmpdir), quota=100) as ws:
+            write(os.path.join(ws.path, "a"), 60)
+            ws.check()
+            write(os.path.join(ws.path, "b"), 60)
+            ws.check()
+    # not kept, it is too big
+    assert os.listdir(str(tmpdir)) == []
+
+
+def test_build_workspace_options(tmpdir, monkeypatch):
+    doc = "Title\n=====\n\nSome text.\n"
+    data = rst2epub.build(doc, options={"workspace_dir": str(tmpdir)})
+    assert data.startswith(b"PK")
+    assert os.listdir(str(tmpdir)) == []
+    monkeypatch.setattr(workspace, "tree_size", lambda path: 2 * 1024 * 1024)
+    with pytest.raises(QuotaExceeded):
+        rst2epub.build(
+            doc, options={"workspace_dir": str(tmpdir), "workspace_quota": 1}
+        )
+    assert os.listdir(str(tmpdir)) == []
+
+
+def test_quota_while_writing(tmp_path):
+    book = EpubBook()
+    book.set_title("Book")
+    for i in range(20):
+        dest = "{0}.html".format(i)
+        book.add_spine_item(book.add_html("", dest, "x" * 1000))
+    written = []
+
+    def on_write(path):
+        written.append(path)
+        ws.add_file(path)
+
+    book.on_write = on_write
+    with pytest.raises(QuotaExceeded):
+        with Workspace(root=str(tmp_path), quota=5000) as ws:
+            book.create_book(os.path.join(ws.path, "epub"))
+    # stopped at the item that went over, not after the whole book
+    assert len(written) == 6
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_quota_while_archiving(tmp_path):
+    sizes = []
+    with Workspace(root=str(tmp_path)) as ws:
+        root_dir = os.path.join(ws.path, "epub")
+        book = EpubBook()
+        book.set_title("Book")
+        book.add_spine_item(book.add_html("", "1.html", "<p/>"))
+        book.create_book(root_dir)
+        EpubBook.create_archive(
+            root_dir, root_dir + ".epub", on_progress=sizes.append
+        )
+        assert sizes == sorted(sizes)
+        assert len(sizes) == len(EpubBook.list_archive_members(root_dir))
+        ws.check()
+        ws.quota = ws.used + 10
+        ws.check_writing(10)
+        with pytest.raises(QuotaExceeded):
+            ws.check_writing(11)
@@ -0,0 +1,67 @@
+import io
+import os
+
+import rst2epub
+from epublib import epub, xmlstream
+from genshi.core import Markup
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SAMPLE = os.path.join(ROOT, "sample", "sample.rst")
+
+
+def genshi(book, name):
+    return book.loader.load(name).generate(book=book).render("xml")
+
+
+def check(book):
+    book.toc_map_root.assign_play_order()
+    assert "".join(xmlstream.content_opf(book)) == genshi(book, "content.opf")
+    assert "".join(xmlstream.toc_ncx(book)) == genshi(book, "toc.ncx")
+
+
+def test_same_as_templates_empty():
+    check(epub.EpubBook())
+
+
+def test_same_as_templates(tmp_path):
+    book = epub.EpubBook()
+    book.set_title(u'A & <b>"B"</b> 壁')
+    book.add_creator("X & Y")
+    book.add_creator("", role="edt")
+    book.add_meta("publisher", "P & Q")
+    book.add_meta("rights", Markup("<i>kept</i>"))
+    html = book.add_html("", "1.html", "<p/>")
+    book.add_spine_item(html)
+    other = book.add_html("", "2.html", "<p/>")
+    book.add_spine_item(other, linear=False)
+    book.add_image("a.png", "a & b.png")
+    book.add_image("a.xyz", "a.xyz")  # no media type, left out
+    book.add_guide_item("1.html", 'Say "hi" & <go>', "text")
+    one = book.add_toc_map_node("1.html", "One & <i>two</i>")
+    child = book.add_toc_map_node("1.html#x", "Child", parent=one)
+    book.add_toc_map_node("1.html#y", "Grand", parent=child)
+    book.add_toc_map_node("2.html", "Two")
+    check(book)
+
+
+def test_same_as_templates_sample():
+    with io.open(SAMPLE, encoding="utf-8-sig") as fin:
+        book = rst2epub.build_book(fin.read(), base_dir=os.path.dirname(SAMPLE))
+    check(book)
+
+
+def test_custom_templates(tmp_path):
+    for name in ("content.opf", "toc.ncx"):
+        (tmp_path / name).write_text(u'<custom xmlns:py="http://genshi.edgewall.org/"/>')
+    book = epub.EpubBook()
+    assert book._bundled_templates()
+    from genshi.template import TemplateLoader
+
+    book.loader = TemplateLoader(str(tmp_path))
+    book.root_dir = str(tmp_path / "book")
+    book.make_dirs()
+    book._write_content_opf()
+    book._write_toc_ncx()
+    for name in ("content.opf", "toc.ncx"):
+        with io.open(os.path.join(book.root_dir, "OEBPS", name)) as fin:
+            assert fin.read() == "<custom/>"
@@ -0,0 +1,173 @@
+import os
+import zipfile
+
+from epublib import ziputil
+from epublib.epub import EpubBook
+
+OPF = (
+    '<package xmlns="http://www.idpf.org/2007/opf"><manifest>'
+    '<item href="a.html"/><item href="b.html"/></manifest></package>'
+)
+
+
+def make_root(root_dir, files):
+    for name, text in files.items():
+        path = os.path.join(root_dir, name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, "w") as fout:
+            fout.write(text)
+
+
+def test_file_crc(tmp_path):
+    path = tmp_path / "a"
+    path.write_bytes(b"x" * 100000)
+    with zipfile.ZipFile(str(tmp_path / "a.zip"), "w") as fout:
+        fout.write(str(path), "a")
+        info = fout.getinfo("a")
+    assert ziputil.file_crc(str(path)) == (info.CRC, 100000)
+
+
+def test_raw_copy(tmp_path):
+    source = str(tmp_path / "source.zip")
+    with zipfile.ZipFile(source, "w", zipfile.ZIP_DEFLATED) as fout:
+        fout.writestr("a.txt", "a" * 1000)
+        fout.writestr("b.txt", "b")
+    copy = str(tmp_path / "copy.zip")
+    with zipfile.ZipFile(source) as old, zipfile.ZipFile(copy, "w") as fout:
+        fout.writestr("first", "new")
+        for info in old.infolist():
+            ziputil.write_raw(fout, info, ziputil.read_raw(old.fp, info))
+        fout.writestr("last", "new")
+    with zipfile.ZipFile(copy) as book:
+        assert book.testzip() is None
+        assert book.namelist() == ["first", "a.txt", "b.txt", "last"]
+        assert book.read("a.txt") == b"a" * 1000
+        assert book.getinfo("a.txt").compress_type == zipfile.ZIP_DEFLATED
+
+
+def test_create_archive_update(tmp_path, monkeypatch):
+    root_dir = str(tmp_path / "epub")
+    files = {
+        "META-INF/container.xml": "<container/>",
+        "OEBPS/content.opf": OPF,
+        "OEBPS/a.html": "a" * 1000,
+        "OEBPS/b.html": "b" * 1000,
+    }
+    make_root(root_dir, files)
+    path = str(tmp_path / "book.epub")
+    EpubBook.create_archive(root_dir, path)
+    make_root(root_dir, {"OEBPS/b.html": "changed"})
+    written = []
+    write = zipfile.ZipFile.write
+    monkeypatch.setattr(
+        zipfile.ZipFile,
+        "write",
+        lambda self, filename, arcname=None, **kw: written.append(arcname)
+        or write(self, filename, arcname, **kw),
+    )
+    # in place
+    EpubBook.create_archive(root_dir, path, previous=path)
+    assert written == [os.path.join("OEBPS", "b.html")]
+    with zipfile.ZipFile(path) as book:
+        assert book.testzip() is None
+        assert book.namelist()[0] == "mimetype"
+        assert book.read("OEBPS/b.html") == b"changed"
+        assert book.read("OEBPS/a.html") == b"a" * 1000
+    assert [name for name in os.listdir(str(tmp_path)) if name != "epub"] == [
+        "book.epub"
+    ]
+
+
+def test_compression_policy(tmp_path):
+    policy = ziputil.CompressionPolicy(
+        rules=[
+            ("image/png", zipfile.ZIP_STORED, None),
+            ("image/", zipfile.ZIP_DEFLATED, 1),
+        ],
+        default=(zipfile.ZIP_DEFLATED, 9),
+        min_gain=0.05,
+    )
+    assert policy.lookup("image/png") == (zipfile.ZIP_STORED, None)
+    assert policy.lookup("image/svg+xml") == (zipfile.ZIP_DEFLATED, 1)
+    assert policy.lookup(None) == (zipfile.ZIP_DEFLATED, 9)
+    text = tmp_path / "text"
+    text.write_bytes(b"abc" * 1000)
+    noise = tmp_path / "noise"
+    noise.write_bytes(os.urandom(10000))
+    assert policy.compression(str(text), "text/css") == (zipfile.ZIP_DEFLATED, 9)
+    # deflate wouldn't gain 5%
+    assert policy.compression(str(noise), "text/css") == (zipfile.ZIP_STORED, None)
+
+
+def test_create_archive_profiles(tmp_path):
+    root_dir = str(tmp_path / "epub")
+    opf = (
+        '<package xmlns="http://www.idpf.org/2007/opf"><manifest>'
+        '<item href="a.html" media-type="application/xhtml+xml"/>'
+        '<item href="a.png" media-type="image/png"/></manifest></package>'
+    )
+    files = {
+        "META-INF/container.xml": "<container/>",
+        "OEBPS/content.opf": opf,
+        "OEBPS/a.html": "a" * 1000,
+        "OEBPS/a.png": "png" * 1000,
+    }
+    make_root(root_dir, files)
+    preview = str(tmp_path / "preview.epub")
+    EpubBook.create_archive(root_dir, preview, policy=ziputil.PROFILES["preview"])
+    with zipfile.ZipFile(preview) as book:
+        assert book.testzip() is None
+        types = dict((info.filename, info.compress_type) for info in book.infolist())
+    assert types["OEBPS/a.png"] == zipfile.ZIP_STORED
+    assert types["OEBPS/a.html"] == zipfile.ZIP_DEFLATED
+    # the stored member of the preview is deflated for the release
+    release = str(tmp_path / "release.epub")
+    EpubBook.create_archive(
+        root_dir, release, previous=preview, policy=ziputil.PROFILES["release"]
+    )
+    with zipfile.ZipFile(release) as book:
+        assert book.getinfo("OEBPS/a.png").compress_type == zipfile.ZIP_DEFLATED
+        assert book.read("OEBPS/a.png") == b"png" * 1000
+
+
+def test_member_store(tmp_path):
+    root_dir = str(tmp_path / "epub")
+    make_root(
+        root_dir,
+        {
+            "META-INF/container.xml": "<container/>",
+            "OEBPS/content.opf": OPF,
+            "OEBPS/a.html": "a" * 1000,
+            "OEBPS/b.html": "b" * 1000,
+        },
+    )
+    store = ziputil.MemberStore(str(tmp_path / "store"))
+    first = str(tmp_path / "first.epub")
+    EpubBook.create_archive(root_dir, first, store=store)
+    assert (store.hits, store.misses) == (0, 4)
+    # the same content under another name is a hit too
+    make_root(root_dir, {"OEBPS/b.html": "a" * 1000})
+    second = str(tmp_path / "second.epub")
+    EpubBook.create_archive(root_dir, second, store=store)
+    assert (store.hits, store.misses) == (4, 4)
+    with zipfile.ZipFile(second) as book:
+        assert book.testzip() is None
+        assert book.read("OEBPS/b.html") == b"a" * 1000
+        info = book.getinfo("OEBPS/a.html")
+        assert info.compress_type == zipfile.ZIP_DEFLATED
+        assert info.compress_size < info.file_size
+
+
+def test_member_store_evict(tmp_path):
+    store_dir = str(tmp_path / "store")
+    store = ziputil.MemberStore(store_dir, max_size=150)
+    paths = [store.entry_path(str(i), zipfile.ZIP_STORED, None) for i in range(3)]
+    for i, path in enumerate(paths):
+        store.put(path, 0, 100, b"x" * 100)
+        os.utime(path, (i, i))
+    # using the oldest makes it the most recent
+    assert store.get(paths[0]) == (0, 100, b"x" * 100)
+    assert store.evict() == 2
+    assert os.listdir(store_dir) == [os.path.basename(paths[0])]
+    assert store.get(paths[1]) is None